@@ -0,0 +1,204 @@
+"""Compiled inference backends of the SuperPoint and SuperGlue models"""
+import hashlib
+import os
+import warnings
+
+import torch
+from torch import nn
+
+from superglue_lib.models.superpoint import simple_nms, remove_borders, top_k_keypoints, sample_descriptors
+import superglue_batch
+
+############################################################################################################
+# Backends of the feature matching models (Localizer(backend=...), inference_backend in wildnav.py):
+#   eager         the models run op by op through the PyTorch Python dispatch
+#   torchscript   the dense parts of the models are traced once into TorchScript graphs, frozen and optimized
+#                 for inference (constant weights, fused operations), and run without Python overhead:
+#                   - SuperPoint up to the non maximum suppression of the keypoint scores map and the
+#                     normalized descriptor map; selecting the keypoints (their number depends on the image)
+#                     and sampling their descriptors stays in Python
+#                   - the SuperGlue network and optimal transport of a padded batch of pairs (see
+#                     superglue_batch.batch_scores); selecting the matches stays in Python
+# The graphs work for any image size and number of keypoints. They are written to cache_dir, named after
+# the model weights, config, torch version and device, and loaded from there the next time. After
+# building or loading, every graph is run next to the eager model on inputs of another size than the
+# one it was traced with; if the outputs differ by more than the tolerance the eager model is used.
+############################################################################################################
+
+BACKENDS = ['eager', 'torchscript']
+BACKEND_VERSION = 1 # bump when the traced modules change, so that old cached graphs are not used
+RTOL, ATOL = 1e-3, 1e-4 # tolerance of the compiled graphs against the eager models
+
+
+class SuperPointDense(nn.Module):
+    """SuperPoint forward pass up to the keypoint scores map after non maximum suppression and the descriptor map"""
+    def __init__(self, superpoint):
+        super().__init__()
+        self.superpoint = superpoint
+        self.nms_radius = superpoint.config['nms_radius']
+
+    def forward(self, image):
+        sp = self.superpoint
+        # Shared Encoder
+        x = sp.relu(sp.conv1a(image))
+        x = sp.relu(sp.conv1b(x))
+        x = sp.pool(x)
+        x = sp.relu(sp.conv2a(x))
+        x = sp.relu(sp.conv2b(x))
+        x = sp.pool(x)
+        x = sp.relu(sp.conv3a(x))
+        x = sp.relu(sp.conv3b(x))
+        x = sp.pool(x)
+        x = sp.relu(sp.conv4a(x))
+        x = sp.relu(sp.conv4b(x))
+
+        # Compute the dense keypoint scores
+        cPa = sp.relu(sp.convPa(x))
+        scores = sp.convPb(cPa)
+        scores = torch.nn.functional.softmax(scores, 1)[:, :-1]
+        b, _, h, w = scores.shape
+        scores = scores.permute(0, 2, 3, 1).reshape(b, h, w, 8, 8)
+        scores = scores.permute(0, 1, 3, 2, 4).reshape(b, h*8, w*8)
+        scores = simple_nms(scores, self.nms_radius)
+
+        # Compute the dense descriptors
+        cDa = sp.relu(sp.convDa(x))
+        descriptors = sp.convDb(cDa)
+        descriptors = torch.nn.functional.normalize(descriptors, p=2, dim=1)
+        return scores, descriptors
+
+
+class CompiledSuperPoint(nn.Module):
+    """SuperPoint with a compiled dense part, same input and output as the SuperPoint module"""
+    def __init__(self, dense, config):
+        super().__init__()
+        self.dense = dense
+        self.config = config # shared with the eager module, the keypoint threshold can be changed on the fly
+
+    def forward(self, data):
+        scores, descriptors = self.dense(data['image'])
+        _, height, width = scores.shape
+
+        # Extract keypoints, as in SuperPoint.forward
+        keypoints = [torch.nonzero(s > self.config['keypoint_threshold']) for s in scores]
+        scores = [s[tuple(k.t())] for s, k in zip(scores, keypoints)]
+        keypoints, scores = list(zip(*[remove_borders(k, s, self.config['remove_borders'], height, width)
+                                       for k, s in zip(keypoints, scores)]))
+        if self.config['max_keypoints'] >= 0:
+            keypoints, scores = list(zip(*[top_k_keypoints(k, s, self.config['max_keypoints'])
+                                           for k, s in zip(keypoints, scores)]))
+        # Convert (h, w) to (x, y)
+        keypoints = [torch.flip(k, [1]).float() for k in keypoints]
+
+        descriptors = [sample_descriptors(k[None], d[None], 8)[0] for k, d in zip(keypoints, descriptors)]
+        return {'keypoints': keypoints, 'scores': scores, 'descriptors': descriptors}
+
+
+class SuperGlueScores(nn.Module):
+    """superglue_batch.batch_scores() as a module, to be traced"""
+    def __init__(self, superglue):
+        super().__init__()
+        self.superglue = superglue
+
+    def forward(self, kpts0, scores0, desc0, mask0, kpts1, scores1, desc1, mask1):
+        return superglue_batch.batch_scores(self.superglue, kpts0, scores0, desc0, mask0, kpts1, scores1, desc1, mask1)
+
+
+def _superpoint_inputs(device, height, width):
+    generator = torch.Generator().manual_seed(height * width)
+    return (torch.rand((1, 1, height, width), generator=generator).to(device),)
+
+
+def _superglue_inputs(device, dim, sizes0, sizes1):
+    """Random padded batch of pairs with the given numbers of keypoints"""
+    generator = torch.Generator().manual_seed(sum(sizes0) * sum(sizes1))
+    inputs = []
+    for sizes in (sizes0, sizes1):
+        length = max(sizes)
+        kpts = torch.rand((len(sizes), length, 2), generator=generator) - 0.5
+        scores = torch.rand((len(sizes), length), generator=generator)
+        desc = torch.nn.functional.normalize(torch.randn((len(sizes), dim, length), generator=generator), dim=1)
+        mask = torch.arange(length)[None] < torch.tensor(sizes)[:, None]
+        kpts, scores, desc = kpts * mask[:, :, None], scores * mask, desc * mask[:, None, :]
+        inputs += [kpts.to(device), scores.to(device), desc.to(device), mask.to(device)]
+    return tuple(inputs)
+
+
+def weights_digest(module, config):
+    """Digest of the weights of a module, a config and the environment, names the cached graph"""
+    sha = hashlib.sha1(repr((BACKEND_VERSION, torch.__version__, sorted(config.items()))).encode())
+    for name, tensor in sorted(module.state_dict().items()):
+        sha.update(name.encode())
+        sha.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return sha.hexdigest()[:16]
+
+
+def compile_module(module, example_inputs, filename):
+    """
+    TorchScript graph of a module, optimized for inference: the frozen graph is loaded from filename, or traced,
+    frozen and written to filename. The optimization (fused, prepacked operations) depends on the CPU, it is not
+    cached.
+    """
+    device = example_inputs[0].device
+    graph = None
+    if os.path.isfile(filename):
+        try:
+            graph = torch.jit.load(filename, map_location=device)
+        except RuntimeError as error:
+            print("Could not load %s (%s), compiling it again" % (filename, error))
+
+    if graph is None:
+        with warnings.catch_warnings():
+            # the sizes of the inputs are traced as sizes, the tracer warns about every python number it sees
+            warnings.simplefilter("ignore", torch.jit.TracerWarning)
+            traced = torch.jit.trace(module.eval(), example_inputs, check_trace=False)
+        graph = torch.jit.freeze(traced.eval())
+        os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+        tmp_filename = "%s.%d.tmp" % (filename, os.getpid())
+        torch.jit.save(graph, tmp_filename)
+        os.replace(tmp_filename, filename)
+        print("Compiled " + filename)
+    return torch.jit.optimize_for_inference(graph)
+
+
+def outputs_match(reference, compiled, inputs):
+    """True if the compiled graph gives the outputs of the eager module, within RTOL / ATOL"""
+    expected, actual = reference(*inputs), compiled(*inputs)
+    if isinstance(expected, torch.Tensor):
+        expected, actual = (expected,), (actual,)
+    return all(e.shape == a.shape and torch.allclose(e, a, rtol=RTOL, atol=ATOL, equal_nan=True)
+               for e, a in zip(expected, actual))
+
+
+def compile_matching(matching, backend, cache_dir, device):
+    """
+    Runs the models of a superglue Matching module on a backend. The superpoint module of matching is replaced
+    by its compiled version, in place. Returns the scores function of the superglue batches to pass to
+    superglue_batch.match_batch(), None for the eager backend.
+    """
+    if backend not in BACKENDS:
+        raise ValueError("Unknown backend %s, use one of %s" % (backend, BACKENDS))
+    if backend == 'eager':
+        return None
+
+    superpoint, superglue = matching.superpoint, matching.superglue
+    superpoint_config = {'nms_radius': superpoint.config['nms_radius'], 'device': str(device)}
+    superglue_config = {'sinkhorn_iterations': superglue.config['sinkhorn_iterations'],
+                        'descriptor_dim': superglue.config['descriptor_dim'], 'device': str(device)}
+    dim = superglue.config['descriptor_dim']
+
+    dense = SuperPointDense(superpoint)
+    filename = os.path.join(cache_dir, "superpoint-%s.pt" % weights_digest(superpoint, superpoint_config))
+    dense_graph = compile_module(dense, _superpoint_inputs(device, 240, 320), filename)
+    if outputs_match(dense, dense_graph, _superpoint_inputs(device, 184, 248)):
+        matching.superpoint = CompiledSuperPoint(dense_graph, superpoint.config)
+    else:
+        print("The compiled superpoint graph does not match the eager model, using the eager model")
+
+    scores = SuperGlueScores(superglue)
+    filename = os.path.join(cache_dir, "superglue-%s.pt" % weights_digest(superglue, superglue_config))
+    scores_graph = compile_module(scores, _superglue_inputs(device, dim, [60, 45], [50, 30]), filename)
+    if outputs_match(scores, scores_graph, _superglue_inputs(device, dim, [23, 70, 41], [66, 12, 35])):
+        return scores_graph
+    print("The compiled superglue graph does not match the eager model, using the eager model")
+    return None
@@ -0,0 +1,234 @@
+"""Reproducible benchmark of the localization pipeline: latency, throughput, memory and accuracy as json"""
+import argparse
+import csv
+import json
+import math
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import cv2
+import numpy as np
+
+import evaluation
+import wildnav
+
+############################################################################################################
+# Every benchmark run localizes all the drone images of the query set in one map, in a fresh worker
+# process so that the peak memory (RSS) of a run is not inflated by the previous ones. Besides the
+# map itself, synthetic larger maps can be benchmarked: the map is repeated on a k x k grid next to
+# itself, every copy but the original one with flipped and contrast changed tiles, so the drone images
+# are still only found in the original tiles while there are k^2 times as many tiles to search.
+# With GNSS priors the copies are too far away to be matched, benchmark them with --no-prior.
+# The results are written as json with sorted keys, so that a regression between two commits shows up
+# in the diff of their benchmark files. Latencies vary from run to run, compare them with some margin.
+############################################################################################################
+
+MAX_ERROR_METERS = evaluation.MAX_ERROR_METERS # localization errors above this are counted as not located
+PERCENTILES = [50, 90, 95, 99]
+SYNTHETIC_DIR = "benchmark"
+CSV_HEADER = ['Filename', 'Top_left_lat', 'Top_left_lon', 'Bottom_right_lat', 'Bottom_right_long']
+
+
+def peak_rss_mb():
+    """Peak resident memory of the current process in MB, None where the resource module is not available"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10 # bytes on macOS, kilobytes on Linux
+
+
+def git_commit():
+    """Commit of the working tree, None outside of a git repository"""
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def augment(image, copy):
+    """Flipped and contrast changed version of a map tile, different for every synthetic copy of the map"""
+    image = cv2.flip(image, [1, 0, -1][copy % 3])
+    alpha = 0.8 + 0.1 * (copy % 5)
+    return cv2.convertScaleAbs(image, alpha=alpha, beta=10 * (copy % 4))
+
+
+def make_synthetic_map(map_filename, scale):
+    """
+    Writes a map scale x scale times as large as the map in map_filename, next to it in benchmark/x<scale>/,
+    and returns its csv filename. The original tiles are referenced, not copied.
+    """
+    map_dir = os.path.dirname(map_filename)
+    out_dir = os.path.join(map_dir, SYNTHETIC_DIR, "x%d" % scale)
+    os.makedirs(out_dir, exist_ok=True)
+    geo_photos = wildnav.csv_read_sat_map(map_filename, os.path.join(map_dir, ""))
+    min_lat = min(min(p.top_left_coord[0], p.bottom_right_coord[0]) for p in geo_photos)
+    max_lat = max(max(p.top_left_coord[0], p.bottom_right_coord[0]) for p in geo_photos)
+    min_lon = min(min(p.top_left_coord[1], p.bottom_right_coord[1]) for p in geo_photos)
+    max_lon = max(max(p.top_left_coord[1], p.bottom_right_coord[1]) for p in geo_photos)
+
+    rows = []
+    for copy in range(scale * scale):
+        # copy 0 is the original map, the other ones go south and east of it
+        d_lat = -(copy // scale) * (max_lat - min_lat)
+        d_lon = (copy % scale) * (max_lon - min_lon)
+        for geo_photo in geo_photos:
+            if copy == 0:
+                filename = os.path.relpath(geo_photo.filename, out_dir)
+            else:
+                name = os.path.splitext(os.path.basename(geo_photo.filename))[0]
+                filename = "%s_copy_%03d.png" % (name, copy)
+                if not os.path.isfile(os.path.join(out_dir, filename)):
+                    cv2.imwrite(os.path.join(out_dir, filename), augment(geo_photo.photo, copy))
+            rows.append([filename, geo_photo.top_left_coord[0] + d_lat, geo_photo.top_left_coord[1] + d_lon,
+                         geo_photo.bottom_right_coord[0] + d_lat, geo_photo.bottom_right_coord[1] + d_lon])
+
+    synthetic_filename = os.path.join(out_dir, "map.csv")
+    with open(synthetic_filename, 'w', newline='') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(CSV_HEADER)
+        writer.writerows(rows)
+    return synthetic_filename
+
+
+def accuracy(drone_images):
+    """Accuracy figures of evaluation.py for localized drone images"""
+    coordinates = np.array([(drone_image.latitude, drone_image.longitude, drone_image.latitude_calculated,
+                             drone_image.longitude_calculated) for drone_image in drone_images], dtype=float).reshape(-1, 4)
+    localized = coordinates[:, 2] != -1
+    errors = np.full(len(coordinates), np.nan)
+    errors[localized] = evaluation.haversine_m(*coordinates[localized].T)
+    summary = evaluation.summarize(errors, coordinates[:, 0] - coordinates[:, 2], coordinates[:, 1] - coordinates[:, 3],
+                                   MAX_ERROR_METERS)
+    return {
+        'total_images': len(drone_images),
+        'matched_images': sum(1 for drone_image in drone_images if drone_image.matched),
+        'located_images': summary['correct'],
+        'located_percent': summary['correct_percent'],
+        'mean_error_m': summary['error']['mean_m'],
+        'rms_error_m': summary['error']['rms_m'],
+        'mse_latitude': summary['mse_latitude'],
+        'mse_longitude': summary['mse_longitude'],
+    }
+
+
+def _run(map_filename, settings, threads, warmup):
+    """One benchmark run, in its own worker process: loads the map and localizes every drone image"""
+    import torch
+    if threads is not None:
+        torch.set_num_threads(threads)
+    for name, value in settings.items():
+        setattr(wildnav, name, value)
+    wildnav.map_filename = map_filename
+
+    start = time.perf_counter()
+    localizer = wildnav.create_localizer(no_display=True)
+    satellite_map = wildnav.load_satellite_map(localizer)
+    load_seconds = time.perf_counter() - start
+
+    drone_images = wildnav.csv_read_drone_images(wildnav.drone_photos_filename)
+    # warm up the model (lazy initialization, allocator) on copies of the first drone images
+    for drone_image in wildnav.csv_read_drone_images(wildnav.drone_photos_filename)[:warmup]:
+        wildnav.localize_drone_image(drone_image, localizer, satellite_map)
+
+    latencies = []
+    start = time.perf_counter()
+    for drone_image in drone_images:
+        image_start = time.perf_counter()
+        wildnav.localize_drone_image(drone_image, localizer, satellite_map)
+        latencies.append(time.perf_counter() - image_start)
+    total_seconds = time.perf_counter() - start
+
+    tiles = [drone_image.tiles_evaluated for drone_image in drone_images]
+    return {
+        'map': map_filename,
+        'map_tiles': len(satellite_map.tile_features),
+        'map_load_s': load_seconds,
+        'latency_s': {**{'p%d' % p: float(np.percentile(latencies, p)) for p in PERCENTILES},
+                      'mean': float(np.mean(latencies)), 'max': float(np.max(latencies))},
+        'images_per_s': len(drone_images) / total_seconds,
+        'peak_rss_mb': peak_rss_mb(),
+        'tiles_per_query': {'mean': float(np.mean(tiles)), 'max': int(np.max(tiles))},
+        'accuracy': accuracy(drone_images),
+        'images': {os.path.basename(drone_image.filename): {'matched': bool(drone_image.matched),
+                                                            'tiles_evaluated': drone_image.tiles_evaluated,
+                                                            'matches': drone_image.num_matches,
+                                                            'latitude_calculated': drone_image.latitude_calculated,
+                                                            'longitude_calculated': drone_image.longitude_calculated}
+                   for drone_image in drone_images},
+    }
+
+
+def run_benchmark(map_filenames, settings, threads=None, warmup=1):
+    """Benchmarks every map in a fresh worker process, returns the results of every run"""
+    context = multiprocessing.get_context("spawn")
+    runs = []
+    for map_filename in map_filenames:
+        print("Benchmarking map " + map_filename)
+        with context.Pool(1) as pool:
+            runs.append(pool.apply(_run, (map_filename, settings, threads, warmup)))
+    return runs
+
+
+def _rounded(value):
+    """Rounds the floats of the results, so that the json diff only shows meaningful changes"""
+    if isinstance(value, float):
+        return round(value, 4) if math.isfinite(value) else None
+    if isinstance(value, dict):
+        return {key: _rounded(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_rounded(item) for item in value]
+    return value
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks the localization pipeline and writes the results as json")
+    parser.add_argument('--map', default=wildnav.map_filename, help="csv file of the map")
+    parser.add_argument('--query', default=wildnav.drone_photos_filename, help="csv file with the drone images metadata")
+    parser.add_argument('--synthetic', type=int, nargs='*', default=[],
+                        help="also benchmark synthetic maps k x k times as large as the map, for every given k")
+    parser.add_argument('--no-prior', action='store_true', help="ignore the GNSS position of the drone images when selecting map tiles")
+    parser.add_argument('--threads', type=int, default=None, help="torch threads (default: all cores)")
+    parser.add_argument('--warmup', type=int, default=1, help="drone images localized before measuring")
+    parser.add_argument('--output', default="../results/benchmark.json", help="json file with the results")
+    args = parser.parse_args()
+
+    # pipeline settings of the benchmark, applied in the worker processes
+    settings = {
+        'drone_photos_filename': args.query,
+        'orthomosaic_filename': None,
+        'gnss_prior_radius': None if args.no_prior else wildnav.gnss_prior_radius,
+        'save_located_images': False,
+        'trace_matches': False,
+    }
+    for name in ['superglue_batch_size', 'retrieval_top_k', 'early_exit_min_matches', 'early_exit_min_inlier_ratio',
+                 'map_pyramid_levels', 'use_heading', 'fallback_rotations']:
+        settings[name] = getattr(wildnav, name)
+
+    map_filenames = [args.map] + [make_synthetic_map(args.map, scale) for scale in args.synthetic if scale > 1]
+    runs = run_benchmark(map_filenames, settings, args.threads, args.warmup)
+
+    import torch
+    results = {
+        'commit': git_commit(),
+        'environment': {'python': platform.python_version(), 'torch': torch.__version__, 'opencv': cv2.__version__,
+                        'machine': platform.machine(), 'cpu_count': os.cpu_count(), 'threads': args.threads},
+        'settings': settings,
+        'runs': runs,
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, 'w') as file:
+        json.dump(_rounded(results), file, indent=1, sort_keys=True)
+        file.write("\n")
+
+    for run in runs:
+        print("%-40s %5d tiles  p50 %6.2f s  p95 %6.2f s  %6.3f images/s  %s MB  located %d/%d" % (
+            run['map'], run['map_tiles'], run['latency_s']['p50'], run['latency_s']['p95'], run['images_per_s'],
+            "%.0f" % run['peak_rss_mb'] if run['peak_rss_mb'] is not None else "?",
+            run['accuracy']['located_images'], run['accuracy']['total_images']))
+    print("Results written to " + args.output)
@@ -0,0 +1,243 @@
+"""Evaluation of wildnav results: localization rate, localization error and stage timing of one or more runs"""
+import argparse
+import glob
+import json
+import os
+
+import numpy as np
+
+import results_store
+
+############################################################################################################
+# Evaluates results files written by wildnav (csv, npz or parquet, see results_store.py):
+#   python3 evaluation.py ../results/run_1.csv ../results/run_2.parquet --plot ../results
+# For every run it reports the number of drone images, how many were localized, how many within
+# --max-error meters of their GNSS position, and the mean / median / RMS / p95 error of those. The
+# results files are read in batches and only the coordinate columns are read; the errors are computed
+# for a whole batch at once. Stage timing comes from the instrumentation file of the run (the
+# instrumentation_filename of wildnav.py, found through the run metadata, or given with --timing).
+# Plots are only drawn with --plot, to image files, so no GUI is needed.
+############################################################################################################
+
+EARTH_RADIUS_M = 6371008.8 # mean earth radius, the one of the haversine package
+MAX_ERROR_METERS = 50 # localization errors above this are counted as wrong, as plot_data.py always did
+COORDINATE_COLUMNS = ['Latitude', 'Longitude', 'Calculated_Latitude', 'Calculated_Longitude']
+
+
+def haversine_m(latitude_1, longitude_1, latitude_2, longitude_2):
+    """Great circle distances in meters between arrays of coordinates in degrees"""
+    latitude_1, longitude_1, latitude_2, longitude_2 = (np.radians(np.asarray(values, dtype=float)) for values in
+                                                        (latitude_1, longitude_1, latitude_2, longitude_2))
+    a = np.sin((latitude_2 - latitude_1) / 2) ** 2 + \
+        np.cos(latitude_1) * np.cos(latitude_2) * np.sin((longitude_2 - longitude_1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+def error_statistics(errors):
+    """Mean, median, RMS, p95 and max of localization errors in meters, None values if there are none"""
+    errors = np.asarray(errors, dtype=float)
+    if len(errors) == 0:
+        return {'mean_m': None, 'median_m': None, 'rms_m': None, 'p95_m': None, 'max_m': None}
+    return {'mean_m': float(errors.mean()), 'median_m': float(np.median(errors)),
+            'rms_m': float(np.sqrt(np.square(errors).mean())), 'p95_m': float(np.percentile(errors, 95)),
+            'max_m': float(errors.max())}
+
+
+def read_errors(filename, batch_size=65536):
+    """
+    Localization errors in meters of the drone images of a results file, NaN for the ones that were not localized,
+    and the latitude / longitude differences. The file is read batch_size rows at a time.
+    """
+    errors, latitude_errors, longitude_errors = [], [], []
+    for batch in results_store.iter_results(filename, COORDINATE_COLUMNS, batch_size):
+        latitude, longitude = batch['Latitude'], batch['Longitude']
+        latitude_calculated, longitude_calculated = batch['Calculated_Latitude'], batch['Calculated_Longitude']
+        # -1 is the calculated latitude of the drone images that were not localized
+        localized = (latitude_calculated != -1) & np.isfinite(latitude_calculated) & np.isfinite(longitude_calculated)
+        error = np.full(len(latitude), np.nan)
+        error[localized] = haversine_m(latitude[localized], longitude[localized],
+                                       latitude_calculated[localized], longitude_calculated[localized])
+        errors.append(error)
+        latitude_errors.append(np.where(localized, latitude - latitude_calculated, np.nan))
+        longitude_errors.append(np.where(localized, longitude - longitude_calculated, np.nan))
+    if not errors:
+        return np.zeros(0), np.zeros(0), np.zeros(0)
+    return np.concatenate(errors), np.concatenate(latitude_errors), np.concatenate(longitude_errors)
+
+
+def summarize(errors, latitude_errors, longitude_errors, max_error=MAX_ERROR_METERS):
+    """Localization rate and error statistics of a run, from the arrays of read_errors()"""
+    images = len(errors)
+    localized = np.isfinite(errors)
+    correct = localized & (errors < max_error) if max_error is not None else localized
+    return {
+        'images': images,
+        'localized': int(localized.sum()),
+        'localized_percent': 100 * float(localized.sum()) / images if images else None,
+        'correct': int(correct.sum()),
+        'correct_percent': 100 * float(correct.sum()) / images if images else None,
+        'max_error_m': max_error,
+        'error': error_statistics(errors[correct]),
+        'mse_latitude': float(np.square(latitude_errors[correct]).mean()) if correct.any() else None,
+        'mse_longitude': float(np.square(longitude_errors[correct]).mean()) if correct.any() else None,
+    }
+
+
+def timing_files(results_filename, metadata):
+    """Instrumentation files of a run, from its metadata: the main file and the files of the worker processes"""
+    filename = ((metadata or {}).get('config') or {}).get('instrumentation_filename')
+    if not filename:
+        return []
+    candidates = [filename, os.path.join(os.path.dirname(results_filename), os.path.basename(filename))]
+    for candidate in candidates:
+        if os.path.isfile(candidate):
+            root, extension = os.path.splitext(candidate)
+            return [candidate] + sorted(glob.glob("%s.[0-9]*%s" % (glob.escape(root), extension)))
+    return []
+
+
+def stage_timing(filenames):
+    """
+    Duration of the stages (decode, superglue, homography, ...) from instrumentation files: count, total,
+    mean and, for jsonl files, median and p95 per stage.
+    """
+    durations = {} # stage -> list of durations (jsonl)
+    totals = {} # stage -> [sum, count] (prometheus)
+    for filename in filenames:
+        with open(filename) as file:
+            for line in file:
+                if line.startswith('{'):
+                    record = json.loads(line)
+                    if record.get('type') == 'span':
+                        durations.setdefault(record['name'], []).append(record['duration_s'])
+                elif line.startswith('wildnav_stage_seconds_'):
+                    # wildnav_stage_seconds_sum{stage="superglue"} 1.234567
+                    name, amount = line.rsplit(' ', 1)
+                    stage = name.split('"')[1]
+                    total = totals.setdefault(stage, [0.0, 0])
+                    if name.startswith('wildnav_stage_seconds_sum'):
+                        total[0] += float(amount)
+                    else:
+                        total[1] += int(float(amount))
+
+    timing = {}
+    for stage, total in totals.items():
+        timing[stage] = {'count': total[1], 'total_s': total[0], 'mean_ms': 1000 * total[0] / total[1] if total[1] else None}
+    for stage, values in durations.items():
+        values = np.array(values)
+        timing[stage] = {'count': len(values), 'total_s': float(values.sum()), 'mean_ms': 1000 * float(values.mean()),
+                         'median_ms': 1000 * float(np.median(values)), 'p95_ms': 1000 * float(np.percentile(values, 95))}
+    return timing
+
+
+def evaluate(filename, max_error=MAX_ERROR_METERS, timing=None, batch_size=65536):
+    """
+    Evaluates a results file. timing: instrumentation files of the run, None looks them up in the run metadata.
+    Returns the report and the localization errors of the drone images (NaN if not localized).
+    """
+    errors, latitude_errors, longitude_errors = read_errors(filename, batch_size)
+    report = {'filename': filename, **summarize(errors, latitude_errors, longitude_errors, max_error)}
+    if timing is None:
+        timing = timing_files(filename, results_store.read_metadata(filename))
+    report['timing'] = stage_timing(timing)
+    return report, errors
+
+
+def print_report(report):
+    def number(value, format="%.2f"):
+        return format % value if value is not None else "-"
+
+    print("Results: " + report['filename'])
+    print("  Drone images            %d" % report['images'])
+    print("  Localized               %d (%s %%)" % (report['localized'], number(report['localized_percent'])))
+    print("  %-24s%d (%s %%)" % ("Error < %s m" % number(report['max_error_m'], "%g"), report['correct'],
+                                   number(report['correct_percent'])))
+    error = report['error']
+    print("  Error [m]               mean %s  median %s  RMS %s  p95 %s  max %s" % tuple(
+        number(error[key]) for key in ('mean_m', 'median_m', 'rms_m', 'p95_m', 'max_m')))
+    print("  MSE latitude/longitude  %s / %s" % (number(report['mse_latitude'], "%.3g"),
+                                               number(report['mse_longitude'], "%.3g")))
+    if report['timing']:
+        print("  Stage                   count     mean [ms]  median [ms]   p95 [ms]   total [s]")
+        for stage, timing in sorted(report['timing'].items(), key=lambda item: -item[1]['total_s']):
+            print("  %-22s %6d %13s %12s %10s %11.2f" % (stage, timing['count'], number(timing['mean_ms']),
+                                                         number(timing.get('median_ms')), number(timing.get('p95_ms')),
+                                                         timing['total_s']))
+
+
+def plot(labels, errors_list, folder, max_error=MAX_ERROR_METERS):
+    """Draws the error of every drone image of each run and a box plot of the errors of the runs to folder"""
+    try:
+        import matplotlib
+        matplotlib.use('Agg') # files only, no window
+        import matplotlib.pyplot as plt
+    except ImportError:
+        raise ImportError("Plotting needs the matplotlib package: pip3 install matplotlib")
+    os.makedirs(folder, exist_ok=True)
+
+    correct_list = []
+    for label, errors in zip(labels, errors_list):
+        index = np.flatnonzero(np.isfinite(errors) & (errors < max_error if max_error is not None else True))
+        correct_list.append(errors[index])
+        fig = plt.figure(figsize=(15, 8))
+        ax = plt.gca()
+        ax.spines['top'].set_visible(False)
+        ax.spines['right'].set_visible(False)
+        ax.plot(index, errors[index], marker="o", color='r')
+        ax.set_xlabel("Photograph Index")
+        ax.set_ylabel("Localization Error [m]")
+        ax.set_title(label)
+        for extension in ('png', 'pdf'):
+            fig.savefig(os.path.join(folder, "error_%s.%s" % (label.replace(" ", "_"), extension)))
+        plt.close(fig)
+
+    fig = plt.figure(figsize=(15, 8))
+    ax = plt.gca()
+    ax.boxplot(correct_list)
+    ax.set_xticks(range(1, len(labels) + 1))
+    ax.set_xticklabels(labels)
+    ax.set_ylabel("Localization Error [m]")
+    for extension in ('png', 'pdf'):
+        fig.savefig(os.path.join(folder, "boxplot_error.%s" % extension))
+    plt.close(fig)
+    print("Plots saved to " + folder)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Evaluates the results files of one or more wildnav runs")
+    parser.add_argument('results', nargs='+', help="results files (.csv, .npz or .parquet)")
+    parser.add_argument('--labels', nargs='+', default=None, help="names of the runs (default: the file names)")
+    parser.add_argument('--max-error', type=float, default=MAX_ERROR_METERS,
+                        help="errors above this many meters count as wrong and are left out of the error statistics")
+    parser.add_argument('--timing', action='append', default=None,
+                        help="instrumentation file of a run, once per results file in the same order "
+                             "(default: the instrumentation_filename in the run metadata)")
+    parser.add_argument('--json', default=None, help="write the reports to this json file")
+    parser.add_argument('--plot', default=None, help="folder to draw the error plots to")
+    parser.add_argument('--batch-size', type=int, default=65536, help="rows of a results file read at a time")
+    args = parser.parse_args(argv)
+
+    labels = args.labels or [os.path.splitext(os.path.basename(filename))[0] for filename in args.results]
+    if len(labels) != len(args.results) or (args.timing is not None and len(args.timing) != len(args.results)):
+        parser.error("give one label and one timing file per results file")
+
+    reports, errors_list = [], []
+    for index, filename in enumerate(args.results):
+        timing = [args.timing[index]] if args.timing is not None else None
+        report, errors = evaluate(filename, args.max_error, timing, args.batch_size)
+        report['label'] = labels[index]
+        print_report(report)
+        reports.append(report)
+        errors_list.append(errors)
+
+    if args.json is not None:
+        with open(args.json, 'w') as file:
+            json.dump(reports, file, indent=1, sort_keys=True)
+        print("Reports saved to " + args.json)
+    if args.plot is not None:
+        plot(labels, errors_list, args.plot, args.max_error)
+    return reports
+
+
+if __name__ == "__main__":
+    main()
@@ -1,26 +1,42 @@
 """Script that reads the EXIF data from the drone images and extracts the GNSS coordinates to a csv file"""
-import subprocess
-import re
+import argparse
+import concurrent.futures
+import csv
+import json
+import math
 import os
+import re
+import shutil
+import struct
+import subprocess
 
 ############################################################################################################
-# Requires exiftool to be installed: https://exiftool.org/
-# You might have to modify the scripts to match the EXIF metadata of your drone photos 
+# Two backends read the metadata of the drone images:
+#   exiftool   a single exiftool process (https://exiftool.org/) kept open with -stay_open, fed the images
+#              in batches; reads any format exiftool knows
+#   python     a pure python reader of the JPEG EXIF GPS tags and the DJI XMP tags (drone-dji:GimbalYawDegree,
+#              ...), run across a pool of processes; no external tool needed
+# Both write the same photo_metadata.csv columns, read by wildnav.csv_read_drone_images(), and skip the
+# images already in the csv file, so the script can be run again when new images are added to the folder.
+# Missing values are written as NaN.
+# You might have to modify the scripts to match the EXIF metadata of your drone photos
 # Use https://www.metadata2go.com/ to easily check the metadata of your images
 ############################################################################################################
 
 csv_filename = 'photo_metadata.csv' # csv file with drone image metadata containing GNSS location
 photo_folder = '../assets/query/' # folder with drone images
- 
+
 csv_filename = photo_folder + csv_filename
 
-def convert_gnss_coord(lat_or_lon):
-    """
-    Convert GNSS coordinate to decimal degrees instead of minutes and seconds
-    """
-    deg, deg_string, minutes,discard_1,  seconds, discard_2, direction =  re.split('[\s°\'"]', lat_or_lon)
-    converted = (float(deg) + float(minutes)/60 + float(seconds)/(60*60)) * (-1 if direction in ['W', 'S'] else 1)
-    return str(converted)
+CSV_HEADER = "Filename,Latitude,Longitude,Altitude,Gimball_Roll,Gimball_Yaw,Gimball_Pitch,Flight_Roll,Flight_Yaw,Flight_Pitch"
+FIELDS = ['latitude', 'longitude', 'altitude', 'gimbal_roll', 'gimbal_yaw', 'gimbal_pitch',
+          'flight_roll', 'flight_yaw', 'flight_pitch']
+# DJI XMP tags (drone-dji namespace) of the metadata fields
+XMP_TAGS = {'RelativeAltitude': 'altitude', 'GimbalRollDegree': 'gimbal_roll', 'GimbalYawDegree': 'gimbal_yaw',
+            'GimbalPitchDegree': 'gimbal_pitch', 'FlightRollDegree': 'flight_roll', 'FlightYawDegree': 'flight_yaw',
+            'FlightPitchDegree': 'flight_pitch'}
+EXIFTOOL_BATCH = 100 # images per exiftool command
+
 
 def load_images_from_folder(folder):
     images_list = []
@@ -33,66 +49,202 @@ def load_images_from_folder(folder):
     images_list.sort()
     return images_list
 
-images_list = load_images_from_folder(photo_folder)
-
-f = open(csv_filename, "a")
-
-filesize = os.path.getsize(csv_filename)
-if filesize == 0:
-    f.write("Filename,Latitude,Longitude,Altitude,Gimball_Roll,Gimball_Yaw,Gimball_Pitch,Flight_Roll,Flight_Yaw,Flight_Pitch")
-
-print("Reading metadata. Please wait...")
-for image in images_list:
-    infoDict = {} #Creating the dict to get the metadata tags
-    exifToolPath = 'exiftool'
-    imgPath = photo_folder + image
-    process = subprocess.Popen([exifToolPath,imgPath],stdout=subprocess.PIPE, stderr=subprocess.STDOUT,universal_newlines=True) 
-    #get the tags in dict 
-    for tag in process.stdout:
-        line = tag.strip().split(':')
-        infoDict[line[0].strip()] = line[-1].strip()
-
-    #Default values
-    altitude = "NaN"
-    gimball_roll = "NaN"
-    gimball_yaw = "NaN"
-    gimball_pitch = "NaN"
-    flight_roll = "NaN"
-    flight_yaw = "NaN"
-    flight_pitch = "NaN"
-
-    if 'File Name' in infoDict:
-        filename = infoDict['File Name']
-    if 'GPS Latitude' in infoDict:
-        lat = infoDict['GPS Latitude']
-    if 'GPS Longitude' in infoDict:
-        lon = infoDict['GPS Longitude']
-    if 'Relative Altitude' in infoDict:
-        altitude = infoDict['Relative Altitude']
-    elif 'GPS Altitude' in infoDict:
-        altitude = infoDict['GPS Altitude']
-        altitude =  re.search(r'\d+', altitude).group() #keep only the number value, discard text
-
-    if 'Gimbal Roll Degree' in infoDict:
-        gimball_roll = infoDict['Gimbal Roll Degree']
-    if 'Gimbal Yaw Degree' in infoDict:
-        gimball_yaw = infoDict['Gimbal Yaw Degree']
-    if 'Gimbal Pitch Degree' in infoDict:
-        gimball_pitch = infoDict['Gimbal Pitch Degree']
-    if 'Flight Roll Degree' in infoDict:
-        flight_roll = infoDict['Flight Roll Degree']
-    if 'Flight Yaw Degree' in infoDict:
-        flight_yaw = infoDict['Flight Yaw Degree']
-    if 'Flight Pitch Degree' in infoDict:    
-        flight_pitch = infoDict['Flight Pitch Degree']
-
-    lat = convert_gnss_coord(lat)
-    lon = convert_gnss_coord(lon)
-
-    f.write('\n' + filename + ',' + lat + ',' + lon + ',' + altitude + ',' + gimball_roll + ',' + gimball_yaw + ',' + gimball_pitch + ',' + flight_roll + ','  + flight_yaw + ','+ flight_pitch)
-
-print("Done reading metadata. Metadata saved to " + csv_filename)
-
-f.close()
+
+def read_known_images(filename):
+    """Filenames already in the metadata csv file"""
+    if not os.path.isfile(filename):
+        return set()
+    with open(filename, newline='') as csv_file:
+        return {row[0] for index, row in enumerate(csv.reader(csv_file)) if index > 0 and row}
+
+
+def write_rows(filename, records):
+    """Appends the metadata of the images to the csv file, writing the header if the file is new"""
+    with open(filename, "a") as f:
+        if f.tell() == 0:
+            f.write(CSV_HEADER)
+        for record in records:
+            values = ["NaN" if math.isnan(record[field]) else str(record[field]) for field in FIELDS]
+            f.write('\n' + record['filename'] + ',' + ','.join(values))
 
 
+def _number(value):
+    """Float of an exiftool or XMP value ("+119.98", 120.5), NaN if it is missing or not a number"""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return math.nan
+
+
+############################################################################################################
+# exiftool backend
+############################################################################################################
+class ExifToolSession:
+    """A single exiftool process reading the metadata of many images, one batch of images per command"""
+    def __init__(self, executable='exiftool'):
+        self.process = subprocess.Popen([executable, '-stay_open', 'True', '-@', '-'], stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True)
+
+    def read(self, paths):
+        """Metadata records of the images, in the same order"""
+        # -n: numbers instead of formatted text (decimal degrees, plain altitude)
+        arguments = ['-json', '-n', '-FileName', '-GPSLatitude', '-GPSLatitudeRef', '-GPSLongitude', '-GPSLongitudeRef',
+                     '-GPSAltitude', '-GPSAltitudeRef'] + ['-' + tag for tag in XMP_TAGS] + list(paths) + ['-execute']
+        self.process.stdin.write('\n'.join(arguments) + '\n')
+        self.process.stdin.flush()
+        output = []
+        for line in self.process.stdout:
+            if line.strip() == '{ready}':
+                break
+            output.append(line)
+        tags_list = json.loads(''.join(output)) if ''.join(output).strip() else []
+        by_file = {os.path.basename(tags.get('SourceFile', '')): tags for tags in tags_list}
+        return [self.record(by_file.get(os.path.basename(path), {}), os.path.basename(path)) for path in paths]
+
+    @staticmethod
+    def record(tags, filename):
+        record = {'filename': filename}
+        for field, ref, negative in (('latitude', 'GPSLatitudeRef', 'S'), ('longitude', 'GPSLongitudeRef', 'W')):
+            value = abs(_number(tags.get('GPS' + field.capitalize())))
+            record[field] = -value if str(tags.get(ref, '')).upper().startswith(negative) else value
+        for tag, field in XMP_TAGS.items():
+            record[field] = _number(tags.get(tag))
+        if math.isnan(record['altitude']):
+            # altitude above sea level if there is no altitude relative to the take off point
+            record['altitude'] = _number(tags.get('GPSAltitude')) * (-1 if str(tags.get('GPSAltitudeRef')) == '1' else 1)
+        return record
+
+    def close(self):
+        self.process.stdin.write('-stay_open\nFalse\n')
+        self.process.stdin.flush()
+        self.process.wait()
+
+
+def extract_exiftool(paths, executable='exiftool'):
+    """Metadata records of the images, read by a single exiftool process"""
+    session = ExifToolSession(executable)
+    records = []
+    try:
+        for start in range(0, len(paths), EXIFTOOL_BATCH):
+            records.extend(session.read(paths[start:start + EXIFTOOL_BATCH]))
+            print("Read metadata of %d of %d images" % (len(records), len(paths)))
+    finally:
+        session.close()
+    return records
+
+
+############################################################################################################
+# Pure python backend
+############################################################################################################
+_TIFF_TYPES = {1: ('B', 1), 2: ('s', 1), 3: ('H', 2), 4: ('I', 4), 5: ('II', 8), 7: ('B', 1),
+               9: ('i', 4), 10: ('ii', 8)} # type: (struct format of one value, size)
+
+
+def _read_ifd(tiff, offset, endian):
+    """Tags of a TIFF image file directory as {tag: values}"""
+    tags = {}
+    count, = struct.unpack_from(endian + 'H', tiff, offset)
+    for index in range(count):
+        tag, kind, number, value_offset = struct.unpack_from(endian + 'HHI4s', tiff, offset + 2 + 12 * index)
+        if kind not in _TIFF_TYPES:
+            continue
+        fmt, size = _TIFF_TYPES[kind]
+        data = value_offset if size * number <= 4 else \
+            tiff[struct.unpack(endian + 'I', value_offset)[0]:][:size * number]
+        if kind == 2:
+            tags[tag] = data[:number].split(b'\0')[0].decode('ascii', 'replace')
+        elif kind in (5, 10):
+            values = struct.unpack(endian + fmt[0] * 2 * number, data[:size * number])
+            tags[tag] = [n / d if d else math.nan for n, d in zip(values[0::2], values[1::2])]
+        else:
+            tags[tag] = list(struct.unpack(endian + fmt * number, data[:size * number]))
+    return tags
+
+
+def _parse_exif_gps(exif):
+    """GPS tags of an EXIF block (after the Exif header) as {tag: values}, empty if there are none"""
+    endian = '<' if exif[:2] == b'II' else '>'
+    ifd0 = _read_ifd(exif, struct.unpack_from(endian + 'I', exif, 4)[0], endian)
+    if 0x8825 not in ifd0: # GPS IFD pointer
+        return {}
+    return _read_ifd(exif, ifd0[0x8825][0], endian)
+
+
+def read_jpeg_metadata(path):
+    """
+    Metadata record of a JPEG image from its EXIF GPS tags and DJI XMP tags. Only the segments before
+    the image data are read.
+    """
+    exif, xmp = None, b''
+    with open(path, 'rb') as file:
+        if file.read(2) == b'\xff\xd8':
+            while True:
+                marker = file.read(2)
+                if len(marker) < 2 or marker[0] != 0xFF or marker[1] == 0xDA: # start of scan, no more metadata
+                    break
+                length, = struct.unpack('>H', file.read(2))
+                segment = file.read(length - 2)
+                if marker[1] == 0xE1 and segment.startswith(b'Exif\0\0'):
+                    exif = segment[6:]
+                elif marker[1] == 0xE1 and segment.startswith(b'http://ns.adobe.com/xap/1.0/\0'):
+                    xmp += segment
+
+    record = {'filename': os.path.basename(path)}
+    gps = {}
+    if exif is not None:
+        try:
+            gps = _parse_exif_gps(exif)
+        except struct.error:
+            print("Corrupt EXIF data in " + path)
+    for field, tag, ref, negative in (('latitude', 2, 1, 'S'), ('longitude', 4, 3, 'W')):
+        if tag in gps and len(gps[tag]) == 3:
+            degrees, minutes, seconds = gps[tag]
+            value = degrees + minutes / 60 + seconds / 3600
+            record[field] = -value if gps.get(ref, '').upper().startswith(negative) else value
+        else:
+            record[field] = math.nan
+
+    xmp = xmp.decode('utf-8', 'replace')
+    for tag, field in XMP_TAGS.items():
+        # attribute (drone-dji:Tag="+1.00") or element (<drone-dji:Tag>+1.00</drone-dji:Tag>) form
+        match = re.search(r'drone-dji:%s\s*=\s*"([^"]*)"|<drone-dji:%s>([^<]*)<' % (tag, tag), xmp)
+        record[field] = _number(match.group(1) if match.group(1) is not None else match.group(2)) if match else math.nan
+    if math.isnan(record['altitude']) and 6 in gps:
+        record['altitude'] = gps[6][0] * (-1 if gps.get(5, [0])[0] == 1 else 1)
+    return record
+
+
+def extract_python(paths, workers=None):
+    """Metadata records of the images, read by a pool of processes"""
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(read_jpeg_metadata, paths, chunksize=max(1, len(paths) // (4 * (workers or os.cpu_count() or 1)))))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Extracts the GNSS position and the camera angles of the drone images to a csv file")
+    parser.add_argument('--folder', default=photo_folder, help="folder with the drone images")
+    parser.add_argument('--csv', default=None, help="metadata csv file (default: photo_metadata.csv in the folder)")
+    parser.add_argument('--backend', choices=['auto', 'exiftool', 'python'], default='auto',
+                        help="exiftool or the pure python reader (JPEG only); auto uses exiftool if it is installed")
+    parser.add_argument('--workers', type=int, default=None, help="processes of the python backend (default: all cores)")
+    args = parser.parse_args()
+
+    folder = os.path.join(args.folder, "")
+    metadata_filename = args.csv or folder + os.path.basename(csv_filename)
+    backend = args.backend
+    if backend == 'auto':
+        backend = 'exiftool' if shutil.which('exiftool') else 'python'
+
+    known = read_known_images(metadata_filename)
+    images_list = [image for image in load_images_from_folder(folder) if image not in known]
+    print("%d images are already in %s, reading the metadata of %d with %s" % (len(known), metadata_filename, len(images_list), backend))
+
+    print("Reading metadata. Please wait...")
+    paths = [folder + image for image in images_list]
+    records = extract_exiftool(paths) if backend == 'exiftool' else extract_python(paths, args.workers)
+    for record in records:
+        if math.isnan(record['latitude']) or math.isnan(record['longitude']):
+            print("No GNSS position in " + record['filename'])
+    write_rows(metadata_filename, records)
+
+    print("Done reading metadata. Metadata saved to " + metadata_filename)
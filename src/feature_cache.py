@@ -0,0 +1,178 @@
+"""On-disk cache of the SuperPoint features (keypoints, scores, descriptors) of the satellite map tiles"""
+import csv
+import hashlib
+import json
+import os
+
+import numpy as np
+import torch
+
+############################################################################################################
+# The satellite map index is made of map.csv (geographical bounds of every tile) and the features folder
+# next to it, which holds one .npz file per tile and feature extraction config:
+#   features/<tile name>.<config digest>.npz
+# Every file stores the cache key it was built with (tile content hash + SuperPoint config), so a tile
+# that was replaced or re-downloaded is detected as stale and its features are extracted again.
+############################################################################################################
+
+CACHE_VERSION = 1
+FEATURES_DIR = "features"
+
+
+class TileFeatures:
+    """SuperPoint keypoints, scores and descriptors of one satellite map tile,
+    extracted from the tile resized to shape (height, width).
+    The resized grayscale tile image is optional, it is only needed for drawing the matches.
+    cache_key identifies the tile content and extraction config, None if the features were not cached.
+    """
+    def __init__(self, filename, keypoints, scores, descriptors, shape, image=None, cache_key=None):
+        self.filename = filename
+        self.keypoints = keypoints # (N, 2) x, y pixel coordinates in the resized tile
+        self.scores = scores # (N,)
+        self.descriptors = descriptors # (256, N)
+        self.shape = tuple(int(x) for x in shape)
+        self.image = image
+        self.cache_key = cache_key
+        self.reader = None # function returning the resized grayscale tile image, for tiles that are not files
+
+    def to_data(self, device, suffix='1'):
+        """Returns the features in the input format of superglue Matching, with the given image suffix.
+        Superglue only needs the image shape to normalize the keypoints, so the image is a zero-copy placeholder.
+        """
+        height, width = self.shape
+        return {
+            'keypoints' + suffix: [torch.from_numpy(self.keypoints).to(device)],
+            'scores' + suffix: (torch.from_numpy(self.scores).to(device),),
+            'descriptors' + suffix: [torch.from_numpy(self.descriptors).to(device)],
+            'image' + suffix: torch.zeros((1, 1, 1, 1), device=device).expand(1, 1, height, width),
+        }
+
+    def strongest(self, max_keypoints):
+        """Features with only the max_keypoints keypoints with the highest scores, in their order; self if there are not more"""
+        if max_keypoints < 0 or len(self.keypoints) <= max_keypoints:
+            return self
+        keep = np.sort(np.argpartition(-self.scores, max_keypoints)[:max_keypoints])
+        tile = TileFeatures(self.filename, self.keypoints[keep], self.scores[keep], self.descriptors[:, keep],
+                            self.shape, self.image, self.cache_key)
+        tile.reader = self.reader
+        return tile
+
+    def __str__(self):
+        return "%s; %d keypoints, shape: %s" % (self.filename, len(self.keypoints), self.shape)
+
+
+def file_hash(filename):
+    """Content hash of a file"""
+    sha = hashlib.sha1()
+    with open(filename, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def feature_config(localizer):
+    """Parameters of the localizer that change the extracted tile features"""
+    superpoint_config = localizer.matching.superpoint.config
+    config = {
+        'version': CACHE_VERSION,
+        'resize': list(localizer.resize),
+        'nms_radius': superpoint_config['nms_radius'],
+        'keypoint_threshold': superpoint_config['keypoint_threshold'],
+        'max_keypoints': superpoint_config['max_keypoints'],
+    }
+    if localizer.precision == 'static':
+        # int8 superpoint gives slightly different features, fp32 caches stay valid
+        config['precision'] = 'static'
+    return config
+
+
+def cache_filename(tile_filename, config, cache_dir=None):
+    """Path of the cache file of a tile for the given feature config"""
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(tile_filename), FEATURES_DIR)
+    digest = hashlib.sha1(json.dumps(config, sort_keys=True).encode()).hexdigest()[:12]
+    name = os.path.splitext(os.path.basename(tile_filename))[0]
+    return os.path.join(cache_dir, name + "." + digest + ".npz")
+
+
+def read_cache(path, key):
+    """Reads a cache file, returns None if it does not exist, is unreadable or was built with another key"""
+    if not os.path.isfile(path):
+        return None
+    try:
+        with np.load(path) as data:
+            if json.loads(str(data['key'])) != key:
+                return None
+            return data['keypoints'], data['scores'], data['descriptors'], data['shape']
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def write_cache(path, key, keypoints, scores, descriptors, shape):
+    """Writes a cache file atomically, so that concurrent runs never read a half written file"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp_path, 'wb') as file:
+        np.savez(file, key=json.dumps(key), keypoints=keypoints, scores=scores,
+                 descriptors=descriptors, shape=np.asarray(shape))
+    os.replace(tmp_path, path)
+
+
+def load_tile_features(localizer, tile_filename, cache_dir=None, keep_image=False):
+    """Loads the features of a tile from the cache, extracting and caching them if missing or stale.
+    Returns the features and True if they were read from the cache.
+    If keep_image is set, the resized grayscale tile image is kept in memory together with the features.
+    """
+    config = feature_config(localizer)
+    key = {**config, 'content_hash': file_hash(tile_filename)}
+    path = cache_filename(tile_filename, config, cache_dir)
+    cached = read_cache(path, key)
+    if cached is not None:
+        image = localizer.read_image(tile_filename) if keep_image else None
+        return TileFeatures(tile_filename, *cached, image=image, cache_key=key), True
+
+    frame = localizer.read_image(tile_filename)
+    keypoints, scores, descriptors = localizer.extract_features(frame)
+    write_cache(path, key, keypoints, scores, descriptors, frame.shape)
+    return TileFeatures(tile_filename, keypoints, scores, descriptors, frame.shape,
+                        image=frame if keep_image else None, cache_key=key), False
+
+
+def load_map_features(localizer, tile_filenames, cache_dir=None, keep_images=False):
+    """Loads the features of all the map tiles.
+    Tiles missing on disk or that cannot be read are skipped: returns the features of the loaded tiles and their
+    indices in tile_filenames, so that the callers can keep their own tile lists aligned with the features.
+    """
+    tiles = []
+    loaded = []
+    extracted = 0
+    for index, tile_filename in enumerate(tile_filenames):
+        if not os.path.isfile(tile_filename):
+            print("Map tile not found, skipping: " + tile_filename)
+            continue
+        try:
+            tile, from_cache = load_tile_features(localizer, tile_filename, cache_dir, keep_images)
+        except IOError:
+            print("Could not read map tile, skipping: " + tile_filename)
+            continue
+        if not from_cache:
+            extracted += 1
+        tiles.append(tile)
+        loaded.append(index)
+    print("Loaded features of %d map tiles, %d were (re)extracted" % (len(tiles), extracted))
+    return tiles, loaded
+
+
+def read_map_filenames(map_filename):
+    """Reads the tile filenames listed in map.csv, relative to the map folder"""
+    map_path = os.path.dirname(map_filename)
+    with open(map_filename) as csv_file:
+        csv_reader = csv.reader(csv_file, delimiter=',')
+        next(csv_reader)
+        return sorted(os.path.join(map_path, row[0].strip()) for row in csv_reader if row)
+
+
+if __name__ == "__main__":
+    # Precompute the features of the map so that the first localization run does not pay for it
+    import superglue_utils
+    load_map_features(superglue_utils.Localizer(), read_map_filenames("../assets/map/map.csv"))
@@ -0,0 +1,174 @@
+"""Structured instrumentation of the localization pipeline: stage durations and per query / per tile metrics"""
+import json
+import os
+import threading
+import time
+
+############################################################################################################
+# The pipeline reports what it does through three calls:
+#   with span('superglue', tile=3): ...    duration of a stage
+#   value('matches', 120)                  a measurement (keypoints, matches, inliers, ...)
+#   count('located')                       a counter
+# Spans nest: the fields of the enclosing spans (e.g. query=<drone image name>, tile=<index>) are added
+# to everything reported inside them. Nothing is recorded until configure() is called; until then span()
+# returns a shared no-op context manager and value() / count() return right away, so the instrumentation
+# costs next to nothing when it is disabled.
+# The spans nest per thread, so concurrent requests (see service.py) each get their own context.
+# Output formats:
+#   jsonl        one json object per span / value / counter, written as they happen
+#   prometheus   text exposition format with totals per stage and metric (no per query labels), rewritten
+#                after every top level span, e.g. for the node exporter textfile collector
+############################################################################################################
+
+FORMATS = ['jsonl', 'prometheus']
+PREFIX = "wildnav_"
+
+_recorder = None
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    def __init__(self, recorder, name, fields):
+        self.recorder = recorder
+        self.name = name
+        self.fields = fields
+
+    def __enter__(self):
+        self.recorder.stack.append({**self.recorder.context(), **self.fields})
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        duration = time.perf_counter() - self.start
+        fields = self.recorder.stack.pop()
+        self.recorder.span(self.name, duration, fields)
+        if not self.recorder.stack:
+            self.recorder.flush()
+        return False
+
+
+class Recorder:
+    """Writes the spans, values and counters to a file in one of the FORMATS"""
+    def __init__(self, filename, format='jsonl'):
+        if format not in FORMATS:
+            raise ValueError("Unknown instrumentation format %s, use one of %s" % (format, FORMATS))
+        self.filename = filename
+        self.format = format
+        self.local = threading.local() # stack of the open spans of every thread
+        self.lock = threading.Lock() # the file and the totals are shared by the threads
+        self.totals = {} # (kind, name) -> [sum, count]
+        self.file = open(filename, 'a', buffering=1) if format == 'jsonl' else None
+
+    @property
+    def stack(self):
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    def context(self):
+        return self.stack[-1] if self.stack else {}
+
+    def _emit(self, record):
+        # numpy scalars (counts, indices) are written as plain numbers
+        line = json.dumps(record, default=lambda o: o.item() if hasattr(o, 'item') else str(o)) + "\n"
+        with self.lock:
+            self.file.write(line)
+
+    def _add(self, kind, name, amount):
+        with self.lock:
+            total = self.totals.setdefault((kind, name), [0.0, 0])
+            total[0] += amount
+            total[1] += 1
+
+    def span(self, name, duration, fields):
+        if self.file is not None:
+            self._emit({'type': 'span', 'name': name, 'duration_s': duration, 'time': time.time(), **fields})
+        self._add('span', name, duration)
+
+    def value(self, name, amount, fields):
+        if self.file is not None:
+            self._emit({'type': 'value', 'name': name, 'value': amount, **self.context(), **fields})
+        self._add('value', name, amount)
+
+    def count(self, name, amount, fields):
+        if self.file is not None:
+            self._emit({'type': 'counter', 'name': name, 'value': amount, **self.context(), **fields})
+        self._add('counter', name, amount)
+
+    def prometheus_text(self):
+        """Totals in the Prometheus text exposition format"""
+        with self.lock:
+            totals = {key: list(total) for key, total in self.totals.items()}
+        lines = []
+        stages = sorted(name for kind, name in totals if kind == 'span')
+        if stages:
+            lines.append("# TYPE %sstage_seconds summary" % PREFIX)
+            for name in stages:
+                total, number = totals[('span', name)]
+                lines.append('%sstage_seconds_sum{stage="%s"} %.6f' % (PREFIX, name, total))
+                lines.append('%sstage_seconds_count{stage="%s"} %d' % (PREFIX, name, number))
+        for (kind, name), (total, number) in sorted(totals.items()):
+            if kind == 'value':
+                lines.append("# TYPE %s%s summary" % (PREFIX, name))
+                lines.append("%s%s_sum %g" % (PREFIX, name, total))
+                lines.append("%s%s_count %d" % (PREFIX, name, number))
+            elif kind == 'counter':
+                lines.append("# TYPE %s%s_total counter" % (PREFIX, name))
+                lines.append("%s%s_total %g" % (PREFIX, name, total))
+        return "\n".join(lines) + "\n"
+
+    def flush(self):
+        if self.format == 'prometheus':
+            # written to a temporary file first, so a reader never sees a half written file
+            tmp_filename = "%s.%d.%d.tmp" % (self.filename, os.getpid(), threading.get_ident())
+            with open(tmp_filename, 'w') as file:
+                file.write(self.prometheus_text())
+            os.replace(tmp_filename, self.filename)
+
+    def close(self):
+        self.flush()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def configure(filename, format='jsonl'):
+    """Enables the instrumentation, writing to filename in the given format; filename None disables it"""
+    global _recorder
+    if _recorder is not None:
+        _recorder.close()
+    _recorder = Recorder(filename, format) if filename is not None else None
+    return _recorder
+
+
+def enabled():
+    return _recorder is not None
+
+
+def span(name, **fields):
+    """Context manager measuring the duration of a stage"""
+    if _recorder is None:
+        return _NULL_SPAN
+    return _Span(_recorder, name, fields)
+
+
+def value(name, amount, **fields):
+    """Records a measurement"""
+    if _recorder is not None:
+        _recorder.value(name, amount, fields)
+
+
+def count(name, amount=1, **fields):
+    """Increments a counter"""
+    if _recorder is not None:
+        _recorder.count(name, amount, fields)
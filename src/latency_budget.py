@@ -0,0 +1,180 @@
+"""Latency budget: adapts the image size, keypoint limit and Sinkhorn iterations of every frame to a deadline"""
+import collections
+import time
+
+import numpy as np
+
+import instrumentation
+
+############################################################################################################
+# The cost of localizing a drone image grows with the number of keypoints, which varies a lot between
+# textured and bland terrain. With a latency target (latency_target in wildnav.py) a LatencyController
+# picks a quality level from LADDER before every frame, so that the given percentile of the frame
+# latency stays under the target. Level 0 is the configured matching settings, every next level is
+# cheaper: a smaller query image, fewer keypoints of the query and of the map tiles, fewer Sinkhorn
+# iterations. The map tile features themselves are not extracted again: the keypoint caps are settings of
+# the Localizer (query_max_keypoints, tile_max_keypoints), the superpoint config that keys the feature cache
+# is left alone.
+# The controller predicts the latency of a level from
+#   - the average latency measured at that level (levels not used yet are extrapolated from the cost of
+#     the measured ones: query pixels and keypoints),
+#   - the keypoint density of the last frame: the same level costs more over textured terrain,
+#   - the tail factor: the given percentile of the measured / predicted latency ratio of the recent frames.
+# It picks the best level predicted to fit the target, moving up one level at a time and only when the
+# prediction is below upgrade_margin times the target, so that it does not oscillate between levels.
+# The levels are printed when the controller is created; the level of every frame is printed with its result,
+# stored in the results file and recorded by the instrumentation with the predicted latency.
+# With the torchscript backend the Sinkhorn iterations are part of the compiled superglue graph: every level
+# keeps the configured iterations, so that the printed settings and the cost of the levels are the ones run.
+############################################################################################################
+
+# steps of the quality ladder: scale of the query image size, cap of the keypoints of the query and of the
+# map tiles (None keeps the configured one) and Sinkhorn iterations (None keeps the configured ones)
+LADDER = [
+    {'resize_scale': 1.0, 'max_keypoints': None, 'sinkhorn_iterations': None},
+    {'resize_scale': 1.0, 'max_keypoints': 1024, 'sinkhorn_iterations': None},
+    {'resize_scale': 0.8, 'max_keypoints': 1024, 'sinkhorn_iterations': 15},
+    {'resize_scale': 0.8, 'max_keypoints': 512, 'sinkhorn_iterations': 10},
+    {'resize_scale': 0.6, 'max_keypoints': 512, 'sinkhorn_iterations': 10},
+    {'resize_scale': 0.6, 'max_keypoints': 256, 'sinkhorn_iterations': 5},
+]
+SMOOTHING = 0.3 # weight of the last frame in the moving averages
+
+
+def _cap(configured, cap):
+    """Keypoint limit of a level: the smaller of the configured limit (-1: none) and the cap of the level"""
+    if cap is None:
+        return configured
+    return cap if configured < 0 else min(configured, cap)
+
+
+class LatencyController:
+    """
+    Chooses the quality level of every frame so that the percentile of the frame latency stays under target seconds.
+    Call begin_frame() before localizing a frame and end_frame() after it.
+    """
+    def __init__(self, localizer, target, percentile=99, ladder=None, window=100, upgrade_margin=0.8):
+        self.localizer = localizer
+        self.target = target
+        self.percentile = percentile
+        self.upgrade_margin = upgrade_margin
+        superpoint_config = localizer.matching.superpoint.config
+        superglue_config = localizer.matching.superglue.config
+        # a compiled superglue graph (localizer.batch_scores) runs the iterations it was traced with
+        fixed_iterations = localizer.batch_scores is not None
+        self.levels = []
+        for step in (ladder or LADDER):
+            self.levels.append({
+                'resize': [max(1, int(round(size * step['resize_scale']))) if size > 0 else size for size in localizer.resize],
+                'max_keypoints': _cap(superpoint_config['max_keypoints'], step['max_keypoints']),
+                'sinkhorn_iterations': superglue_config['sinkhorn_iterations'] if fixed_iterations else
+                                       step['sinkhorn_iterations'] or superglue_config['sinkhorn_iterations'],
+                'resize_scale': step['resize_scale'],
+            })
+        for level, settings in enumerate(self.levels):
+            print("Quality level %d: resize %s, %s keypoints, %d Sinkhorn iterations" % (
+                level, settings['resize'], settings['max_keypoints'] if settings['max_keypoints'] >= 0 else "all",
+                settings['sinkhorn_iterations']))
+        self.latency = [None] * len(self.levels) # moving average of the latency of every level
+        self.keypoints = [None] * len(self.levels) # moving average of the query keypoints of every level
+        self.density = None # query keypoints per pixel of the last frame
+        self.full_pixels = None # pixels of the last query image at full size (level 0)
+        self.ratios = collections.deque(maxlen=window) # measured / predicted latency of the recent frames
+        self.latencies = collections.deque(maxlen=window)
+        self.level = 0
+        self.prediction = None
+        self.start = None
+
+    def expected_keypoints(self, level):
+        """Query keypoints expected at a level from the keypoint density of the last frame, None before the first frame"""
+        if self.density is None:
+            return None
+        settings = self.levels[level]
+        keypoints = self.density * self.full_pixels * settings['resize_scale'] ** 2
+        return keypoints if settings['max_keypoints'] < 0 else min(keypoints, settings['max_keypoints'])
+
+    def _cost(self, level):
+        """
+        Rough relative cost of a level, only used for levels that were not measured yet: superpoint grows with the
+        pixels, superglue with the query keypoints times the map tile keypoints and with the Sinkhorn iterations.
+        """
+        settings = self.levels[level]
+        tile_keypoints = settings['max_keypoints'] if settings['max_keypoints'] >= 0 else 2048
+        keypoints = self.expected_keypoints(level)
+        if keypoints is None:
+            keypoints = tile_keypoints
+        return settings['resize_scale'] ** 2 + \
+            (keypoints / 1024.0) * (tile_keypoints / 1024.0) * (0.5 + 0.5 * settings['sinkhorn_iterations'] / 20.0)
+
+    def predict(self, level):
+        """Predicted latency of the next frame at a level, without the tail factor; None before the first frame"""
+        if self.latency[level] is None:
+            measured = [index for index, latency in enumerate(self.latency) if latency is not None]
+            if not measured:
+                return None
+            # closest measured level, scaled by the relative cost of the two levels
+            reference = min(measured, key=lambda index: abs(index - level))
+            return self.predict(reference) * self._cost(level) / self._cost(reference)
+        expected = self.expected_keypoints(level)
+        if expected is None or not self.keypoints[level]:
+            return self.latency[level]
+        # about half of the latency grows with the number of keypoints
+        return self.latency[level] * (0.5 + 0.5 * expected / self.keypoints[level])
+
+    def tail(self):
+        """Percentile of the measured / predicted latency ratio of the recent frames, at least 1"""
+        if len(self.ratios) < 5:
+            return 1.0
+        return max(1.0, float(np.percentile(self.ratios, self.percentile)))
+
+    def choose_level(self):
+        """Best level predicted to fit the target"""
+        if all(latency is None for latency in self.latency):
+            return 0
+        tail = self.tail()
+        # up at most one level at a time, and only with some margin
+        for level in range(max(0, self.level - 1), len(self.levels)):
+            budget = self.target * (self.upgrade_margin if level < self.level else 1.0)
+            if self.predict(level) * tail <= budget:
+                return level
+        return len(self.levels) - 1
+
+    def apply(self, level):
+        """Sets the matching settings of a level on the localizer"""
+        settings = self.levels[level]
+        self.localizer.query_resize = settings['resize']
+        self.localizer.tile_max_keypoints = settings['max_keypoints']
+        self.localizer.query_max_keypoints = settings['max_keypoints']
+        self.localizer.matching.superglue.config['sinkhorn_iterations'] = settings['sinkhorn_iterations']
+
+    def begin_frame(self, drone_image):
+        """Picks and applies the quality level of a frame"""
+        self.level = self.choose_level()
+        self.prediction = self.predict(self.level)
+        self.apply(self.level)
+        drone_image.quality_level = self.level
+        instrumentation.value('quality_level', self.level)
+        if self.prediction is not None:
+            instrumentation.value('predicted_latency_s', self.prediction * self.tail(), quality_level=self.level)
+        self.start = time.perf_counter()
+
+    def end_frame(self):
+        """Measures the latency of the frame and the keypoint density of its query image, returns the latency"""
+        latency = time.perf_counter() - self.start
+        level = self.level
+        self.latencies.append(latency)
+        if self.prediction:
+            self.ratios.append(latency / self.prediction)
+        keypoints, pixels = self.localizer.query_keypoints, self.localizer.query_pixels
+        if pixels:
+            # the keypoint limit may have cut the keypoints, the density is then a lower bound
+            self.density = keypoints / float(pixels)
+            self.full_pixels = pixels / self.levels[level]['resize_scale'] ** 2
+        for averages, measurement in ((self.latency, latency), (self.keypoints, keypoints)):
+            averages[level] = measurement if averages[level] is None else \
+                (1 - SMOOTHING) * averages[level] + SMOOTHING * measurement
+        return latency
+
+    def percentile_latency(self):
+        """The percentile of the latency of the recent frames"""
+        return float(np.percentile(self.latencies, self.percentile)) if self.latencies else None
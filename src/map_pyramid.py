@@ -0,0 +1,162 @@
+"""Multi-resolution map pyramid: merged, downsampled super-tiles for a coarse-to-fine search of the map"""
+import csv
+import hashlib
+import json
+import os
+
+import cv2
+import numpy as np
+from PIL import Image
+
+import feature_cache
+from spatial_index import TileGrid
+
+############################################################################################################
+# Level 0 of the pyramid is the map itself (the map.csv tiles). Every coarser level k covers the map with a
+# grid of super-tiles 2^k times as large as an average tile (in degrees) and with the same number of pixels:
+# the tiles overlapping a super-tile are downsampled and pasted into it. Every level is stored like the map,
+# as images and a csv file with their geographical bounds (filenames relative to the map folder):
+#   pyramid/level_<k>/map.csv, pyramid/level_<k>/super_tile_<row>_<column>.png
+# so its superpoint features are cached in pyramid/level_<k>/features like the ones of the map tiles.
+# The pyramid is rebuilt when the map tiles change (see manifest.json).
+############################################################################################################
+
+PYRAMID_VERSION = 1
+PYRAMID_DIR = "pyramid"
+CSV_HEADER = ['Filename', 'Top_left_lat', 'Top_left_lon', 'Bottom_right_lat', 'Bottom_right_long']
+
+
+def tile_bounds(geo_photo):
+    """(min_lat, min_lon, max_lat, max_lon) of a GeoPhoto"""
+    lat_a, lon_a = geo_photo.top_left_coord
+    lat_b, lon_b = geo_photo.bottom_right_coord
+    return min(lat_a, lat_b), min(lon_a, lon_b), max(lat_a, lat_b), max(lon_a, lon_b)
+
+
+def content_hash(geo_photo):
+    """Content hash of a geo photo: of its file, or of the orthomosaic it is a window of"""
+    window = getattr(geo_photo, 'window', None)
+    if window is not None:
+        return "%s:%d:%d" % (window.orthomosaic.content_key, window.row, window.column)
+    return feature_cache.file_hash(geo_photo.filename)
+
+
+def image_size(geo_photo):
+    """(height, width) of a geo photo, from its orthomosaic window or the header of its image file, without decoding it"""
+    window = getattr(geo_photo, 'window', None)
+    if window is not None:
+        return window.height, window.width
+    with Image.open(geo_photo.filename) as image:
+        width, height = image.size
+    return height, width
+
+
+def render_super_tile(geo_photos, bounds, size):
+    """Pastes the downsampled geo photos overlapping the bounds into a (height, width) grayscale image"""
+    height, width = size
+    min_lat, min_lon, max_lat, max_lon = bounds
+    image = np.zeros((height, width), np.uint8)
+    for geo_photo in geo_photos:
+        tile_min_lat, tile_min_lon, tile_max_lat, tile_max_lon = tile_bounds(geo_photo)
+        # pixel rectangle of the tile in the super-tile, north is up
+        x0 = int(round((tile_min_lon - min_lon) / (max_lon - min_lon) * width))
+        x1 = int(round((tile_max_lon - min_lon) / (max_lon - min_lon) * width))
+        y0 = int(round((max_lat - tile_max_lat) / (max_lat - min_lat) * height))
+        y1 = int(round((max_lat - tile_min_lat) / (max_lat - min_lat) * height))
+        if x1 <= 0 or y1 <= 0 or x0 >= width or y0 >= height or x1 <= x0 or y1 <= y0:
+            continue
+        tile = cv2.resize(geo_photo.photo, (x1 - x0, y1 - y0), interpolation=cv2.INTER_AREA)
+        image[max(y0, 0):min(y1, height), max(x0, 0):min(x1, width)] = \
+            tile[max(-y0, 0):min(y1, height) - y0, max(-x0, 0):min(x1, width) - x0]
+    return image
+
+
+def build_level(geo_photos, level, map_dir, tile_grid, size):
+    """Renders the super-tiles of one pyramid level and writes them with their csv file, returns the csv filename"""
+    level_dir = os.path.join(map_dir, PYRAMID_DIR, "level_%d" % level)
+    os.makedirs(level_dir, exist_ok=True)
+    min_lat, min_lon, max_lat, max_lon = tile_grid.extent
+    cell_lat, cell_lon = tile_grid.cell_lat * 2**level, tile_grid.cell_lon * 2**level
+    rows = int(np.ceil((max_lat - min_lat) / cell_lat - 1e-9))
+    columns = int(np.ceil((max_lon - min_lon) / cell_lon - 1e-9))
+
+    csv_rows = []
+    for row in range(rows):
+        for column in range(columns):
+            bounds = (max_lat - (row + 1) * cell_lat, min_lon + column * cell_lon,
+                      max_lat - row * cell_lat, min_lon + (column + 1) * cell_lon)
+            indices = tile_grid.overlapping(bounds, (bounds[0] + bounds[2]) / 2, (bounds[1] + bounds[3]) / 2)
+            if not indices:
+                continue
+            filename = "super_tile_%02d_%02d.png" % (row, column)
+            image = render_super_tile([geo_photos[i] for i in indices], bounds, size)
+            cv2.imwrite(os.path.join(level_dir, filename), image)
+            csv_rows.append([os.path.relpath(os.path.join(level_dir, filename), map_dir), bounds[2], bounds[1], bounds[0], bounds[3]])
+
+    map_filename = os.path.join(level_dir, "map.csv")
+    with open(map_filename, 'w', newline='') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(CSV_HEADER)
+        writer.writerows(csv_rows)
+    print("Built map pyramid level %d: %d super-tiles" % (level, len(csv_rows)))
+    return map_filename
+
+
+def build_pyramid(geo_photos, map_dir, num_levels):
+    """
+    Builds the coarse levels 1..num_levels of the map pyramid of the geo photos, or reuses them if the map tiles did
+    not change; the tile images are only decoded when a level is rendered. Stops early at the first level with a single super-tile.
+    Returns the csv filenames of the levels, finest first.
+    """
+    pyramid_dir = os.path.join(map_dir, PYRAMID_DIR)
+    manifest_filename = os.path.join(pyramid_dir, "manifest.json")
+    manifest = {
+        'version': PYRAMID_VERSION,
+        'num_levels': num_levels,
+        'tiles': [[os.path.basename(geo_photo.filename), list(tile_bounds(geo_photo)), content_hash(geo_photo)]
+                  for geo_photo in geo_photos],
+    }
+    manifest['key'] = hashlib.sha1(json.dumps(manifest, sort_keys=True).encode()).hexdigest()
+
+    if os.path.isfile(manifest_filename):
+        try:
+            with open(manifest_filename) as file:
+                previous = json.load(file)
+            if previous.get('key') == manifest['key'] and \
+                    all(os.path.isfile(os.path.join(map_dir, filename)) for filename in previous['levels']):
+                return [os.path.join(map_dir, filename) for filename in previous['levels']]
+        except (OSError, ValueError, KeyError):
+            pass
+
+    tile_grid = TileGrid(geo_photos)
+    size = tuple(int(x) for x in np.median([image_size(geo_photo) for geo_photo in geo_photos], axis=0))
+    levels = []
+    for level in range(1, num_levels + 1):
+        map_filename = build_level(geo_photos, level, map_dir, tile_grid, size)
+        levels.append(os.path.relpath(map_filename, map_dir))
+        with open(map_filename) as csv_file:
+            if sum(1 for _ in csv_file) <= 2: # header + a single super-tile covering the whole map
+                break
+
+    manifest['levels'] = levels
+    tmp_filename = "%s.%d.tmp" % (manifest_filename, os.getpid())
+    with open(tmp_filename, 'w') as file:
+        json.dump(manifest, file, indent=1)
+    os.replace(tmp_filename, manifest_filename)
+    return [os.path.join(map_dir, filename) for filename in levels]
+
+
+if __name__ == "__main__":
+    # Builds the map pyramid and the features of its levels ahead of time
+    import argparse
+    import superglue_utils
+    import wildnav
+
+    parser = argparse.ArgumentParser(description="Builds the coarse levels of the map pyramid and caches their features")
+    parser.add_argument('--levels', type=int, default=max(wildnav.map_pyramid_levels, 1), help="number of coarse levels")
+    args = parser.parse_args()
+
+    geo_images_list = wildnav.csv_read_sat_map(wildnav.map_filename)
+    localizer = superglue_utils.Localizer(no_display=True)
+    for map_filename in build_pyramid(geo_images_list, os.path.dirname(wildnav.map_filename), args.levels):
+        feature_cache.load_map_features(localizer, [geo_image.filename for geo_image in wildnav.csv_read_sat_map(map_filename)])
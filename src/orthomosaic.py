@@ -0,0 +1,186 @@
+"""Single large georeferenced raster used as satellite map, read on demand in overlapping windows"""
+import collections
+import json
+import os
+
+import cv2
+import numpy as np
+
+import feature_cache
+
+############################################################################################################
+# Instead of map.csv and one image per tile, the map can be a single large raster with an affine
+# geotransform (GDAL convention, x = longitude and y = latitude):
+#   longitude = gt[0] + column * gt[1] + row * gt[2]
+#   latitude  = gt[3] + column * gt[4] + row * gt[5]
+# Supported rasters, always memory mapped so that only the windows being used are read from disk:
+#   .npy                     numpy array (height, width) or (height, width, 3 RGB)
+#   .raw / .bin              raw array, shape and dtype given in the sidecar file
+#   .tif / .tiff             uncompressed (Geo)TIFF, needs the optional tifffile package
+# The geotransform (and for raw arrays the shape and dtype) is read from a json sidecar file next to the
+# raster, <raster filename>.json: {"geotransform": [...], "shape": [...], "dtype": "uint8"}. GeoTIFF files
+# without sidecar use their ModelPixelScale / ModelTiepoint tags.
+# The map is covered by overlapping square windows that play the role of the map tiles. Their superpoint
+# features are cached like the ones of the tiles, in the features folder next to the raster.
+############################################################################################################
+
+MAX_CACHED_WINDOWS = 32 # decoded windows kept in memory (least recently used ones are dropped)
+
+
+def apply_geotransform(geotransform, column, row):
+    """Geographical (latitude, longitude) of a pixel position"""
+    gt = geotransform
+    return gt[3] + column * gt[4] + row * gt[5], gt[0] + column * gt[1] + row * gt[2]
+
+
+def invert_geotransform(geotransform):
+    """Geotransform mapping (longitude, latitude) back to (column, row)"""
+    gt = geotransform
+    det = gt[1] * gt[5] - gt[2] * gt[4]
+    if det == 0:
+        raise ValueError("Geotransform is not invertible: %s" % (gt,))
+    return [(gt[2] * gt[3] - gt[0] * gt[5]) / det, gt[5] / det, -gt[2] / det,
+            (gt[0] * gt[4] - gt[1] * gt[3]) / det, -gt[4] / det, gt[1] / det]
+
+
+def _read_sidecar(filename):
+    sidecar = filename + ".json"
+    if not os.path.isfile(sidecar):
+        return {}
+    with open(sidecar) as file:
+        return json.load(file)
+
+
+def _open_tiff(filename):
+    """Memory maps an uncompressed TIFF, returns the array and its geotransform from the GeoTIFF tags (or None)"""
+    try:
+        import tifffile
+    except ImportError:
+        raise ImportError("Reading TIFF orthomosaics needs the tifffile package: pip3 install tifffile")
+    try:
+        image = tifffile.memmap(filename, mode='r')
+    except ValueError:
+        raise ValueError("Cannot memory map %s, only uncompressed TIFF files are supported. "
+                         "Convert it to an uncompressed TIFF or a .npy file." % filename)
+    geotransform = None
+    with tifffile.TiffFile(filename) as tiff:
+        tags = tiff.pages[0].tags
+        if 33550 in tags and 33922 in tags: # ModelPixelScaleTag, ModelTiepointTag
+            scale_x, scale_y = tags[33550].value[:2]
+            column, row, _, lon, lat = tags[33922].value[:5]
+            geotransform = [lon - column * scale_x, scale_x, 0.0, lat + row * scale_y, 0.0, -scale_y]
+    return image, geotransform
+
+
+class Window:
+    """Square window of the orthomosaic, used as a map tile"""
+    def __init__(self, orthomosaic, row, column, height, width):
+        self.orthomosaic = orthomosaic
+        self.row = row
+        self.column = column
+        self.height = height
+        self.width = width
+        # geotransform of the window pixels
+        gt = orthomosaic.geotransform
+        lat, lon = apply_geotransform(gt, column, row)
+        self.geotransform = [lon, gt[1], gt[2], lat, gt[4], gt[5]]
+        self.top_left_coord = apply_geotransform(gt, column, row)
+        self.bottom_right_coord = apply_geotransform(gt, column + width, row + height)
+        stem = os.path.splitext(os.path.basename(orthomosaic.filename))[0]
+        # virtual filename, used to name the cache file of the window features
+        self.filename = os.path.join(os.path.dirname(orthomosaic.filename), "%s_window_%06d_%06d" % (stem, row, column))
+
+    def read(self):
+        """Grayscale window image (uint8)"""
+        return self.orthomosaic.read_window(self.row, self.column, self.height, self.width)
+
+
+class Orthomosaic:
+    """Memory mapped georeferenced raster with a bounded cache of decoded windows"""
+    def __init__(self, filename, max_cached_windows=MAX_CACHED_WINDOWS):
+        self.filename = filename
+        sidecar = _read_sidecar(filename)
+        extension = os.path.splitext(filename)[1].lower()
+        geotransform = None
+        if extension == ".npy":
+            self.image = np.load(filename, mmap_mode='r')
+        elif extension in (".tif", ".tiff"):
+            self.image, geotransform = _open_tiff(filename)
+        elif extension in (".raw", ".bin"):
+            if 'shape' not in sidecar:
+                raise ValueError("Raw orthomosaic %s needs its shape and dtype in %s.json" % (filename, filename))
+            self.image = np.memmap(filename, dtype=sidecar.get('dtype', 'uint8'), mode='r', shape=tuple(sidecar['shape']))
+        else:
+            raise ValueError("Unsupported orthomosaic format: " + filename)
+
+        self.geotransform = [float(x) for x in sidecar.get('geotransform', geotransform or [])]
+        if len(self.geotransform) != 6:
+            raise ValueError("No geotransform found for %s, add it to %s.json" % (filename, filename))
+        self.height, self.width = self.image.shape[:2]
+        self.max_cached_windows = max_cached_windows
+        self.cache = collections.OrderedDict()
+        # identifies the raster content without reading it, used as cache key of the window features
+        stat = os.stat(filename)
+        self.content_key = "%d:%d:%s" % (stat.st_size, stat.st_mtime_ns, self.geotransform)
+
+    def geo_to_pixel(self, latitude, longitude):
+        """(column, row) of a geographical position"""
+        inverse = invert_geotransform(self.geotransform)
+        row, column = apply_geotransform(inverse, longitude, latitude)
+        return column, row
+
+    def windows(self, size, overlap=0.25):
+        """Square windows of size pixels covering the raster, overlapping by the given fraction of their size"""
+        step = max(1, int(size * (1 - overlap)))
+        def starts(length):
+            positions = list(range(0, max(length - size, 0) + 1, step))
+            if positions[-1] + size < length:
+                positions.append(length - size) # last window flush with the border
+            return positions
+        return [Window(self, row, column, min(size, self.height - row), min(size, self.width - column))
+                for row in starts(self.height) for column in starts(self.width)]
+
+    def read_window(self, row, column, height, width):
+        """Decoded grayscale window, from the cache if it was read recently"""
+        key = (row, column, height, width)
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+        window = np.asarray(self.image[row:row + height, column:column + width])
+        if window.dtype == np.uint16:
+            window = (window // 257).astype(np.uint8)
+        elif window.dtype != np.uint8:
+            window = np.clip(window, 0, 255).astype(np.uint8)
+        if window.ndim == 3:
+            window = cv2.cvtColor(np.ascontiguousarray(window[:, :, :3]), cv2.COLOR_RGB2GRAY)
+        window = np.array(window) # own copy, never a view of the memory map
+        window.setflags(write=False) # shared by every user of the cache
+        self.cache[key] = window
+        if len(self.cache) > self.max_cached_windows:
+            self.cache.popitem(last=False)
+        return window
+
+
+def load_window_features(localizer, windows, cache_dir=None):
+    """
+    Loads the superpoint features of the orthomosaic windows from the feature cache, extracting them if
+    missing or stale. The window images are not kept in memory, the tiles read them again when drawing.
+    """
+    config = feature_cache.feature_config(localizer)
+    tiles = []
+    extracted = 0
+    for window in windows:
+        key = {**config, 'content_hash': window.orthomosaic.content_key,
+               'window': [window.row, window.column, window.height, window.width]}
+        path = feature_cache.cache_filename(window.filename, config, cache_dir)
+        cached = feature_cache.read_cache(path, key)
+        if cached is None:
+            frame = localizer.prepare_query(window.read())
+            cached = localizer.extract_features(frame) + (frame.shape,)
+            feature_cache.write_cache(path, key, *cached)
+            extracted += 1
+        tile = feature_cache.TileFeatures(window.filename, *cached, cache_key=key)
+        tile.reader = lambda window=window: localizer.prepare_query(window.read())
+        tiles.append(tile)
+    print("Loaded features of %d orthomosaic windows, %d were (re)extracted" % (len(tiles), extracted))
+    return tiles
@@ -0,0 +1,107 @@
+"""Parallel localization of drone images across a pool of worker processes"""
+import argparse
+import multiprocessing
+import os
+import time
+
+import torch
+
+import wildnav
+
+############################################################################################################
+# Every worker process loads the feature matching model and the satellite map (features, spatial and
+# global index) once when it starts, and limits torch to its own share of the CPU cores, so that the
+# workers do not compete for the same cores. The drone images are handed out one at a time and the
+# results are returned in input order.
+############################################################################################################
+
+_worker = None # (localizer, satellite map, tracker, latency controller) of the current worker process
+
+
+def _init_worker(threads):
+    """Initializer of the worker processes"""
+    global _worker
+    torch.set_num_threads(threads)
+    wildnav.setup_instrumentation(worker=True)
+    localizer = wildnav.create_localizer(no_display=True)
+    _worker = (localizer, wildnav.load_satellite_map(localizer), None, wildnav.create_latency_controller(localizer))
+
+
+def _localize(drone_image):
+    """
+    Localizes one drone image in a worker process, returns its wildnav.RESULT_FIELDS as a dict and the processing
+    start and end times
+    """
+    start = time.perf_counter()
+    wildnav.localize_drone_image(drone_image, *_worker)
+    end = time.perf_counter()
+    return {field: getattr(drone_image, field) for field in wildnav.RESULT_FIELDS}, start, end
+
+
+def default_threads(workers):
+    """Number of torch threads per worker that splits the CPU cores evenly between the workers"""
+    return max(1, (os.cpu_count() or 1) // workers)
+
+
+def localize_parallel(drone_images_list, workers, threads_per_worker=None, timings=None):
+    """
+    Localizes the drone images with a pool of worker processes.
+    Yields the drone images in input order, as soon as they and all the previous ones are done,
+    with their calculated coordinates set. If a timings list is given, the (start, end)
+    processing times of every image are appended to it.
+    """
+    if threads_per_worker is None:
+        threads_per_worker = default_threads(workers)
+    print("Localizing with %d worker processes, %d torch threads each" % (workers, threads_per_worker))
+
+    # spawn instead of fork, so the workers do not inherit the torch thread pools of the parent
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(workers, initializer=_init_worker, initargs=(threads_per_worker,)) as pool:
+        results = pool.imap(_localize, drone_images_list, chunksize=1)
+        for drone_image, (fields, start, end) in zip(drone_images_list, results):
+            for field, value in fields.items():
+                setattr(drone_image, field, value)
+            if timings is not None:
+                timings.append((start, end))
+            yield drone_image
+
+
+def measure_scaling(drone_images_list, worker_counts, threads_per_worker=None):
+    """
+    Localizes the same drone images with every number of workers and reports the throughput.
+    Throughput is measured from the first image started to the last image finished, so that
+    the time spent by the workers loading the model and the map is not counted.
+    """
+    rows = []
+    for workers in worker_counts:
+        timings = []
+        for _ in localize_parallel(drone_images_list, workers, threads_per_worker, timings):
+            pass
+        elapsed = max(end for _, end in timings) - min(start for start, _ in timings)
+        rows.append((workers, len(timings) / elapsed))
+
+    print("workers  images/sec  speedup  efficiency")
+    for workers, throughput in rows:
+        speedup = throughput / rows[0][1]
+        print("%7d  %10.3f  %7.2f  %10.2f" % (workers, throughput, speedup, speedup * rows[0][0] / workers))
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measures how localization throughput scales with the number of worker processes")
+    parser.add_argument('--workers', type=int, nargs='+', default=None,
+                        help="numbers of worker processes to measure (default: powers of 2 up to the number of cores)")
+    parser.add_argument('--threads', type=int, default=None,
+                        help="torch threads per worker (default: cores / workers)")
+    parser.add_argument('--repeat', type=int, default=1,
+                        help="localize every drone image this many times, to have enough work for all the workers")
+    args = parser.parse_args()
+
+    worker_counts = args.workers
+    if worker_counts is None:
+        worker_counts = [1]
+        while worker_counts[-1] * 2 <= (os.cpu_count() or 1):
+            worker_counts.append(worker_counts[-1] * 2)
+
+    drone_images = wildnav.csv_read_drone_images(wildnav.drone_photos_filename) * args.repeat
+    measure_scaling(drone_images, worker_counts, args.threads)
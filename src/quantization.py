@@ -0,0 +1,174 @@
+"""Int8 post-training quantization of the SuperPoint and SuperGlue models for CPU inference"""
+import argparse
+import json
+import os
+
+import numpy as np
+import torch
+from torch import nn
+
+############################################################################################################
+# Precisions of the feature matching models (Localizer(precision=...), inference_precision in wildnav.py):
+#   fp32      the models as they are
+#   dynamic   SuperGlue with int8 weights, the activations are quantized on the fly. SuperGlue is made of
+#             1x1 convolutions, which torch does not quantize dynamically, so they are first turned into
+#             the equivalent linear layers
+#   static    dynamic SuperGlue, and SuperPoint convolutions with int8 weights and activations. The
+#             activation ranges are calibrated once, on a few map tiles, when the model is loaded; the
+#             rest of SuperPoint (keypoint selection, descriptor sampling) stays in fp32
+# Quantized models only run on the CPU. Quantization changes the keypoints and matches a little, run
+#   python3 quantization.py
+# to compare the precisions on the map and drone images configured in wildnav.py: speedup, change of
+# the number of matches and of the calculated locations against fp32.
+############################################################################################################
+
+PRECISIONS = ['fp32', 'dynamic', 'static']
+CALIBRATION_IMAGES = 16 # map tiles used to calibrate the static quantization
+
+
+def quantized_engine():
+    """Quantized kernels of this CPU: x86 / fbgemm on Intel and AMD, qnnpack on ARM"""
+    for engine in ('x86', 'fbgemm', 'qnnpack'):
+        if engine in torch.backends.quantized.supported_engines:
+            return engine
+    raise RuntimeError("This torch build has no quantized CPU kernels")
+
+
+class PointwiseLinear(nn.Module):
+    """1x1 Conv1d on (batch, channels, points) tensors as a linear layer, so that it can be quantized dynamically"""
+    def __init__(self, conv):
+        super().__init__()
+        self.linear = nn.Linear(conv.in_channels, conv.out_channels, bias=conv.bias is not None)
+        self.linear.weight.data.copy_(conv.weight.data[:, :, 0])
+        if conv.bias is not None:
+            self.linear.bias.data.copy_(conv.bias.data)
+
+    def forward(self, x):
+        # contiguous: superglue views the projections of the attention layers as heads
+        return self.linear(x.transpose(1, 2)).transpose(1, 2).contiguous()
+
+
+def _replace_modules(module, condition, replacement):
+    """Replaces every submodule for which condition is true by replacement(submodule)"""
+    for name, child in module.named_children():
+        if condition(child):
+            setattr(module, name, replacement(child))
+        else:
+            _replace_modules(child, condition, replacement)
+
+
+def quantize_superglue_dynamic(superglue):
+    """Dynamic int8 quantization of the SuperGlue model, in place"""
+    _replace_modules(superglue, lambda module: isinstance(module, nn.Conv1d) and module.kernel_size == (1,),
+                     PointwiseLinear)
+    torch.ao.quantization.quantize_dynamic(superglue, {nn.Linear}, dtype=torch.qint8, inplace=True)
+    return superglue
+
+
+def quantize_superpoint_static(superpoint, calibration_images):
+    """
+    Static int8 quantization of the convolutions of the SuperPoint model, in place.
+    calibration_images: list of (1, 1, H, W) image tensors used to measure the range of the activations.
+    """
+    if not calibration_images:
+        raise ValueError("Static quantization needs calibration images")
+    qconfig = torch.ao.quantization.get_default_qconfig(quantized_engine())
+
+    def wrap(conv):
+        # quantizes the input, runs the int8 convolution and dequantizes the output, so that the
+        # superpoint forward pass (relu, pooling, softmax, ...) is unchanged
+        wrapper = torch.ao.quantization.QuantWrapper(conv)
+        wrapper.qconfig = qconfig
+        return wrapper
+
+    _replace_modules(superpoint, lambda module: isinstance(module, nn.Conv2d), wrap)
+    torch.ao.quantization.prepare(superpoint, inplace=True)
+    for image in calibration_images:
+        superpoint({'image': image})
+    torch.ao.quantization.convert(superpoint, inplace=True)
+    return superpoint
+
+
+def quantize_matching(matching, precision, calibration_images=None):
+    """Quantizes the superpoint and superglue models of a Matching module to the given precision, in place"""
+    if precision not in PRECISIONS:
+        raise ValueError("Unknown precision %s, use one of %s" % (precision, PRECISIONS))
+    if precision == 'fp32':
+        return matching
+    torch.backends.quantized.engine = quantized_engine()
+    if precision == 'static':
+        quantize_superpoint_static(matching.superpoint, calibration_images)
+    quantize_superglue_dynamic(matching.superglue)
+    print("Quantized the models to int8 (%s, %s engine)" % (precision, torch.backends.quantized.engine))
+    return matching
+
+
+############################################################################################################
+# Comparison of the precisions
+############################################################################################################
+def compare(reference, run):
+    """Speedup, match count drift and location drift of a benchmark run against the fp32 reference run"""
+    import evaluation
+    names = sorted(set(reference['images']) & set(run['images']))
+    matches = np.array([(reference['images'][name]['matches'], run['images'][name]['matches']) for name in names],
+                       dtype=float).reshape(-1, 2)
+    both_matched = [name for name in names if reference['images'][name]['matched'] and run['images'][name]['matched']]
+    positions = np.array([[reference['images'][name]['latitude_calculated'], reference['images'][name]['longitude_calculated'],
+                           run['images'][name]['latitude_calculated'], run['images'][name]['longitude_calculated']]
+                          for name in both_matched], dtype=float).reshape(-1, 4)
+    location_drift = evaluation.haversine_m(*positions.T)
+    both = (matches > 0).all(axis=1)
+    relative = (matches[both, 1] - matches[both, 0]) / matches[both, 0]
+    return {
+        'speedup': reference['latency_s']['mean'] / run['latency_s']['mean'],
+        'matched_changed': sum(1 for name in names if reference['images'][name]['matched'] != run['images'][name]['matched']),
+        'match_count_drift': {'mean_relative': float(relative.mean()) if both.any() else None,
+                              'mean_abs_relative': float(np.abs(relative).mean()) if both.any() else None},
+        'location_drift_m': {'mean': float(location_drift.mean()) if len(location_drift) else None,
+                             'max': float(location_drift.max()) if len(location_drift) else None},
+    }
+
+
+if __name__ == "__main__":
+    import benchmark
+    import wildnav
+
+    parser = argparse.ArgumentParser(description="Compares the quantized precisions of the models with fp32: speed, matches and locations")
+    parser.add_argument('--precision', nargs='+', choices=PRECISIONS[1:], default=PRECISIONS[1:], help="precisions to compare with fp32")
+    parser.add_argument('--map', default=wildnav.map_filename, help="csv file of the map")
+    parser.add_argument('--query', default=wildnav.drone_photos_filename, help="csv file with the drone images metadata")
+    parser.add_argument('--threads', type=int, default=None, help="torch threads (default: all cores)")
+    parser.add_argument('--warmup', type=int, default=1, help="drone images localized before measuring")
+    parser.add_argument('--output', default="../results/quantization.json", help="json file with the comparison")
+    args = parser.parse_args()
+
+    # every precision runs in its own worker process (see benchmark.py), on the CPU, fp32 included
+    os.environ['CUDA_VISIBLE_DEVICES'] = ''
+    settings = {'drone_photos_filename': args.query, 'save_located_images': False, 'trace_matches': False}
+    runs = {}
+    for precision in ['fp32'] + args.precision:
+        print("Localizing the drone images with %s models" % precision)
+        runs[precision] = benchmark.run_benchmark([args.map], {**settings, 'inference_precision': precision},
+                                                  args.threads, args.warmup)[0]
+
+    results = {'settings': settings, 'runs': runs,
+               'comparison': {precision: compare(runs['fp32'], runs[precision]) for precision in args.precision}}
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, 'w') as file:
+        json.dump(benchmark._rounded(results), file, indent=1, sort_keys=True)
+        file.write("\n")
+
+    def number(value, format):
+        return format % value if value is not None else "-"
+
+    print("%-8s %9s %8s %8s %15s %19s" % ("", "mean [s]", "speedup", "matched", "matches drift", "max location drift"))
+    for precision, run in runs.items():
+        comparison = results['comparison'].get(precision, {'speedup': None, 'match_count_drift': {'mean_abs_relative': None},
+                                                            'location_drift_m': {'max': None}})
+        drift = comparison['match_count_drift']['mean_abs_relative']
+        print("%-8s %9.3f %8s %8s %15s %19s" % (
+            precision, run['latency_s']['mean'], number(comparison['speedup'], "%.2fx"),
+            "%d/%d" % (run['accuracy']['matched_images'], run['accuracy']['total_images']),
+            number(drift if drift is None else 100 * drift, "%.1f %%"),
+            number(comparison['location_drift_m']['max'], "%.2f m")))
+    print("Results written to " + args.output)
@@ -0,0 +1,300 @@
+"""Results store: calculated coordinates of the drone images, written in batches as csv, npz or parquet"""
+import csv
+import json
+import math
+import os
+import time
+import zipfile
+
+import numpy as np
+
+import evaluation
+import instrumentation
+import rotation
+
+############################################################################################################
+# One row per drone image with the columns of COLUMNS. The file stays open while the drone images are
+# localized and the rows are written in batches of buffer_size, instead of opening the file for every row.
+# Formats, chosen by the filename extension:
+#   .csv       a header and the rows, appended to the file batch by batch
+#   .npz       every flush appends one numpy array per column (<column>.<chunk number>) to the file, the
+#              readers join the chunks
+#   .parquet   one row group per batch, needs the optional pyarrow package
+# In every format the file is written from scratch at the start of a run (it is replaced, not appended to),
+# so that its metadata describes all of its rows; a run without results still writes the file, without rows.
+# Every results file has a run metadata header (config, map version, start / end time of the run): in the
+# file itself for npz and parquet, in a <filename>.meta.json sidecar for csv so that the csv stays a plain
+# table (and for parquet, whose schema metadata cannot be changed at the end of the run). read_results() reads any of the formats back into numpy columns, iter_results() reads them in
+# batches of rows and only the columns asked for, for files too large to read at once. read_metadata() reads
+# only the run metadata header.
+############################################################################################################
+
+COLUMNS = ['Filename', 'Latitude', 'Longitude', 'Calculated_Latitude', 'Calculated_Longitude', 'Latitude_Error',
+           'Longitude_Error', 'Meters_Error', 'Corrected', 'Matched', 'Yaw', 'Tiles_Evaluated',
+           'Quality_Level']
+DTYPES = {'Filename': str, 'Corrected': bool, 'Matched': bool, 'Tiles_Evaluated': int, 'Quality_Level': int}
+FORMATS = {'.csv': 'csv', '.npz': 'npz', '.parquet': 'parquet'}
+
+
+def result_row(drone_image):
+    """Values of the COLUMNS for a localized drone image, without Meters_Error (see add_errors)"""
+    yaw = rotation.heading(drone_image)
+    return [drone_image.filename.split("/")[-1], drone_image.latitude, drone_image.longitude,
+            drone_image.latitude_calculated, drone_image.longitude_calculated,
+            drone_image.latitude - drone_image.latitude_calculated, drone_image.longitude - drone_image.longitude_calculated,
+            None, bool(drone_image.corrected), bool(drone_image.matched),
+            yaw if yaw is not None else math.nan, int(drone_image.tiles_evaluated),
+            int(drone_image.quality_level)]
+
+
+def add_errors(rows):
+    """Fills in the Meters_Error of a batch of rows, in one vectorized haversine pass"""
+    if not rows:
+        return
+    coordinates = np.array([row[1:5] for row in rows], dtype=float)
+    errors = evaluation.haversine_m(coordinates[:, 0], coordinates[:, 1], coordinates[:, 2], coordinates[:, 3])
+    meters_error = COLUMNS.index('Meters_Error')
+    for row, error in zip(rows, errors):
+        row[meters_error] = float(error)
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("Writing parquet results needs the pyarrow package: pip3 install pyarrow")
+    return pyarrow
+
+
+def _columns(rows):
+    """Numpy column arrays of a list of rows"""
+    columns = {}
+    for index, name in enumerate(COLUMNS):
+        values = [row[index] for row in rows]
+        columns[name] = np.array(values, dtype=DTYPES.get(name, float)) if values else np.array([], DTYPES.get(name, float))
+    return columns
+
+
+class ResultsWriter:
+    """
+    Writes the results of the drone images to filename, buffer_size rows at a time.
+    metadata: json serializable run metadata (config, map version, ...), the start and end time of the run are added.
+    Use it as a context manager or call close(), otherwise the last batch is not written.
+    """
+    def __init__(self, filename, metadata=None, buffer_size=100):
+        extension = os.path.splitext(filename)[1].lower()
+        if extension not in FORMATS:
+            raise ValueError("Unsupported results format %s, use one of %s" % (filename, list(FORMATS)))
+        self.filename = filename
+        self.format = FORMATS[extension]
+        self.buffer_size = buffer_size
+        self.metadata = {**(metadata or {}), 'started': time.time()}
+        self.buffer = []
+        self.chunks = 0 # chunks written to the npz file
+        self.count = 0
+        self.file = None
+        self.writer = None
+
+        directory = os.path.dirname(filename)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        if self.format == 'csv':
+            self.file = open(filename, 'w', newline='', encoding='UTF8')
+            self.writer = csv.writer(self.file)
+            self.writer.writerow(COLUMNS)
+            self.file.flush()
+            self._write_sidecar()
+        elif self.format == 'npz':
+            with zipfile.ZipFile(filename, 'w') as archive:
+                self._write_npz_array(archive, 'metadata', np.array(json.dumps(self.metadata, default=str)))
+        else:
+            pyarrow = _import_pyarrow()
+            schema = pyarrow.table(_columns([])).schema.with_metadata({'wildnav': json.dumps(self.metadata, default=str)})
+            self.writer = pyarrow.parquet.ParquetWriter(filename, schema)
+            self._write_sidecar()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+    def _write_sidecar(self):
+        tmp_filename = "%s.meta.json.%d.tmp" % (self.filename, os.getpid())
+        with open(tmp_filename, 'w') as file:
+            json.dump(self.metadata, file, indent=1, default=str)
+        os.replace(tmp_filename, self.filename + ".meta.json")
+
+    def write(self, drone_image):
+        """Adds the result of a drone image, written with the next batch"""
+        self.buffer.append(result_row(drone_image))
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        """Writes the buffered rows"""
+        if not self.buffer:
+            return
+        with instrumentation.span('results_write', rows=len(self.buffer)):
+            add_errors(self.buffer)
+            self.count += len(self.buffer)
+            if self.format == 'csv':
+                self.writer.writerows(self.buffer)
+                self.file.flush()
+            elif self.format == 'npz':
+                self._write_npz(self.buffer)
+            else:
+                self._write_parquet(self.buffer)
+            self.buffer = []
+
+    @staticmethod
+    def _write_npz_array(archive, name, array):
+        with archive.open(name + ".npy", 'w', force_zip64=True) as file:
+            np.lib.format.write_array(file, np.asanyarray(array), allow_pickle=False)
+
+    def _write_npz(self, rows):
+        """Appends the rows to the npz file as a new chunk of every column"""
+        self.chunks += 1
+        with zipfile.ZipFile(self.filename, 'a') as archive:
+            for name, array in _columns(rows).items():
+                self._write_npz_array(archive, "%s.%06d" % (name, self.chunks), array)
+
+    def _write_parquet(self, rows):
+        self.writer.write_table(_import_pyarrow().table(_columns(rows)).cast(self.writer.schema))
+
+    def close(self):
+        """Writes the remaining rows and the end time of the run"""
+        self.flush()
+        self.metadata.update({'finished': time.time(), 'results': self.count})
+        self.metadata['elapsed_s'] = self.metadata['finished'] - self.metadata['started']
+        if self.format == 'csv':
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+            self._write_sidecar()
+        elif self.format == 'npz':
+            with zipfile.ZipFile(self.filename, 'a') as archive:
+                self._write_npz_array(archive, 'metadata.closed', np.array(json.dumps(self.metadata, default=str)))
+        elif self.writer is not None:
+            # the schema metadata is written when the file is opened, the final times go to the sidecar
+            self.writer.close()
+            self.writer = None
+            self._write_sidecar()
+
+
+def read_metadata(filename):
+    """
+    Run metadata of a results file, None if it has none: from the sidecar of csv and parquet files (the one of
+    parquet files has the end time of the run), from the file itself for npz, without reading the rows.
+    """
+    if os.path.isfile(filename + ".meta.json"):
+        with open(filename + ".meta.json") as file:
+            return json.load(file)
+    format = FORMATS.get(os.path.splitext(filename)[1].lower())
+    if format == 'npz':
+        with np.load(filename) as data:
+            return _npz_metadata(data)
+    if format == 'parquet':
+        schema_metadata = _import_pyarrow().parquet.read_schema(filename).metadata
+        if schema_metadata and b'wildnav' in schema_metadata:
+            return json.loads(schema_metadata[b'wildnav'])
+    return None
+
+
+def _npz_chunks(data, columns=None):
+    """
+    Chunks of an npz results file as {column: numpy array}, in the order they were written.
+    Files written before the chunks have a single array per column.
+    """
+    chunks = {}
+    for name in data.files:
+        column, _, number = name.partition('.')
+        if column != 'metadata' and (columns is None or column in columns):
+            chunks.setdefault(number, {})[column] = data[name]
+    return [chunks[number] for number in sorted(chunks)]
+
+
+def _npz_metadata(data):
+    for name in ('metadata.closed', 'metadata'):
+        if name in data.files:
+            return json.loads(str(data[name]))
+    return None
+
+
+def _csv_column(name, values):
+    if DTYPES.get(name) is bool:
+        return np.array([value == 'True' for value in values], dtype=bool)
+    return np.array(values, dtype=DTYPES.get(name, float))
+
+
+def iter_results(filename, columns=None, batch_size=65536):
+    """
+    Reads a results file in batches of up to batch_size rows, yields them as {column: numpy array}.
+    columns: names of the columns to read, None reads all of them; columns missing in the file (older files) are left out.
+    """
+    format = FORMATS.get(os.path.splitext(filename)[1].lower())
+    if format == 'npz':
+        # every chunk of a column is a separate array in the file, only the ones asked for are loaded
+        with np.load(filename) as data:
+            for chunk in _npz_chunks(data, columns):
+                rows = len(next(iter(chunk.values()))) if chunk else 0
+                for start in range(0, rows, batch_size):
+                    yield {name: array[start:start + batch_size] for name, array in chunk.items()}
+        return
+
+    if format == 'parquet':
+        pyarrow = _import_pyarrow()
+        parquet_file = pyarrow.parquet.ParquetFile(filename)
+        names = [name for name in parquet_file.schema_arrow.names if columns is None or name in columns]
+        for batch in parquet_file.iter_batches(batch_size=batch_size, columns=names):
+            yield {name: batch.column(name).to_numpy(zero_copy_only=False) for name in names}
+        return
+
+    # csv, also the ones written before the header and the Yaw / Tiles_Evaluated columns existed
+    with open(filename, newline='', encoding='UTF8') as file:
+        reader = csv.reader(file)
+        first = next(reader, None)
+        if first is None:
+            return
+        if first[0] == COLUMNS[0]:
+            header, rows = first, []
+        else:
+            header, rows = COLUMNS[:len(first)], [first] # the unlabeled last column of the old files is the yaw
+        indices = [(index, name) for index, name in enumerate(header) if columns is None or name in columns]
+        for row in reader:
+            if row:
+                rows.append(row)
+            if len(rows) == batch_size:
+                yield {name: _csv_column(name, [row[index] for row in rows]) for index, name in indices}
+                rows = []
+        if rows:
+            yield {name: _csv_column(name, [row[index] for row in rows]) for index, name in indices}
+
+
+def read_results(filename, columns=None):
+    """
+    Reads a results file, returns its columns as numpy arrays and its run metadata (None if there is none).
+    columns: names of the columns to read, None reads all of them.
+    """
+    format = FORMATS.get(os.path.splitext(filename)[1].lower())
+    metadata = read_metadata(filename)
+
+    if format == 'npz':
+        with np.load(filename) as data:
+            chunks = _npz_chunks(data, columns)
+        if not chunks:
+            return {name: np.array([], DTYPES.get(name, float)) for name in COLUMNS if columns is None or name in columns}, metadata
+        return {name: np.concatenate([chunk[name] for chunk in chunks]) for name in chunks[0]}, metadata
+
+    if format == 'parquet':
+        pyarrow = _import_pyarrow()
+        names = [name for name in pyarrow.parquet.read_schema(filename).names if columns is None or name in columns]
+        table = pyarrow.parquet.read_table(filename, columns=names)
+        return {name: table.column(name).to_numpy() for name in table.column_names}, metadata
+
+    batches = list(iter_results(filename, columns))
+    if not batches:
+        return {name: np.array([], DTYPES.get(name, float)) for name in COLUMNS if columns is None or name in columns}, metadata
+    return {name: np.concatenate([batch[name] for batch in batches]) for name in batches[0]}, metadata
@@ -0,0 +1,147 @@
+"""Global descriptor retrieval: shortlists the map tiles worth matching with superglue when there is no GNSS prior"""
+import hashlib
+import json
+import os
+
+import numpy as np
+
+import feature_cache
+
+############################################################################################################
+# Every tile (and every query image) is summarized by one VLAD vector built from its SuperPoint descriptors:
+# the descriptors are assigned to the closest word of a small codebook learnt on the map, the residuals are
+# summed per word, intra-normalized, power-normalized and L2-normalized. The tile vectors are stacked in a
+# single matrix, so ranking the whole map for a query is one matrix-vector product.
+############################################################################################################
+
+NUM_CLUSTERS = 16 # size of the VLAD codebook, the global descriptors have NUM_CLUSTERS * 256 dimensions
+
+
+def train_codebook(descriptor_sets, num_clusters=NUM_CLUSTERS, iterations=20, max_samples=50000, seed=0):
+    """Spherical k-means over a sample of the (256, N) descriptor sets, returns a (num_clusters, 256) codebook"""
+    rng = np.random.default_rng(seed)
+    samples = np.concatenate([descriptors.T for descriptors in descriptor_sets if descriptors.shape[1] > 0])
+    if len(samples) > max_samples:
+        samples = samples[rng.choice(len(samples), max_samples, replace=False)]
+    centers = samples[rng.choice(len(samples), num_clusters, replace=len(samples) < num_clusters)].copy()
+    for _ in range(iterations):
+        assignment = np.argmax(samples @ centers.T, axis=1)
+        sums = np.zeros_like(centers)
+        np.add.at(sums, assignment, samples)
+        empty = ~sums.any(axis=1)
+        sums[empty] = centers[empty] # keep the previous word for empty clusters
+        centers = sums / (np.linalg.norm(sums, axis=1, keepdims=True) + 1e-12)
+    return centers.astype(np.float32)
+
+
+def vlad(descriptors, codebook):
+    """VLAD global descriptor of a (256, N) SuperPoint descriptor set"""
+    descriptors = descriptors.T
+    residuals = np.zeros(codebook.shape, np.float32)
+    if len(descriptors):
+        assignment = np.argmax(descriptors @ codebook.T, axis=1)
+        np.add.at(residuals, assignment, descriptors - codebook[assignment])
+    residuals /= np.linalg.norm(residuals, axis=1, keepdims=True) + 1e-12
+    vector = residuals.ravel()
+    vector = np.sign(vector) * np.sqrt(np.abs(vector))
+    return vector / (np.linalg.norm(vector) + 1e-12)
+
+
+class GlobalIndex:
+    """VLAD descriptors of all the map tiles, one row per tile in the order of the tile list"""
+    def __init__(self, codebook, descriptors):
+        self.codebook = codebook
+        self.descriptors = descriptors
+
+    def __len__(self):
+        return len(self.descriptors)
+
+    def similarities(self, descriptors):
+        """Cosine similarity between a query (256, N) SuperPoint descriptor set and every tile"""
+        return self.descriptors @ vlad(descriptors, self.codebook)
+
+    def rank(self, descriptors, k=None):
+        """Indices of the k tiles most similar to a query descriptor set, most similar first"""
+        order = np.argsort(-self.similarities(descriptors), kind='stable')
+        return order if k is None else order[:k]
+
+    def save(self, filename):
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        tmp_filename = "%s.%d.tmp" % (filename, os.getpid())
+        with open(tmp_filename, 'wb') as file:
+            np.savez(file, codebook=self.codebook, descriptors=self.descriptors)
+        os.replace(tmp_filename, filename)
+
+
+def build_global_index(tiles, num_clusters=NUM_CLUSTERS):
+    """Trains the codebook on the map tiles and computes the global descriptor of every tile"""
+    codebook = train_codebook([tile.descriptors for tile in tiles], num_clusters)
+    descriptors = np.stack([vlad(tile.descriptors, codebook) for tile in tiles]).astype(np.float32)
+    return GlobalIndex(codebook, descriptors)
+
+
+def load_global_index(tiles, cache_dir=None, num_clusters=NUM_CLUSTERS):
+    """Loads the global index of the map tiles from the map feature folder, building it if missing or stale.
+    The index is only cached when all the tiles come from the feature cache, since its key is made of theirs.
+    """
+    keys = [tile.cache_key for tile in tiles]
+    if not tiles or any(key is None for key in keys):
+        return build_global_index(tiles, num_clusters)
+
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(tiles[0].filename), feature_cache.FEATURES_DIR)
+    digest = hashlib.sha1(json.dumps({'tiles': keys, 'num_clusters': num_clusters}, sort_keys=True).encode())
+    filename = os.path.join(cache_dir, "global_index." + digest.hexdigest()[:12] + ".npz")
+    if os.path.isfile(filename):
+        try:
+            with np.load(filename) as data:
+                return GlobalIndex(data['codebook'], data['descriptors'])
+        except (OSError, ValueError, KeyError):
+            pass
+    global_index = build_global_index(tiles, num_clusters)
+    global_index.save(filename)
+    return global_index
+
+
+def recall_at_k(rankings, ground_truth, ks):
+    """Fraction of the queries for which at least one correct tile is ranked in the top k, for every k in ks.
+    rankings: list of tile index rankings, ground_truth: list of sets of correct tile indices
+    Queries without any correct tile in the map are ignored.
+    """
+    pairs = [(ranking, truth) for ranking, truth in zip(rankings, ground_truth) if truth]
+    if not pairs:
+        return {k: float('nan') for k in ks}
+    return {k: sum(1 for ranking, truth in pairs if truth.intersection(ranking[:k])) / len(pairs) for k in ks}
+
+
+if __name__ == "__main__":
+    # Reports recall@k of the retrieval stage over the drone images in assets/query, using their
+    # GNSS coordinates as ground truth (the correct tiles are the ones containing the GNSS position)
+    import cv2
+    import superglue_utils
+    import wildnav
+    from spatial_index import TileGrid
+
+    geo_images_list = wildnav.csv_read_sat_map(wildnav.map_filename)
+    drone_images_list = wildnav.csv_read_drone_images(wildnav.drone_photos_filename)
+    localizer = superglue_utils.Localizer(no_display=True, output_dir=None)
+    tiles, loaded = feature_cache.load_map_features(localizer, [geo_image.filename for geo_image in geo_images_list])
+    global_index = load_global_index(tiles)
+    # ground truth over the tiles actually loaded, in the order of their features
+    tile_grid = TileGrid([geo_images_list[index] for index in loaded])
+
+    rankings = []
+    ground_truth = []
+    for drone_image in drone_images_list:
+        photo = cv2.imread(drone_image.filename)
+        if photo is None:
+            print("Could not read drone image, skipping: " + drone_image.filename)
+            continue
+        _, query_data = localizer.extract_query(photo)
+        rankings.append(list(global_index.rank(query_data['descriptors0'][0].cpu().numpy())))
+        ground_truth.append(set(tile_grid.containing(drone_image.latitude, drone_image.longitude)))
+
+    ks = sorted({k for k in (1, 2, 3, 5, 10, 20, 50, 100) if k < len(tiles)} | {len(tiles)})
+    print("Retrieval recall over %d drone images and %d map tiles:" % (len(rankings), len(tiles)))
+    for k, recall in recall_at_k(rankings, ground_truth, ks).items():
+        print("  recall@%d: %.3f" % (k, recall))
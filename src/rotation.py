@@ -0,0 +1,105 @@
+"""Rotation strategy: orients the drone images like the (north-up) satellite map before matching"""
+import math
+
+import cv2
+import numpy as np
+
+import instrumentation
+
+############################################################################################################
+# The drone image is first matched as it is, or de-rotated to north-up with the camera heading from its
+# metadata (use_heading), against the candidate tiles. Only if that gives no confident match, the rest of
+# a small ordered set of rotations is tried, all of them in a single pass over the tiles: every tile is
+# matched against all the rotated versions of the drone image in the same superglue batch, and the search
+# stops at the first confident match.
+############################################################################################################
+
+YAW_OFFSET = 0 # degrees added to the gimbal yaw to get the camera heading (clockwise from north), for a camera mount
+               # that is not aligned with the gimbal
+FALLBACK_ROTATIONS = [0, 90, -90, 180] # rotations tried (in this order) when the heading does not give a match
+
+
+def heading(drone_image):
+    """
+    Camera heading of a drone image in degrees clockwise from north, None if the metadata has no yaw.
+    The gimbal yaw of the metadata is already absolute (not relative to the flight yaw of the drone body).
+    """
+    yaw = drone_image.gimball_yaw + YAW_OFFSET
+    return None if math.isnan(yaw) else yaw
+
+
+def rotate_image(image, angle):
+    """
+    Rotates an image by angle degrees clockwise around its center. The canvas is enlarged so that
+    nothing is cropped, so the center of the rotated image is the center of the original one.
+    """
+    angle = angle % 360
+    if angle == 0:
+        return image
+    h, w = image.shape[:2]
+    M = cv2.getRotationMatrix2D((w / 2, h / 2), -angle, 1.0)
+    cos, sin = abs(M[0, 0]), abs(M[0, 1])
+    w_new, h_new = int(round(h * sin + w * cos)), int(round(h * cos + w * sin))
+    M[0, 2] += w_new / 2 - w / 2
+    M[1, 2] += h_new / 2 - h / 2
+    return cv2.warpAffine(image, M, (w_new, h_new))
+
+
+def rotation_stages(drone_image, fallback=FALLBACK_ROTATIONS, use_heading=True):
+    """
+    Rotations to try for a drone image, as a list of stages that are only tried if the previous ones
+    gave no confident match. With a heading the first stage de-rotates the image to north-up and the
+    fallback rotations are relative to it, otherwise the fallback rotations are absolute. Either way the
+    first fallback rotation is tried on its own, the others together in the second stage.
+    """
+    north_up = heading(drone_image) if use_heading else None
+    if north_up is None:
+        north_up = 0
+    rotations = []
+    for rotation in fallback:
+        # the top of the image points to the heading: turning it clockwise by the heading brings north up
+        rotation = (rotation + north_up) % 360
+        if not any(np.isclose(rotation, r) for r in rotations):
+            rotations.append(rotation)
+    return [rotations[:1], rotations[1:]] if len(rotations) > 1 else [rotations]
+
+
+def is_located(result, early_exit=None):
+    """
+    True if a match result locates the drone image: the center of the image is inside the tile and,
+    with an early exit policy, the match is confident enough to stop searching.
+    """
+    if result.tile_index is None or not (0 <= result.center[0] < 1 and 0 <= result.center[1] < 1):
+        return False
+    return early_exit is None or early_exit.is_confident(result.num_matches, result.inlier_ratio, result.center)
+
+
+def match_rotated(localizer, photo, tiles, stages, query_data=None):
+    """
+    Matches a drone photo rotated by the angles of every stage against the map tiles, stage by stage,
+    until a stage locates it. All the rotations of a stage are matched in one pass over the tiles.
+    query_data: features of the photo rotated by the first angle of the first stage, if already extracted
+    Returns the best MatchResult, with the rotation (degrees clockwise) and the features of the matched photo
+    in its rotation and query_data attributes, and the number of tiles evaluated over all the stages.
+    """
+    best = None
+    tiles_evaluated = 0
+    for stage in stages:
+        variants = []
+        for rotation in stage:
+            if query_data is not None and not variants and stage is stages[0]:
+                variants.append(query_data)
+            else:
+                variants.append(localizer.extract_query(rotate_image(photo, rotation)))
+        instrumentation.count('rotation_stages', rotations=list(stage))
+        result = localizer.match_variants(variants, tiles)
+        if result.variant is not None:
+            result.rotation, result.query_data = stage[result.variant], variants[result.variant]
+        tiles_evaluated += result.tiles_evaluated
+        # a match with the center inside the tile beats any match without it, then the most matches win
+        if best is None or (is_located(result), result.num_matches) > (is_located(best), best.num_matches):
+            best = result
+        if is_located(result, localizer.early_exit):
+            break
+    best.tiles_evaluated = tiles_evaluated
+    return best
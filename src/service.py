@@ -0,0 +1,368 @@
+"""Localization service: keeps the model and the map loaded and localizes drone images sent over HTTP"""
+import argparse
+import collections
+import http.server
+import json
+import math
+import os
+import socketserver
+import threading
+import time
+import traceback
+import urllib.parse
+
+import cv2
+import numpy as np
+import torch
+
+import instrumentation
+import superglue_batch
+import wildnav
+
+############################################################################################################
+# A long running process that loads the feature matching model and the satellite map (features, spatial
+# and global index) once and localizes the drone images its clients send, over HTTP on a TCP port or on a
+# Unix socket:
+#   POST /localize?latitude=60.40&longitude=22.46&gimball_yaw=-4.7   body: the drone image (jpg or png)
+#        -> {"matched": true, "latitude": ..., "longitude": ..., "matches": 312, "confidence": 0.83, ...}
+#           The query parameters are the optional metadata of the drone image, named as in GeoPhotoDrone;
+#           latitude / longitude are used with gnss_prior_radius, the (absolute) gimball_yaw with
+#           use_heading, see wildnav.py. confidence is the fraction of the matches of the best map tile that
+#           are inliers of its homography.
+#   GET /metrics   queue depth, requests, latency and batching figures in the Prometheus text format, and the
+#                  stage totals of the instrumentation if instrumentation_filename is set in wildnav.py
+#   GET /health    200 once the model and the map are loaded
+# Every request is localized in its own thread, at most concurrency at a time; the others wait in the
+# queue, and requests beyond queue_size waiting ones are turned away with 503. The superglue batches of
+# the requests in flight go to one MicroBatcher thread, which matches the pairs of the requests that
+# arrive together in shared forward passes. Tracking and the latency target of wildnav.py are not used:
+# the requests are independent and share the matching settings.
+############################################################################################################
+
+DEFAULT_PORT = 8765
+MAX_IMAGE_BYTES = 64 * 2**20 # larger request bodies are refused
+METADATA_FIELDS = ['latitude', 'longitude', 'altitude', 'gimball_roll', 'gimball_yaw', 'gimball_pitch',
+                   'flight_roll', 'flight_yaw', 'flight_pitch'] # query parameters, as the GeoPhotoDrone arguments
+LATENCY_WINDOW = 1000 # recent requests the latency quantiles of /metrics are computed over
+QUANTILES = [0.5, 0.95, 0.99]
+
+
+class MicroBatcher:
+    """
+    Runs the superglue batches of concurrent queries in one thread, several of them in one forward pass.
+    Set as the batcher of a Localizer, its predict() hands every batch to match() and waits for the matches.
+    A batch waits up to max_wait seconds for the batches of the other queries in flight, never when it is alone.
+    """
+    def __init__(self, localizer, max_pairs=32, max_wait=0.01):
+        self.localizer = localizer
+        self.max_pairs = max_pairs
+        self.max_wait = max_wait
+        self.jobs = collections.deque() # [items, predictions, error, done event] waiting to be matched
+        self.condition = threading.Condition()
+        self.active = 0 # queries in flight, that may send a batch
+        self.closed = False
+        self.batches = 0 # forward passes run
+        self.pairs = 0 # pairs matched
+        self.jobs_matched = 0 # batches of queries matched, more than batches when they were combined
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def query(self):
+        """Context manager around the localization of a query, so that the batcher knows who may still send a batch"""
+        batcher = self
+
+        class _Query:
+            def __enter__(self):
+                with batcher.condition:
+                    batcher.active += 1
+
+            def __exit__(self, *exc_info):
+                with batcher.condition:
+                    batcher.active -= 1
+                    batcher.condition.notify_all()
+                return False
+
+        return _Query()
+
+    def match(self, items):
+        """Superglue predictions of a batch of pairs, in the format of superglue_batch.match_batch()"""
+        job = [items, None, None, threading.Event()]
+        with self.condition:
+            if self.closed:
+                raise RuntimeError("The batcher is closed")
+            self.jobs.append(job)
+            self.condition.notify_all()
+        job[3].wait()
+        if job[2] is not None:
+            raise job[2]
+        return job[1]
+
+    def _take(self):
+        """Waits for the next jobs to match together, None once closed"""
+        with self.condition:
+            while not self.jobs and not self.closed:
+                self.condition.wait()
+            if not self.jobs:
+                return None
+            # give the other queries in flight a moment to send their batches
+            deadline = time.perf_counter() + self.max_wait
+            while len(self.jobs) < self.active and sum(len(job[0]) for job in self.jobs) < self.max_pairs:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            jobs = [self.jobs.popleft()]
+            pairs = len(jobs[0][0])
+            while self.jobs and pairs + len(self.jobs[0][0]) <= self.max_pairs:
+                pairs += len(self.jobs[0][0])
+                jobs.append(self.jobs.popleft())
+            return jobs
+
+    def _run(self):
+        torch.set_grad_enabled(False) # per thread, superglue_utils only disables it in the main thread
+        localizer = self.localizer
+        max_memory = localizer.max_batch_memory * 2**20 if localizer.max_batch_memory is not None else None
+        while True:
+            jobs = self._take()
+            if jobs is None:
+                return
+            items = [item for job in jobs for item in job[0]]
+            try:
+                predictions = []
+                for batch in superglue_batch.split_batches(items, self.max_pairs, max_memory):
+                    with instrumentation.span('superglue', pairs=len(batch), queries=len(jobs)):
+                        predictions += superglue_batch.match_batch(localizer.matching.superglue, batch, localizer.batch_scores)
+                    self.batches += 1
+                start = 0
+                for job in jobs:
+                    job[1] = predictions[start:start + len(job[0])]
+                    start += len(job[0])
+            except Exception as error:
+                for job in jobs:
+                    job[2] = error
+            self.pairs += len(items)
+            self.jobs_matched += len(jobs)
+            for job in jobs:
+                job[3].set()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join()
+
+
+class LocalizationService:
+    """The loaded model and map, the request queue and the metrics of the service"""
+    def __init__(self, concurrency=4, queue_size=16, max_pairs=32, max_wait=0.01):
+        wildnav.save_located_images = False # nothing is drawn or written per request
+        wildnav.setup_instrumentation()
+        self.localizer = wildnav.create_localizer(no_display=True)
+        self.satellite_map = wildnav.load_satellite_map(self.localizer)
+        self.batcher = MicroBatcher(self.localizer, max_pairs, max_wait)
+        if self.localizer.check_batches(): # otherwise every request matches its pairs one by one
+            self.localizer.batcher = self.batcher
+        self.slots = threading.Semaphore(concurrency) # requests localized at the same time
+        self.queue_size = queue_size
+        self.lock = threading.Lock()
+        self.waiting = 0 # requests in the queue
+        self.in_flight = 0 # requests being localized
+        self.requests = collections.Counter() # status -> number of requests
+        self.latencies = collections.deque(maxlen=LATENCY_WINDOW) # seconds from arrival to answer
+        self.latency_sum = 0.0
+        self.queue_sum = 0.0 # seconds spent in the queue
+        self.next_id = 0
+
+    def _count(self, status, latency=None, queued=None):
+        with self.lock:
+            self.requests[status] += 1
+            if latency is not None:
+                self.latencies.append(latency)
+                self.latency_sum += latency
+                self.queue_sum += queued
+
+    def localize(self, photo, name=None, metadata=None):
+        """
+        Localizes a drone image (BGR numpy array) with its optional metadata (dict of METADATA_FIELDS).
+        Returns the answer as a dict, None if the queue is full.
+        """
+        arrival = time.perf_counter()
+        with self.lock:
+            if self.waiting >= self.queue_size:
+                self.requests['rejected'] += 1
+                return None
+            self.waiting += 1
+            self.next_id += 1
+            name = name or "request_%d" % self.next_id
+        values = [float((metadata or {}).get(field, math.nan)) for field in METADATA_FIELDS]
+        drone_image = wildnav.GeoPhotoDrone(name, photo, *values)
+
+        with self.slots:
+            with self.lock:
+                self.waiting -= 1
+                self.in_flight += 1
+            queued = time.perf_counter() - arrival
+            try:
+                with torch.no_grad(), self.batcher.query():
+                    wildnav.localize_drone_image(drone_image, self.localizer, self.satellite_map)
+            except Exception:
+                self._count('error')
+                raise
+            finally:
+                with self.lock:
+                    self.in_flight -= 1
+
+        latency = time.perf_counter() - arrival
+        self._count('located' if drone_image.matched else 'not_located', latency, queued)
+        return {
+            'name': name,
+            'matched': drone_image.matched,
+            'latitude': drone_image.latitude_calculated if drone_image.matched else None,
+            'longitude': drone_image.longitude_calculated if drone_image.matched else None,
+            'matches': max(drone_image.num_matches, 0),
+            'confidence': drone_image.inlier_ratio if drone_image.matched else 0.0,
+            'tiles_evaluated': drone_image.tiles_evaluated,
+            'queue_s': queued,
+            'latency_s': latency,
+        }
+
+    def metrics_text(self):
+        """Metrics of the service in the Prometheus text exposition format"""
+        prefix = instrumentation.PREFIX + "service_"
+        with self.lock:
+            latencies = np.array(self.latencies)
+            lines = ["# TYPE %squeue_depth gauge" % prefix, "%squeue_depth %d" % (prefix, self.waiting),
+                     "# TYPE %sin_flight gauge" % prefix, "%sin_flight %d" % (prefix, self.in_flight),
+                     "# TYPE %srequests_total counter" % prefix]
+            for status in ('located', 'not_located', 'rejected', 'error'):
+                lines.append('%srequests_total{status="%s"} %d' % (prefix, status, self.requests[status]))
+            answered = self.requests['located'] + self.requests['not_located']
+            lines.append("# TYPE %slatency_seconds summary" % prefix)
+            for quantile in QUANTILES:
+                value = np.quantile(latencies, quantile) if len(latencies) else math.nan
+                lines.append('%slatency_seconds{quantile="%g"} %.6f' % (prefix, quantile, value))
+            lines += ["%slatency_seconds_sum %.6f" % (prefix, self.latency_sum),
+                      "%slatency_seconds_count %d" % (prefix, answered),
+                      "# TYPE %squeue_seconds summary" % prefix,
+                      "%squeue_seconds_sum %.6f" % (prefix, self.queue_sum),
+                      "%squeue_seconds_count %d" % (prefix, answered)]
+        batcher = self.batcher
+        lines += ["# TYPE %ssuperglue_batches_total counter" % prefix,
+                  "%ssuperglue_batches_total %d" % (prefix, batcher.batches),
+                  "# TYPE %ssuperglue_pairs_total counter" % prefix,
+                  "%ssuperglue_pairs_total %d" % (prefix, batcher.pairs),
+                  "# TYPE %ssuperglue_query_batches_total counter" % prefix,
+                  "%ssuperglue_query_batches_total %d" % (prefix, batcher.jobs_matched)]
+        text = "\n".join(lines) + "\n"
+        if instrumentation.enabled():
+            text += instrumentation._recorder.prometheus_text()
+        return text
+
+    def close(self):
+        self.batcher.close()
+        instrumentation.configure(None)
+
+
+class RequestHandler(http.server.BaseHTTPRequestHandler):
+    """HTTP interface of the LocalizationService of the server"""
+    def _send(self, status, body, content_type='application/json'):
+        if not isinstance(body, bytes):
+            body = (json.dumps(body) + "\n").encode() if content_type == 'application/json' else body.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path = urllib.parse.urlsplit(self.path).path
+        if path == '/metrics':
+            self._send(200, self.server.service.metrics_text(), 'text/plain; version=0.0.4')
+        elif path == '/health':
+            self._send(200, {'status': 'ok'})
+        else:
+            self._send(404, {'error': "unknown path " + path})
+
+    def do_POST(self):
+        url = urllib.parse.urlsplit(self.path)
+        if url.path != '/localize':
+            self._send(404, {'error': "unknown path " + url.path})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', ''))
+        except ValueError:
+            length = -1
+        if length < 0:
+            self._send(400, {'error': "missing or invalid Content-Length"})
+            return
+        if length > MAX_IMAGE_BYTES:
+            self._send(413, {'error': "the image is larger than %d bytes" % MAX_IMAGE_BYTES})
+            return
+        body = self.rfile.read(length)
+        photo = cv2.imdecode(np.frombuffer(body, np.uint8), cv2.IMREAD_COLOR) if body else None
+        if photo is None:
+            self._send(400, {'error': "the request body is not a jpg or png image"})
+            return
+        params = urllib.parse.parse_qs(url.query)
+        try:
+            metadata = {field: float(params[field][0]) for field in METADATA_FIELDS if field in params}
+        except ValueError as error:
+            self._send(400, {'error': str(error)})
+            return
+        name = params['name'][0] if 'name' in params else None
+        try:
+            answer = self.server.service.localize(photo, name, metadata)
+        except Exception as error:
+            traceback.print_exc()
+            self._send(500, {'error': repr(error)})
+            return
+        if answer is None:
+            self._send(503, {'error': "the request queue is full"})
+        else:
+            self._send(200, answer)
+
+    def address_string(self):
+        # the client address of a Unix socket is not a (host, port) tuple
+        return self.client_address[0] if isinstance(self.client_address, tuple) else "unix"
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def create_server(service, host='127.0.0.1', port=DEFAULT_PORT, socket_path=None):
+    """HTTP server of a service on a TCP port, or on a Unix socket if socket_path is given"""
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            os.remove(socket_path) # left over by a previous run
+        server = UnixHTTPServer(socket_path, RequestHandler)
+    else:
+        server = http.server.ThreadingHTTPServer((host, port), RequestHandler)
+        server.daemon_threads = True
+    server.service = service
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Localization service keeping the model and the map of wildnav.py loaded")
+    parser.add_argument('--host', default='127.0.0.1', help="address to listen on")
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help="TCP port to listen on")
+    parser.add_argument('--socket', default=None, help="listen on this Unix socket instead of a TCP port")
+    parser.add_argument('--concurrency', type=int, default=4, help="requests localized at the same time")
+    parser.add_argument('--queue', type=int, default=16, help="requests waiting to be localized before new ones are refused")
+    parser.add_argument('--max-pairs', type=int, default=32, help="image pairs of the requests matched in one superglue pass")
+    parser.add_argument('--max-wait', type=float, default=0.01,
+                        help="seconds a superglue batch waits for the batches of the other requests in flight")
+    args = parser.parse_args()
+
+    service = LocalizationService(args.concurrency, args.queue, args.max_pairs, args.max_wait)
+    server = create_server(service, args.host, args.port, args.socket)
+    print("Localization service listening on " + (args.socket or "http://%s:%d" % (args.host, args.port)))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    service.close()
+    if args.socket is not None and os.path.exists(args.socket):
+        os.remove(args.socket)
@@ -0,0 +1,97 @@
+"""Spatial index over the geographical bounds of the satellite map tiles"""
+import math
+
+EARTH_RADIUS = 6371008.8 # mean earth radius in meters
+METERS_PER_DEGREE = math.pi * EARTH_RADIUS / 180
+
+
+class TileGrid:
+    """Uniform grid over the bounds of the map tiles (GeoPhoto.top_left_coord / bottom_right_coord).
+    Every grid cell keeps the indices of the tiles overlapping it, so that the tiles close to a
+    position are found without looking at the whole map.
+    """
+    def __init__(self, geo_photos, cell_size=None):
+        # bounds of every tile as (min_lat, min_lon, max_lat, max_lon)
+        self.bounds = []
+        for geo_photo in geo_photos:
+            lat_a, lon_a = geo_photo.top_left_coord
+            lat_b, lon_b = geo_photo.bottom_right_coord
+            self.bounds.append((min(lat_a, lat_b), min(lon_a, lon_b), max(lat_a, lat_b), max(lon_a, lon_b)))
+
+        # by default the cells are as large as an average tile (in degrees)
+        if cell_size is None and self.bounds:
+            cell_size = (sum(b[2] - b[0] for b in self.bounds) / len(self.bounds),
+                         sum(b[3] - b[1] for b in self.bounds) / len(self.bounds))
+        self.cell_lat, self.cell_lon = cell_size if cell_size else (1.0, 1.0)
+
+        # extent of the map, queries never look at cells outside of it
+        self.extent = (min((b[0] for b in self.bounds), default=0), min((b[1] for b in self.bounds), default=0),
+                       max((b[2] for b in self.bounds), default=0), max((b[3] for b in self.bounds), default=0))
+
+        self.cells = {}
+        for index, (min_lat, min_lon, max_lat, max_lon) in enumerate(self.bounds):
+            for cell in self._cells_in(min_lat, min_lon, max_lat, max_lon):
+                self.cells.setdefault(cell, []).append(index)
+
+    def __len__(self):
+        return len(self.bounds)
+
+    def _cells_in(self, min_lat, min_lon, max_lat, max_lon):
+        """Grid cells overlapping a latitude / longitude rectangle"""
+        for i in range(math.floor(min_lat / self.cell_lat), math.floor(max_lat / self.cell_lat) + 1):
+            for j in range(math.floor(min_lon / self.cell_lon), math.floor(max_lon / self.cell_lon) + 1):
+                yield (i, j)
+
+    def distance(self, index, latitude, longitude):
+        """Distance in meters from a position to the closest point of a tile, 0 if the tile contains it"""
+        min_lat, min_lon, max_lat, max_lon = self.bounds[index]
+        d_lat = max(min_lat - latitude, 0, latitude - max_lat)
+        d_lon = max(min_lon - longitude, 0, longitude - max_lon)
+        return METERS_PER_DEGREE * math.hypot(d_lat, d_lon * math.cos(math.radians(latitude)))
+
+    def query(self, latitude, longitude, radius):
+        """Indices of the tiles closer than radius meters to a position, nearest first"""
+        d_lat = radius / METERS_PER_DEGREE
+        d_lon = d_lat / max(math.cos(math.radians(latitude)), 1e-6)
+        min_lat, min_lon = max(latitude - d_lat, self.extent[0]), max(longitude - d_lon, self.extent[1])
+        max_lat, max_lon = min(latitude + d_lat, self.extent[2]), min(longitude + d_lon, self.extent[3])
+        if min_lat > max_lat or min_lon > max_lon:
+            return []
+        candidates = set()
+        for cell in self._cells_in(min_lat, min_lon, max_lat, max_lon):
+            candidates.update(self.cells.get(cell, ()))
+        distances = {index: self.distance(index, latitude, longitude) for index in candidates}
+        return sorted((index for index in candidates if distances[index] <= radius),
+                      key=lambda index: (distances[index], index))
+
+    def search(self, latitude, longitude, radius, growth=2.0, max_radius=None):
+        """Tiles worth matching for a noisy position prior with the given uncertainty radius (meters).
+        When no tile is found, the radius grows by the growth factor until tiles are found or max_radius
+        is exceeded. Returns the tile indices (nearest first) and the radius that was used.
+        """
+        if max_radius is None:
+            # far enough to reach every tile of the map: distance to the farthest corner of the map extent
+            d_lat = max(abs(latitude - self.extent[0]), abs(latitude - self.extent[2]))
+            d_lon = max(abs(longitude - self.extent[1]), abs(longitude - self.extent[3]))
+            max_radius = max(radius, METERS_PER_DEGREE * math.hypot(d_lat, d_lon * math.cos(math.radians(latitude))))
+        while True:
+            indices = self.query(latitude, longitude, radius)
+            if indices or radius >= max_radius:
+                return indices, radius
+            radius = min(max(radius * growth, 1.0), max_radius)
+
+    def containing(self, latitude, longitude):
+        """Indices of the tiles containing a position"""
+        return self.query(latitude, longitude, 0)
+
+    def overlapping(self, bounds, latitude, longitude):
+        """Indices of the tiles overlapping the (min_lat, min_lon, max_lat, max_lon) bounds, nearest to a position first"""
+        min_lat, min_lon, max_lat, max_lon = bounds
+        candidates = set()
+        for cell in self._cells_in(max(min_lat, self.extent[0]), max(min_lon, self.extent[1]),
+                                   min(max_lat, self.extent[2]), min(max_lon, self.extent[3])):
+            candidates.update(self.cells.get(cell, ()))
+        indices = [index for index in candidates
+                   if self.bounds[index][0] < max_lat and self.bounds[index][2] > min_lat and
+                   self.bounds[index][1] < max_lon and self.bounds[index][3] > min_lon]
+        return sorted(indices, key=lambda index: (self.distance(index, latitude, longitude), index))
@@ -0,0 +1,227 @@
+"""Streaming input: localizes drone frames from a video file or a watched folder as they arrive"""
+import argparse
+import bisect
+import collections
+import csv
+import math
+import os
+import threading
+import time
+
+import cv2
+
+import instrumentation
+import wildnav
+
+############################################################################################################
+# A source is a generator of drone images (wildnav.GeoPhotoDrone with the image already in photo). A reader
+# thread pulls the source into a bounded queue and the localizer takes the frames out of it, so reading and
+# localizing overlap and the queue never grows beyond its size. When the queue is full the drop policy
+# decides what happens to the new frame:
+#   block   the reader waits for the localizer (backpressure, no frame is lost; for recorded data)
+#   latest  the oldest queued frame is dropped, so the localizer always works on the most recent frames
+# Independently, every_nth only admits one frame out of every N into the queue.
+# Frames without metadata get NaN coordinates and yaw: without a GNSS prior they are matched against all the
+# map tiles (or the retrieval_top_k ones with the most similar global descriptor, if set in wildnav.py), and
+# without a heading with all the fallback rotations.
+############################################################################################################
+
+POLICIES = ['block', 'latest']
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+MAX_READ_RETRIES = 20 # polls an unchanged image that cannot be read is tried before it is skipped
+IMAGE_TRAILERS = (b'\xff\xd9', b'IEND\xaeB`\x82') # last bytes of a complete jpeg / png file
+NAN_METADATA = [math.nan] * 9 # latitude, longitude, altitude, gimball roll/yaw/pitch, flight roll/yaw/pitch
+
+
+def read_metadata(filename):
+    """Reads a csv file in the photo_metadata.csv format into a dict: first column -> the 9 metadata values"""
+    metadata = {}
+    with open(filename) as csv_file:
+        csv_reader = csv.reader(csv_file, delimiter=',')
+        next(csv_reader, None)
+        for row in csv_reader:
+            if len(row) >= 10:
+                metadata[row[0].strip()] = [float(x) for x in row[1:10]]
+    return metadata
+
+
+def video_frames(filename, telemetry_filename=None):
+    """
+    Yields the frames of a video file as drone images named <video name>_<frame number>.
+    telemetry_filename: optional csv file in the photo_metadata.csv format whose first column is the time
+    in seconds from the start of the video; every frame gets the last metadata row before its time.
+    """
+    telemetry = sorted((float(t), values) for t, values in read_metadata(telemetry_filename).items()) \
+        if telemetry_filename is not None else []
+    times = [t for t, _ in telemetry]
+    capture = cv2.VideoCapture(filename)
+    if not capture.isOpened():
+        raise IOError("Could not open video " + filename)
+    name = os.path.splitext(filename)[0]
+    index = 0
+    try:
+        while True:
+            ok, frame = capture.read()
+            if not ok:
+                break
+            timestamp = capture.get(cv2.CAP_PROP_POS_MSEC) / 1000
+            position = bisect.bisect_right(times, timestamp) - 1
+            values = telemetry[position][1] if position >= 0 else NAN_METADATA
+            yield wildnav.GeoPhotoDrone("%s_%06d" % (name, index), frame, *values)
+            index += 1
+    finally:
+        capture.release()
+
+
+def is_complete(filename):
+    """True if the file ends like a complete jpeg or png image, OpenCV decodes a truncated one without failing"""
+    with open(filename, 'rb') as file:
+        file.seek(0, os.SEEK_END)
+        file.seek(max(0, file.tell() - 8))
+        return file.read().endswith(IMAGE_TRAILERS)
+
+
+def watch_folder(folder, metadata_filename=None, poll_interval=0.5, stop=None, max_retries=MAX_READ_RETRIES):
+    """
+    Yields the images that land in a folder as drone images, oldest first, until stop (threading.Event) is set.
+    metadata_filename: optional csv file in the photo_metadata.csv format, re-read whenever it changes,
+    with the metadata of the images by filename.
+    An image is only read once its size and modification time did not change for a whole poll and it ends like
+    a complete image, since OpenCV decodes an image that is still being written into a partial one. Writers
+    that can should write the image under another extension (e.g. .tmp) and rename it when it is complete.
+    An image that is incomplete or cannot be read is tried again in the next polls and given up after
+    max_retries polls in which it did not change.
+    """
+    seen = set()
+    pending = {} # name -> (size, mtime) of the image at the last poll
+    failures = {} # name -> polls in a row the unchanged image could not be read
+    metadata, metadata_mtime = {}, None
+    while stop is None or not stop.is_set():
+        if metadata_filename is not None and os.path.isfile(metadata_filename):
+            mtime = os.path.getmtime(metadata_filename)
+            if mtime != metadata_mtime:
+                metadata, metadata_mtime = read_metadata(metadata_filename), mtime
+
+        new_files = []
+        for entry in os.scandir(folder):
+            if entry.is_file() and entry.name.lower().endswith(IMAGE_EXTENSIONS) and entry.name not in seen:
+                stat = entry.stat()
+                new_files.append((stat.st_mtime, stat.st_size, entry.name))
+        yielded = False
+        for mtime, size, name in sorted(new_files):
+            if pending.get(name) != (size, mtime):
+                # new or still being written, read in a later poll once it stopped changing
+                pending[name] = (size, mtime)
+                failures.pop(name, None)
+                continue
+            path = os.path.join(folder, name)
+            photo = cv2.imread(path) if is_complete(path) else None
+            if photo is None:
+                failures[name] = failures.get(name, 0) + 1
+                if failures[name] >= max_retries:
+                    print("Could not read %s after %d polls, skipping it" % (name, failures[name]))
+                    seen.add(name)
+                    del pending[name], failures[name]
+                continue
+            seen.add(name)
+            del pending[name]
+            failures.pop(name, None)
+            yielded = True
+            yield wildnav.GeoPhotoDrone(path, photo, *metadata.get(name, NAN_METADATA))
+        if not yielded:
+            time.sleep(poll_interval)
+
+
+class FrameQueue:
+    """Bounded queue between a reader thread pulling a source and the localizer"""
+    def __init__(self, source, maxsize=4, policy='latest', every_nth=1):
+        if policy not in POLICIES:
+            raise ValueError("Unknown drop policy %s, use one of %s" % (policy, POLICIES))
+        self.source = source
+        self.maxsize = maxsize
+        self.policy = policy
+        self.every_nth = every_nth
+        self.frames = collections.deque()
+        self.condition = threading.Condition()
+        self.done = False
+        self.error = None
+        self.received = 0
+        self.dropped = 0
+        self.thread = threading.Thread(target=self._read, daemon=True)
+        self.thread.start()
+
+    def _read(self):
+        try:
+            for index, frame in enumerate(self.source):
+                with self.condition:
+                    self.received += 1
+                    if index % self.every_nth:
+                        self.dropped += 1
+                        continue
+                    if self.policy == 'block':
+                        while len(self.frames) >= self.maxsize:
+                            self.condition.wait()
+                    elif len(self.frames) >= self.maxsize:
+                        self.frames.popleft()
+                        self.dropped += 1
+                    self.frames.append(frame)
+                    self.condition.notify_all()
+        except Exception as error:
+            self.error = error
+        finally:
+            with self.condition:
+                self.done = True
+                self.condition.notify_all()
+
+    def __iter__(self):
+        """Yields the queued frames until the source is exhausted"""
+        while True:
+            with self.condition:
+                while not self.frames and not self.done:
+                    self.condition.wait()
+                if not self.frames:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                frame = self.frames.popleft()
+                self.condition.notify_all()
+            yield frame
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Localizes drone frames from a video file or a watched folder as they arrive")
+    source_group = parser.add_mutually_exclusive_group(required=True)
+    source_group.add_argument('--video', help="video file")
+    source_group.add_argument('--watch', help="folder where the drone images land")
+    parser.add_argument('--metadata', default=None,
+                        help="csv file in the photo_metadata.csv format: by filename for --watch, by time in seconds for --video")
+    parser.add_argument('--policy', choices=POLICIES, default='latest', help="what to drop when the localizer falls behind")
+    parser.add_argument('--queue', type=int, default=4, help="maximum number of frames waiting to be localized")
+    parser.add_argument('--every', type=int, default=1, help="only localize one frame out of every N")
+    args = parser.parse_args()
+
+    wildnav.setup_instrumentation()
+    localizer = wildnav.create_localizer()
+    satellite_map = wildnav.load_satellite_map(localizer)
+    tracker = wildnav.tracking.Tracker(wildnav.tracking_max_misses) if wildnav.tracking_mode else None
+    controller = wildnav.create_latency_controller(localizer)
+
+    if args.video is not None:
+        source = video_frames(args.video, args.metadata)
+    else:
+        source = watch_folder(args.watch, args.metadata)
+    queue = FrameQueue(source, args.queue, args.policy, args.every)
+    wildnav.results_buffer_size = 1 # results are written as soon as they are known
+    results = wildnav.open_results()
+
+    try:
+        for drone_image in queue:
+            wildnav.localize_drone_image(drone_image, localizer, satellite_map, tracker, controller)
+            results.write(drone_image)
+            # the frame latency is the query span of the instrumentation
+            instrumentation.value('frames_dropped', queue.dropped, received=queue.received)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        results.close()
+    print("%d frames received, %d dropped" % (queue.received, queue.dropped))
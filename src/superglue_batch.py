@@ -0,0 +1,225 @@
+"""Batched superglue inference: matches several image pairs with different numbers of keypoints in one forward pass"""
+import torch
+
+from superglue_lib.models.superglue import normalize_keypoints, arange_like
+
+############################################################################################################
+# The superglue model only supports batches of pairs with the same number of keypoints. Here the keypoint
+# sets of all the pairs are padded to the same size and every attention and optimal transport step masks
+# out the padding, using the weights of the superglue module of Matching. The padded entries contribute
+# exact zeros, so every pair gets the same matches and scores as when it is matched on its own (up to
+# floating point summation order). matches_superglue() checks it against the superglue module on random pairs
+# of different sizes; the Localizer matches the pairs one by one if it does not hold.
+############################################################################################################
+
+NUM_HEADS = 4 # attention heads of the superglue GNN layers
+
+
+def pair_sizes(item):
+    """Number of keypoints of both images of a pair in the input format of superglue Matching"""
+    return item['keypoints0'][0].shape[0], item['keypoints1'][0].shape[0]
+
+
+def estimate_memory(sizes):
+    """Rough estimate (bytes) of the largest intermediate tensors when matching the pairs with the given sizes"""
+    if not sizes:
+        return 0
+    num_keypoints = max(max(n0, n1) for n0, n1 in sizes)
+    # attention scores and probabilities of one layer + sinkhorn couplings, float32
+    return len(sizes) * 4 * (2 * NUM_HEADS * num_keypoints * num_keypoints + 3 * (num_keypoints + 1) ** 2)
+
+
+def split_batches(items, batch_size, max_memory=None, key=None):
+    """Splits the pairs into consecutive batches of at most batch_size pairs and max_memory bytes.
+    key: function returning the superglue input of an item, for items that carry more than the input.
+    """
+    if key is None:
+        key = lambda item: item
+    batch = []
+    for item in items:
+        if batch and (len(batch) >= batch_size or (max_memory is not None and
+                      estimate_memory([pair_sizes(key(x)) for x in batch + [item]]) > max_memory)):
+            yield batch
+            batch = []
+        batch.append(item)
+    if batch:
+        yield batch
+
+
+def _pad(items, suffix, device):
+    """Stacks the keypoints, scores and descriptors of one image of every pair, padded to the same size"""
+    sizes = [item['keypoints' + suffix][0].shape[0] for item in items]
+    length = max(sizes)
+    dim = items[0]['descriptors' + suffix][0].shape[0]
+    kpts = torch.zeros((len(items), length, 2), device=device)
+    scores = torch.zeros((len(items), length), device=device)
+    desc = torch.zeros((len(items), dim, length), device=device)
+    mask = torch.zeros((len(items), length), dtype=torch.bool, device=device)
+    for i, (item, size) in enumerate(zip(items, sizes)):
+        kpts[i, :size] = normalize_keypoints(item['keypoints' + suffix][0][None], item['image' + suffix].shape)[0]
+        scores[i, :size] = item['scores' + suffix][0]
+        desc[i, :, :size] = item['descriptors' + suffix][0]
+        mask[i, :size] = True
+    return kpts, scores, desc, mask, sizes
+
+
+def _propagate(layer, x, source, source_mask):
+    """AttentionalPropagation forward pass that ignores the padded keypoints of the source"""
+    attn = layer.attn
+    batch_dim = x.size(0)
+    query, key, value = [l(t).view(batch_dim, attn.dim, attn.num_heads, -1)
+                         for l, t in zip(attn.proj, (x, source, source))]
+    scores = torch.einsum('bdhn,bdhm->bhnm', query, key) / attn.dim**.5
+    scores = scores.masked_fill(~source_mask[:, None, None, :], float('-inf'))
+    prob = torch.nn.functional.softmax(scores, dim=-1)
+    message = torch.einsum('bhnm,bdhm->bdhn', prob, value)
+    message = attn.merge(message.contiguous().view(batch_dim, attn.dim*attn.num_heads, -1))
+    return layer.mlp(torch.cat([x, message], dim=1))
+
+
+def _log_optimal_transport(scores, alpha, iters, mask0, mask1):
+    """superglue log_optimal_transport with a different number of points for every pair of the batch"""
+    b, m, n = scores.shape
+    ms, ns = mask0.sum(1).to(scores), mask1.sum(1).to(scores)
+    bins0 = alpha.expand(b, m, 1)
+    bins1 = alpha.expand(b, 1, n)
+    alpha = alpha.expand(b, 1, 1)
+    couplings = torch.cat([torch.cat([scores, bins0], -1),
+                           torch.cat([bins1, alpha], -1)], 1)
+    # padded rows / columns get a finite very low score, so that they contribute exact zeros
+    # without producing NaNs when their whole row or column is padding
+    valid0 = torch.cat([mask0, mask0.new_ones((b, 1))], 1)
+    valid1 = torch.cat([mask1, mask1.new_ones((b, 1))], 1)
+    couplings = couplings.masked_fill(~(valid0[:, :, None] & valid1[:, None, :]), -1e9)
+
+    norm = - (ms + ns).log()
+    log_mu = torch.cat([norm[:, None].expand(b, m), (ns.log() + norm)[:, None]], 1)
+    log_nu = torch.cat([norm[:, None].expand(b, n), (ms.log() + norm)[:, None]], 1)
+    log_mu = log_mu.masked_fill(~valid0, float('-inf'))
+    log_nu = log_nu.masked_fill(~valid1, float('-inf'))
+
+    u, v = torch.zeros_like(log_mu), torch.zeros_like(log_nu)
+    for _ in range(iters):
+        u = log_mu - torch.logsumexp(couplings + v.unsqueeze(1), dim=2)
+        v = log_nu - torch.logsumexp(couplings + u.unsqueeze(2), dim=1)
+    return couplings + u.unsqueeze(2) + v.unsqueeze(1) - norm[:, None, None]
+
+
+def _select_matches(scores, match_threshold):
+    """superglue match selection (mutual check + threshold) for a single pair, scores without dustbins"""
+    max0, max1 = scores.max(2), scores.max(1)
+    indices0, indices1 = max0.indices, max1.indices
+    mutual0 = arange_like(indices0, 1)[None] == indices1.gather(1, indices0)
+    mutual1 = arange_like(indices1, 1)[None] == indices0.gather(1, indices1)
+    zero = scores.new_tensor(0)
+    mscores0 = torch.where(mutual0, max0.values.exp(), zero)
+    mscores1 = torch.where(mutual1, mscores0.gather(1, indices1), zero)
+    valid0 = mutual0 & (mscores0 > match_threshold)
+    valid1 = mutual1 & valid0.gather(1, indices1)
+    indices0 = torch.where(valid0, indices0, indices0.new_tensor(-1))
+    indices1 = torch.where(valid1, indices1, indices1.new_tensor(-1))
+    return {
+        'matches0': indices0,
+        'matches1': indices1,
+        'matching_scores0': mscores0,
+        'matching_scores1': mscores1,
+    }
+
+
+def batch_scores(superglue, kpts0, scores0, desc0, mask0, kpts1, scores1, desc1, mask1):
+    """
+    Superglue network on a padded batch: normalized keypoints, keypoint scores, descriptors and padding
+    masks of both images of every pair. Returns the log optimal transport scores, with the dustbins.
+    """
+    # Keypoint MLP encoder, pointwise so the padding does not leak into the real keypoints
+    desc0 = desc0 + superglue.kenc(kpts0, scores0)
+    desc1 = desc1 + superglue.kenc(kpts1, scores1)
+
+    # Multi-layer Transformer network with masked attention
+    gnn = superglue.gnn
+    for layer, name in zip(gnn.layers, gnn.names):
+        if name == 'cross':
+            src0, src1, src_mask0, src_mask1 = desc1, desc0, mask1, mask0
+        else:
+            src0, src1, src_mask0, src_mask1 = desc0, desc1, mask0, mask1
+        delta0, delta1 = _propagate(layer, desc0, src0, src_mask0), _propagate(layer, desc1, src1, src_mask1)
+        desc0, desc1 = (desc0 + delta0), (desc1 + delta1)
+
+    # Final MLP projection and matching descriptor distance
+    mdesc0, mdesc1 = superglue.final_proj(desc0), superglue.final_proj(desc1)
+    scores = torch.einsum('bdn,bdm->bnm', mdesc0, mdesc1)
+    scores = scores / superglue.config['descriptor_dim']**.5
+
+    return _log_optimal_transport(scores, superglue.bin_score, superglue.config['sinkhorn_iterations'], mask0, mask1)
+
+
+def match_batch(superglue, items, scores_function=None):
+    """
+    Runs superglue on a list of image pairs in one forward pass.
+    items: pairs in the input format of superglue Matching with precomputed features
+    (keypoints0/1, scores0/1, descriptors0/1, image0/1), one image per pair.
+    scores_function: computes the optimal transport scores of the padded batch like batch_scores() (without the
+    superglue argument), e.g. a compiled graph of it (see backends.py); None runs batch_scores().
+    Returns one prediction per pair, in the format of the superglue output for a single pair.
+    """
+    preds = [None] * len(items)
+    # pairs without keypoints on one side have no matches, as in superglue
+    empty = [i for i, item in enumerate(items) if 0 in pair_sizes(item)]
+    for i in empty:
+        n0, n1 = pair_sizes(items[i])
+        kpts0, kpts1 = items[i]['keypoints0'][0], items[i]['keypoints1'][0]
+        preds[i] = {
+            'matches0': kpts0.new_full((1, n0), -1, dtype=torch.int),
+            'matches1': kpts1.new_full((1, n1), -1, dtype=torch.int),
+            'matching_scores0': kpts0.new_zeros((1, n0)),
+            'matching_scores1': kpts1.new_zeros((1, n1)),
+        }
+    batch = [i for i in range(len(items)) if i not in empty]
+    if not batch:
+        return preds
+
+    device = items[batch[0]]['keypoints0'][0].device
+    kpts0, scores0, desc0, mask0, sizes0 = _pad([items[i] for i in batch], '0', device)
+    kpts1, scores1, desc1, mask1, sizes1 = _pad([items[i] for i in batch], '1', device)
+    if scores_function is None:
+        scores = batch_scores(superglue, kpts0, scores0, desc0, mask0, kpts1, scores1, desc1, mask1)
+    else:
+        scores = scores_function(kpts0, scores0, desc0, mask0, kpts1, scores1, desc1, mask1)
+
+    for j, i in enumerate(batch):
+        pair_scores = scores[j:j+1, :sizes0[j], :sizes1[j]]
+        preds[i] = _select_matches(pair_scores, superglue.config['match_threshold'])
+    return preds
+
+
+def _random_pair(generator, dim, n0, n1, device):
+    """Superglue input of a random pair whose images share about half of their keypoints"""
+    common = min(n0, n1) // 2
+    kpts = torch.rand((n0 + n1 - common, 2), generator=generator) * torch.tensor([320., 240.])
+    desc = torch.nn.functional.normalize(torch.randn((dim, n0 + n1 - common), generator=generator), dim=0)
+    kpts1 = kpts[n0 - common:] + torch.randn((n1, 2), generator=generator)
+    desc1 = torch.nn.functional.normalize(desc[:, n0 - common:] + 0.1 * torch.randn((dim, n1), generator=generator), dim=0)
+    item = {'image0': torch.zeros((1, 1, 240, 320)), 'image1': torch.zeros((1, 1, 240, 320)),
+            'keypoints0': kpts[None, :n0], 'keypoints1': kpts1[None],
+            'scores0': torch.rand((1, n0), generator=generator), 'scores1': torch.rand((1, n1), generator=generator),
+            'descriptors0': desc[None, :, :n0], 'descriptors1': desc1[None]}
+    return {name: tensor.to(device) for name, tensor in item.items()}
+
+
+def matches_superglue(superglue, device, sizes=((23, 66), (70, 12), (41, 35)), rtol=1e-5, atol=1e-7):
+    """
+    True if match_batch() gives the matches and matching scores of the superglue module run on every pair alone,
+    on a batch of random pairs with the given numbers of keypoints. The matching scores of random pairs are
+    low (about 1 / keypoints), so the tolerance is tight: attention leaking into the padding changes them by ~1e-6.
+    """
+    generator = torch.Generator().manual_seed(0)
+    items = [_random_pair(generator, superglue.config['descriptor_dim'], n0, n1, device) for n0, n1 in sizes]
+    with torch.no_grad():
+        preds = match_batch(superglue, items)
+        for item, pred in zip(items, preds):
+            expected = superglue(item)
+            if not all(torch.equal(expected[name], pred[name]) for name in ('matches0', 'matches1')) or \
+                    not all(torch.allclose(expected[name], pred[name], rtol=rtol, atol=atol)
+                            for name in ('matching_scores0', 'matching_scores1')):
+                return False
+    return True
@@ -1,3 +1,4 @@
+import os
 from pathlib import Path
 import cv2
 import matplotlib.cm as cm
@@ -6,222 +7,481 @@ import numpy as np
 
 
 from superglue_lib.models.matching import Matching
-from superglue_lib.models.utils import (AverageTimer, VideoStreamer,
-                          make_matching_plot_fast, frame2tensor)
+from superglue_lib.models.utils import (make_matching_plot_fast,
+                          frame2tensor, process_resize)
+from feature_cache import TileFeatures
+import superglue_batch
+import instrumentation
+import quantization
+import backends
 
 torch.set_grad_enabled(False)
 
 
-def match_image(): 
+class Localizer:
     """
-    Wrapper function for matching two images, provides an interface to superglue model
+    Matching session that owns the superglue model, the device and the matching config.
+    The model weights are loaded once when the session is created and reused by every
+    call to match_image(), instead of being loaded again for every drone photo.
     """
-    center = None
-    input = '../assets/map/'
-    output_dir = "../results"
-    image_glob = ['*.png', '*.jpg', '*.jpeg', '*.JPG']
-    skip = 1
-    max_length = 1000000
-
-
-    # Important parameters to modify if you wish to improve the feature matching performance. 
-    resize = [800] # Resize the image to this size before processing. Set to None to disable resizing.
-    superglue = 'outdoor' # The SuperGlue model to use. Either 'indoor' or 'outdoor'.
-    max_keypoints = -1 # -1 keep all keypoints  
-    keypoint_threshold = 0.01 # Remove keypoints with low confidence. Set to -1 to keep all keypoints.
-    nms_radius = 4 # Non-maxima suppression: keypoints with similar responses in a small neighborhood are removed.
-    sinkhorn_iterations = 20 # Number of Sinkhorn iterations for matching.
-    match_threshold = 0.5 # Remove matches with low confidence. Set to -1 to keep all matches.
-    show_keypoints = True # Show the detected keypoints.
-    no_display = False
-    force_cpu = False # Force CPU mode. It is significantly slower, but allows the model to run on systems withou dedicated GPU.
-    
-   
-    if len(resize) == 2 and resize[1] == -1:
-        resize = resize[0:1]
-    if len(resize) == 2:
-        print('Will resize to {}x{} (WxH)'.format(
-            resize[0], resize[1]))
-    elif len(resize) == 1 and resize[0] > 0:
-        print('Will resize max dimension to {}'.format(resize[0]))
-    elif len(resize) == 1:
-        print('Will not resize images')
-    else:
-        raise ValueError('Cannot specify more than two integers for --resize')
-
-    
-    device = 'cuda' if torch.cuda.is_available() and not force_cpu else 'cpu'
-    print('Running inference on device \"{}\"'.format(device))
-    config = {
-        'superpoint': {
-            'nms_radius': nms_radius,
-            'keypoint_threshold': keypoint_threshold,
-            'max_keypoints': max_keypoints
-        },
-        'superglue': {
-            'weights': superglue,
-            'sinkhorn_iterations': sinkhorn_iterations,
-            'match_threshold': match_threshold,
+    def __init__(self, resize=None, superglue='outdoor', max_keypoints=-1, keypoint_threshold=0.01,
+                 nms_radius=4, sinkhorn_iterations=20, match_threshold=0.5, show_keypoints=True,
+                 no_display=False, force_cpu=False, input='../assets/map/', output_dir="../results",
+                 batch_size=1, max_batch_memory=512, early_exit=None, trace=False, precision='fp32',
+                 backend='eager', compiled_dir='../assets/compiled/'):
+        # Important parameters to modify if you wish to improve the feature matching performance. 
+        # resize: Resize the image to this size before processing. Set to None to disable resizing.
+        # superglue: The SuperGlue model to use. Either 'indoor' or 'outdoor'.
+        # max_keypoints: -1 keep all keypoints
+        # keypoint_threshold: Remove keypoints with low confidence. Set to -1 to keep all keypoints.
+        # nms_radius: Non-maxima suppression: keypoints with similar responses in a small neighborhood are removed.
+        # sinkhorn_iterations: Number of Sinkhorn iterations for matching.
+        # match_threshold: Remove matches with low confidence. Set to -1 to keep all matches.
+        # show_keypoints: Show the detected keypoints.
+        # force_cpu: Force CPU mode. It is significantly slower, but allows the model to run on systems withou dedicated GPU.
+        # batch_size: Number of map tiles matched in one superglue forward pass. 1 matches the tiles one by one.
+        # max_batch_memory: Approximate memory cap in MB of a batched superglue forward pass, smaller batches are used above it.
+        # early_exit: EarlyExit policy, stops matching the remaining tiles once a tile gives a confident match. None matches every tile.
+        # trace: Debug output of every tile pair: draw the matches, show them (unless no_display) and write them to output_dir.
+        #        Without it nothing is drawn, shown or written during the search and no GUI is needed.
+        # precision: 'fp32', or int8 inference on the CPU (see quantization.py): 'dynamic' quantizes superglue, 'static'
+        #            superpoint too, calibrated on the first images in input.
+        # backend: 'eager', or 'torchscript' to run compiled graphs of the fp32 models (see backends.py), cached in compiled_dir.
+        if resize is None:
+            resize = [800]
+        self.input = input
+        self.output_dir = output_dir
+        self.image_glob = ['*.png', '*.jpg', '*.jpeg', '*.JPG']
+        self.skip = 1
+        self.max_length = 1000000
+        self.show_keypoints = show_keypoints
+        self.no_display = no_display
+        self.batch_size = batch_size
+        self.max_batch_memory = max_batch_memory
+        self.early_exit = early_exit
+        self.trace = trace
+        self.query_resize = None # resize of the query images, None uses resize (see latency_budget.py)
+        self.tile_max_keypoints = -1 # only the strongest keypoints of the map tiles are matched, -1 matches all of them
+        self.query_max_keypoints = -1 # only the strongest keypoints of the query images are matched, -1 matches all of them
+        self.query_keypoints = 0 # keypoints and pixels of the last query image
+        self.query_pixels = 0
+        self.batcher = None # runs the superglue batches together with the ones of concurrent requests (see service.py)
+
+        if len(resize) == 2 and resize[1] == -1:
+            resize = resize[0:1]
+        if len(resize) == 2:
+            print('Will resize to {}x{} (WxH)'.format(
+                resize[0], resize[1]))
+        elif len(resize) == 1 and resize[0] > 0:
+            print('Will resize max dimension to {}'.format(resize[0]))
+        elif len(resize) == 1:
+            print('Will not resize images')
+        else:
+            raise ValueError('Cannot specify more than two integers for --resize')
+        self.resize = resize
+
+        self.precision = precision
+        # quantized models only run on the CPU
+        self.device = 'cuda' if torch.cuda.is_available() and not force_cpu and precision == 'fp32' else 'cpu'
+        print('Running inference on device \"{}\"'.format(self.device))
+        self.config = {
+            'superpoint': {
+                'nms_radius': nms_radius,
+                'keypoint_threshold': keypoint_threshold,
+                'max_keypoints': max_keypoints
+            },
+            'superglue': {
+                'weights': superglue,
+                'sinkhorn_iterations': sinkhorn_iterations,
+                'match_threshold': match_threshold,
+            }
         }
-    }
-    matching = Matching(config).eval().to(device)
-    keys = ['keypoints', 'scores', 'descriptors']
-
-    vs = VideoStreamer(input, resize, skip,
-                       image_glob, max_length)
-    frame, ret = vs.next_frame()
-    assert ret, 'Error when reading the first frame (try different --input?)'
-
-    frame_tensor = frame2tensor(frame, device)
-    last_data = matching.superpoint({'image': frame_tensor})
-    last_data = {k+'0': last_data[k] for k in keys}
-    last_data['image0'] = frame_tensor
-    last_frame = frame
-    last_image_id = 0
-
-    if output_dir is not None:
-        print('==> Will write outputs to {}'.format(output_dir))
-        Path(output_dir).mkdir(exist_ok=True)
-
-    # Create a window to display the demo.
-    if not no_display:
-        cv2.namedWindow('SuperGlue matches', cv2.WINDOW_NORMAL)
-        cv2.resizeWindow('SuperGlue matches', 640*2*2, 480*2)
-    else:
-        print('Skipping visualization, will not show a GUI.')
-
-    timer = AverageTimer()
-
-    satellite_map_index = None # index of the satellite photo in the map where the best match was found
-    index = 0 # index of the sattelite photo if a match was found
-    max_matches = -1 # max number of matches, used to keep track of the best match
-    MATCHED = False # flag to indicate if a match was found
-    located_image = None # the image of the satellite photo where the best match was found
-    features_mean = [0,0] # mean values of feature pixel coordinates 
-
-    while True:
-        
-        #current sattelite image to be matched
-        frame, ret = vs.next_frame()
-        if not ret:
-            print('Finished demo_superglue.py')
-            break
-        timer.update('data')
-        stem0, stem1 = last_image_id, vs.i - 1
-
-
-        
-
-        frame_tensor = frame2tensor(frame, device)
-        pred = matching({**last_data, 'image1': frame_tensor})
-        kpts0 = last_data['keypoints0'][0].cpu().numpy()
-        kpts1 = pred['keypoints1'][0].cpu().numpy()
-        matches = pred['matches0'][0].cpu().numpy()
-        confidence = pred['matching_scores0'][0].cpu().numpy()
-        timer.update('forward')
-
-        valid = matches > -1
-        mkpts0 = kpts0[valid]
-        mkpts1 = kpts1[matches[valid]]
+        self.matching = Matching(self.config).eval().to(self.device)
+        if precision != 'fp32':
+            if backend != 'eager':
+                raise ValueError("The %s backend runs fp32 models, not %s ones" % (backend, precision))
+            calibration_images = self.calibration_images() if precision == 'static' else None
+            quantization.quantize_matching(self.matching, precision, calibration_images)
+        # compiled superglue batches, None runs them eagerly
+        self.batch_scores = backends.compile_matching(self.matching, backend, compiled_dir, self.device)
+        self.batches_match = None # the padded superglue batches give the matches of single pairs, see check_batches()
+        if batch_size > 1 or self.batch_scores is not None:
+            self.check_batches()
 
+    def check_batches(self):
         """
-        Find image in sattelite map with findHomography        
+        Checks once that the padded superglue batches give the matches of superglue on single pairs (the compiled
+        graph is checked against the padded batches by backends.py); if not, the pairs are matched one by one.
         """
-        #At least 4 matched features are needed to compute homography
-        MATCHED = False
-        print("Matches found:", len(mkpts1))
-        if (len(mkpts1) >= 4): 
-            perspective_tranform_error = False           
-            M, mask = cv2.findHomography(mkpts0, mkpts1, cv2.RANSAC,5.0)
-            h,w = last_frame.shape
-            pts = np.float32([ [0,0],[0,h-1],[w-1,h-1],[w-1,0] ]).reshape(-1,1,2)
-            try: 
-                dst = cv2.perspectiveTransform(pts,M)
-            except:
-                print("Perspective transform error. Abort matching.")
-                perspective_tranform_error = True    
-
-            if (len(mkpts1) > max_matches) and not perspective_tranform_error: 
-                frame = cv2.polylines(frame,[np.int32(dst)],True,255,3, cv2.LINE_AA) 
-                moments = cv2.moments(dst)
-                cX = int(moments["m10"] / moments["m00"])
-                cY = int(moments["m01"] / moments["m00"])
-                center = (cX  ,cY) #shape[0] is Y coord, shape[1] is X coord
-                #use ratio here instead of pixels because image is reshaped in superglue
-                features_mean = np.mean(mkpts0, axis = 0)
-
-                #Draw the center of the area which has been matched
-                cv2.circle(frame, center, radius = 10, color = (255, 0, 255), thickness = 5)
-                cv2.circle(last_frame, (int(features_mean[0]), int(features_mean[1])), radius = 10, color = (255, 0, 0), thickness = 2)
-                center = (cX / frame.shape[1] ,cY /frame.shape[0] )
-                satellite_map_index = index
-                max_matches = len(mkpts1)
-                MATCHED = True
+        if self.batches_match is None:
+            self.batches_match = superglue_batch.matches_superglue(self.matching.superglue, self.device)
+            if not self.batches_match:
+                print("Batched superglue does not give the matches of superglue on single pairs, matching the pairs one by one")
+                self.batch_size = 1
+                self.batch_scores = None
+        return self.batches_match
 
-        else:
-            print("Photos were NOT matched")
-      
-        color = cm.jet(confidence[valid])
-        k_thresh = matching.superpoint.config['keypoint_threshold']
-        m_thresh = matching.superglue.config['match_threshold']
-        small_text = [
-            'Keypoint Threshold: {:.4f}'.format(k_thresh),
-            'Match Threshold: {:.2f}'.format(m_thresh),
-            'Image Pair: {:06}:{:06}'.format(stem0, stem1),
-        ]
-     
-        out = make_matching_plot_fast(
-            last_frame, frame, kpts0, kpts1, mkpts0, mkpts1, color, text='',
-            path=None, show_keypoints=show_keypoints, small_text='')
+    def calibration_images(self):
+        """Image tensors to calibrate the static quantization with: up to CALIBRATION_IMAGES images of input, evenly spaced"""
+        filenames = sorted(str(path) for pattern in self.image_glob for path in Path(self.input).glob(pattern))
+        if not filenames:
+            raise ValueError("No images in %s to calibrate the static quantization with" % self.input)
+        step = max(1, len(filenames) // quantization.CALIBRATION_IMAGES)
+        return [frame2tensor(self.read_image(filename), self.device)
+                for filename in filenames[::step][:quantization.CALIBRATION_IMAGES]]
+
+    def read_image(self, filename):
+        """Reads an image as grayscale and resizes it the same way superglue VideoStreamer does"""
+        grayim = cv2.imread(filename, 0)
+        if grayim is None:
+            raise IOError('Error reading image %s' % filename)
+        w_new, h_new = process_resize(grayim.shape[1], grayim.shape[0], self.resize)
+        return cv2.resize(grayim, (w_new, h_new), interpolation=cv2.INTER_AREA)
+
+    def extract_features(self, frame):
+        """Runs superpoint on a grayscale frame, returns keypoints, scores and descriptors as numpy arrays"""
+        pred = self.matching.superpoint({'image': frame2tensor(frame, self.device)})
+        return (pred['keypoints'][0].cpu().numpy(), pred['scores'][0].cpu().numpy(),
+                pred['descriptors'][0].cpu().numpy())
+
+    def prepare_query(self, query, resize=None):
+        """Converts an in-memory query image (BGR or grayscale) to the grayscale resized frame used for matching"""
+        if query.ndim == 3:
+            query = cv2.cvtColor(query, cv2.COLOR_BGR2GRAY)
+        w_new, h_new = process_resize(query.shape[1], query.shape[0], resize or self.resize)
+        return cv2.resize(query, (w_new, h_new), interpolation=cv2.INTER_AREA)
 
-        if MATCHED == True:
-            located_image = out
-        
+    def tile_features(self, filename):
+        """Extracts the features of a satellite image without going through the map feature cache"""
+        frame = self.read_image(filename)
+        return TileFeatures(filename, *self.extract_features(frame), frame.shape, image=frame)
 
+    def tile_image(self, tile):
+        """Grayscale resized image of a tile, used for drawing; read from disk if the tile does not hold it"""
+        if tile.image is not None:
+            return tile.image.copy()
+        if tile.reader is not None:
+            return tile.reader()
+        return self.read_image(tile.filename)
+
+    def extract_query(self, query):
+        """Prepares an in-memory query image and runs superpoint on it.
+        Returns the grayscale resized frame and its features in the input format of superglue Matching.
+        """
+        keys = ['keypoints', 'scores', 'descriptors']
+        with instrumentation.span('superpoint'):
+            frame = self.prepare_query(query, self.query_resize)
+            frame_tensor = frame2tensor(frame, self.device)
+            data = self.matching.superpoint({'image': frame_tensor})
+            if 0 <= self.query_max_keypoints < len(data['keypoints'][0]):
+                # the superpoint config is left alone, the tile features extracted with it are cached
+                keep = torch.topk(data['scores'][0], self.query_max_keypoints).indices
+                data = {'keypoints': [data['keypoints'][0][keep]], 'scores': [data['scores'][0][keep]],
+                        'descriptors': [data['descriptors'][0][:, keep]]}
+        data = {k+'0': data[k] for k in keys}
+        data['image0'] = frame_tensor
+        self.query_keypoints, self.query_pixels = len(data['keypoints0'][0]), frame.size
+        instrumentation.value('query_keypoints', self.query_keypoints)
+        return frame, data
+
+    def predict(self, pairs, sent=None):
+        """
+        Runs superglue on (key, input) pairs, where input holds the features of both images in the input
+        format of superglue Matching. Yields (key, prediction) in the pair order.
+        sent: list the keys of the pairs are appended to when they are sent to superglue, also the ones of a
+        batch whose predictions the caller stops reading.
+        With batch_size > 1 several pairs are matched in one padded forward pass (see superglue_batch.py).
+        With a batcher the batches are handed to it, it may match them together with the pairs of other queries.
+        """
+        if self.batch_size <= 1 and self.batch_scores is None and self.batcher is None:
+            for key, item in pairs:
+                if sent is not None:
+                    sent.append(key)
+                with instrumentation.span('superglue', pairs=1):
+                    pred = self.matching(item)
+                yield key, pred
+            return
+
+        max_memory = self.max_batch_memory * 2**20 if self.max_batch_memory is not None else None
+        for batch in superglue_batch.split_batches(pairs, self.batch_size, max_memory, key=lambda pair: pair[1]):
+            if sent is not None:
+                sent.extend(key for key, _ in batch)
+            if self.batcher is not None:
+                preds = self.batcher.match([item for _, item in batch])
+            else:
+                with instrumentation.span('superglue', pairs=len(batch)):
+                    preds = superglue_batch.match_batch(self.matching.superglue, [item for _, item in batch], self.batch_scores)
+            for (key, _), pred in zip(batch, preds):
+                yield key, pred
+
+    def match(self, query, tiles, query_data=None):
+        """
+        Matches a query image against the given satellite map tiles, entirely in memory.
+        query: drone photo as a numpy array (BGR or grayscale)
+        tiles: list of feature_cache.TileFeatures, the index of the returned MatchResult refers to this list;
+        they are matched in this order, so with an early exit policy the most likely tiles should come first
+        query_data: output of extract_query(query) if it was already computed
+        Without tracing nothing is drawn during the search, the best match is only drawn
+        if the located_image of the returned MatchResult is read.
+        """
+        if query_data is None:
+            query_data = self.extract_query(query)
+        return self.match_variants([query_data], tiles)
+
+    def match_variants(self, variants, tiles):
+        """
+        Matches several versions of the query image (e.g. rotated) against the map tiles in one pass.
+        variants: outputs of extract_query() of every version of the query image
+        Every tile is matched against all the variants (in the same superglue batch when batching)
+        before moving on to the next tile. The returned MatchResult is the best match over all the
+        variants and tiles, its variant attribute is the index of the variant it was found with.
+        """
+        output_dir = self.output_dir
+        matching = self.matching
+        show_keypoints = self.show_keypoints
+        no_display = self.no_display or not self.trace
+
+        # the query frames are copied because tracing draws on them
+        variants = [(frame.copy(), data, data['keypoints0'][0].cpu().numpy()) for frame, data in variants]
+
+        if self.trace and output_dir is not None:
+            print('==> Will write outputs to {}'.format(output_dir))
+            Path(output_dir).mkdir(exist_ok=True)
+
+        # Create a window to display the demo.
         if not no_display:
-            cv2.imshow('SuperGlue matches', out)
-            key = chr(cv2.waitKey(1) & 0xFF)
-            if key == 'q':
-                vs.cleanup()
-                print('Exiting (via q) demo_superglue.py')
+            cv2.namedWindow('SuperGlue matches', cv2.WINDOW_NORMAL)
+            cv2.resizeWindow('SuperGlue matches', 640*2*2, 480*2)
+        elif self.trace:
+            print('Skipping visualization, will not show a GUI.')
+
+        def pairs():
+            for index, tile in enumerate(tiles):
+                tile = tile.strongest(self.tile_max_keypoints)
+                tile_data = tile.to_data(self.device)
+                for variant, (_, data, _) in enumerate(variants):
+                    yield (variant, index, tile), {**data, **tile_data}
+
+        result = MatchResult(variants[0][0])
+        sent = [] # (variant, index, tile) of the pairs matched by superglue, even if the search stops before reading them
+
+        for (variant, index, tile), pred in self.predict(pairs(), sent):
+            last_frame, last_data, kpts0 = variants[variant]
+            kpts1 = tile.keypoints
+            matches = pred['matches0'][0].cpu().numpy()
+            confidence = pred['matching_scores0'][0].cpu().numpy()
+            stem0, stem1 = variant, index + 1
+
+            valid = matches > -1
+            mkpts0 = kpts0[valid]
+            mkpts1 = kpts1[matches[valid]]
+            if variant == 0:
+                instrumentation.value('tile_keypoints', len(kpts1), tile=index)
+            instrumentation.value('matches', len(mkpts1), tile=index, variant=variant)
+
+            """
+            Find image in sattelite map with findHomography        
+            """
+            #At least 4 matched features are needed to compute homography
+            MATCHED = False
+            if (len(mkpts1) >= 4): 
+                perspective_tranform_error = False           
+                with instrumentation.span('homography', tile=index, variant=variant):
+                    M, mask = cv2.findHomography(mkpts0, mkpts1, cv2.RANSAC,5.0)
+                inliers = np.count_nonzero(mask) if mask is not None else 0
+                inlier_ratio = float(inliers) / len(mask) if mask is not None else 0.0
+                instrumentation.value('inliers', inliers, tile=index, variant=variant)
+                h,w = last_frame.shape
+                pts = np.float32([ [0,0],[0,h-1],[w-1,h-1],[w-1,0] ]).reshape(-1,1,2)
+                try: 
+                    dst = cv2.perspectiveTransform(pts,M)
+                except:
+                    instrumentation.count('perspective_transform_errors', tile=index, variant=variant)
+                    perspective_tranform_error = True    
+
+                if (len(mkpts1) > result.num_matches) and not perspective_tranform_error: 
+                    moments = cv2.moments(dst)
+                    cX = int(moments["m10"] / moments["m00"])
+                    cY = int(moments["m01"] / moments["m00"])
+                    #use ratio here instead of pixels because image is reshaped in superglue
+                    features_mean = np.mean(mkpts0, axis = 0)
+
+                    result.center = (cX / tile.shape[1] ,cY / tile.shape[0] )
+                    result.features_mean = features_mean
+                    result.tile_index = index
+                    result.variant = variant
+                    result.query_image = last_frame
+                    result.num_matches = len(mkpts1)
+                    result.inlier_ratio = inlier_ratio
+                    # keep what is needed to draw the match later, only if it is requested
+                    result.drawing = MatchDrawing(self, tile, kpts0, mkpts0, mkpts1, confidence[valid], dst, features_mean)
+                    MATCHED = True
+
+            if self.trace:
+                with instrumentation.span('visualization', tile=index, variant=variant):
+                    #current sattelite image to be matched
+                    frame = self.tile_image(tile)
+
+                    # the query frame is drawn on in place, so every match found so far stays marked on it
+                    if MATCHED:
+                        out = result.drawing.draw(last_frame, frame, show_keypoints)
+                        result.located_image = out
+                    else:
+                        color = cm.jet(confidence[valid])
+                        out = make_matching_plot_fast(
+                            last_frame, frame, kpts0, kpts1, mkpts0, mkpts1, color, text='',
+                            path=None, show_keypoints=show_keypoints, small_text='')
+
+                if not no_display:
+                    cv2.imshow('SuperGlue matches', out)
+                    key = chr(cv2.waitKey(1) & 0xFF)
+                    if key == 'q':
+                        print('Exiting (via q) demo_superglue.py')
+                        break
+                    elif key in ['e', 'r']:
+                        # Increase/decrease keypoint threshold by 10% each keypress.
+                        d = 0.1 * (-1 if key == 'e' else 1)
+                        matching.superpoint.config['keypoint_threshold'] = min(max(
+                            0.0001, matching.superpoint.config['keypoint_threshold']*(1+d)), 1)
+                        print('\nChanged the keypoint threshold to {:.4f}'.format(
+                            matching.superpoint.config['keypoint_threshold']))
+                    elif key in ['d', 'f']:
+                        # Increase/decrease match threshold by 0.05 each keypress.
+                        d = 0.05 * (-1 if key == 'd' else 1)
+                        matching.superglue.config['match_threshold'] = min(max(
+                            0.05, matching.superglue.config['match_threshold']+d), .95)
+                        print('\nChanged the match threshold to {:.2f}'.format(
+                            matching.superglue.config['match_threshold']))
+                    elif key == 'k':
+                        show_keypoints = not show_keypoints
+
+                if output_dir is not None:
+                    stem = 'matches_{:06}_{:06}'.format(stem0, stem1)
+                    out_file = str(Path(output_dir, stem + '.png'))
+                    print('\nWriting image to {}'.format(out_file))
+                    cv2.imwrite(out_file, out)
+
+            # Stop as soon as the best match so far is good enough, the remaining tiles are not matched
+            if MATCHED and self.early_exit is not None and \
+                    self.early_exit.is_confident(result.num_matches, result.inlier_ratio, result.center):
+                instrumentation.count('early_exits', tiles_skipped=len(tiles) - sent[-1][1] - 1)
                 break
-            elif key == 'n':  # set the current frame as anchor
-                last_data = {k+'0': pred[k+'1'] for k in keys}
-                last_data['image0'] = frame_tensor
-                last_frame = frame
-                last_image_id = (vs.i - 1)
-            elif key in ['e', 'r']:
-                # Increase/decrease keypoint threshold by 10% each keypress.
-                d = 0.1 * (-1 if key == 'e' else 1)
-                matching.superpoint.config['keypoint_threshold'] = min(max(
-                    0.0001, matching.superpoint.config['keypoint_threshold']*(1+d)), 1)
-                print('\nChanged the keypoint threshold to {:.4f}'.format(
-                    matching.superpoint.config['keypoint_threshold']))
-            elif key in ['d', 'f']:
-                # Increase/decrease match threshold by 0.05 each keypress.
-                d = 0.05 * (-1 if key == 'd' else 1)
-                matching.superglue.config['match_threshold'] = min(max(
-                    0.05, matching.superglue.config['match_threshold']+d), .95)
-                print('\nChanged the match threshold to {:.2f}'.format(
-                    matching.superglue.config['match_threshold']))
-            elif key == 'k':
-                show_keypoints = not show_keypoints
-
-        timer.update('viz')
-        timer.print()  
-        index += 1  
-
-        if output_dir is not None:
-            #stem = 'matches_{:06}_{:06}'.format(last_image_id, vs.i-1)
-            stem = 'matches_{:06}_{:06}'.format(stem0, stem1)
-            out_file = str(Path(output_dir, stem + '.png'))
-            print('\nWriting image to {}'.format(out_file))
-            cv2.imwrite(out_file, out)
-
-
-    cv2.destroyAllWindows()
-    vs.cleanup()
-    
-    return satellite_map_index, center, located_image, features_mean, last_frame, max_matches
-    
 
+        result.tiles_evaluated = sent[-1][1] + 1 if sent else 0
+
+        instrumentation.value('search_tiles_evaluated', result.tiles_evaluated, tiles=len(tiles))
+
+        if not no_display:
+            cv2.destroyAllWindows()
+
+        return result
+
+    def match_image(self, tile_features=None):
+        """
+        Matches the query image in the map folder against every satellite image of the map.
+        Kept for compatibility with the original script: the first image of the folder in
+        alphabetical order is the query (1_query_image.png), the other ones are the satellite images.
+        Satellite images found in tile_features (see feature_cache.load_map_features) reuse
+        their precomputed superpoint features, so only superglue runs for them.
+        """
+        listing = []
+        for pattern in self.image_glob:
+            listing += list(Path(self.input).glob(pattern))
+        listing.sort()
+        listing = listing[::self.skip][:self.max_length]
+        assert len(listing) > 0, 'Error when reading the first frame (try different --input?)'
+
+        cached_tiles = {os.path.normpath(tile.filename): tile for tile in (tile_features or [])}
+        tiles = []
+        for path in listing[1:]:
+            tile = cached_tiles.get(os.path.normpath(str(path)))
+            tiles.append(tile if tile is not None else self.tile_features(str(path)))
+
+        result = self.match(self.read_image(str(listing[0])), tiles)
+        return result.tile_index, result.center, result.located_image, result.features_mean, result.query_image, result.num_matches
+
+
+class MatchDrawing:
+    """Everything needed to draw a match between the query image and a tile, kept so it can be drawn after the search"""
+    def __init__(self, localizer, tile, kpts0, mkpts0, mkpts1, confidence, dst, features_mean):
+        self.localizer = localizer
+        self.tile = tile
+        self.kpts0 = kpts0
+        self.mkpts0 = mkpts0
+        self.mkpts1 = mkpts1
+        self.confidence = confidence # matching scores of the matched keypoints
+        self.dst = dst # corners of the query image projected on the tile
+        self.features_mean = features_mean
+
+    def draw(self, query_frame, frame, show_keypoints):
+        """Draws the match on the query and tile frames (in place) and returns the side by side visualization"""
+        dst = self.dst
+        frame = cv2.polylines(frame,[np.int32(dst)],True,255,3, cv2.LINE_AA) 
+        moments = cv2.moments(dst)
+        center = (int(moments["m10"] / moments["m00"]), int(moments["m01"] / moments["m00"]))
+
+        #Draw the center of the area which has been matched
+        cv2.circle(frame, center, radius = 10, color = (255, 0, 255), thickness = 5)
+        cv2.circle(query_frame, (int(self.features_mean[0]), int(self.features_mean[1])), radius = 10, color = (255, 0, 0), thickness = 2)
+
+        color = cm.jet(self.confidence)
+        return make_matching_plot_fast(
+            query_frame, frame, self.kpts0, self.tile.keypoints, self.mkpts0, self.mkpts1, color, text='',
+            path=None, show_keypoints=show_keypoints, small_text='')
+
+
+class MatchResult:
+    """Best match of a query image among the satellite map tiles"""
+    def __init__(self, query_image):
+        self.tile_index = None # index of the tile where the best match was found
+        self.variant = None # index of the query image variant of the best match
+        self.rotation = None # rotation of the query image of the best match in degrees, set by rotation.match_rotated()
+        self.query_data = None # extract_query() output of the query image of the best match, set by rotation.match_rotated()
+        self.center = None # center of the query image in the tile, relative to the tile size
+        self.drawing = None # MatchDrawing of the best match
+        self._located_image = None
+        self.features_mean = [0,0] # mean values of the matched feature pixel coordinates in the query image
+        self.query_image = query_image # grayscale resized query image
+        self.num_matches = -1 # number of matches of the best match, -1 if no match was found
+        self.inlier_ratio = 0.0 # fraction of the matches of the best match that are RANSAC inliers of its homography
+        self.tiles_evaluated = 0 # number of tiles matched before the search stopped
+
+    @property
+    def located_image(self):
+        """Visualization of the best match, drawn the first time it is requested"""
+        if self._located_image is None and self.drawing is not None:
+            drawing = self.drawing
+            self._located_image = drawing.draw(self.query_image.copy(), drawing.localizer.tile_image(drawing.tile),
+                                               drawing.localizer.show_keypoints)
+        return self._located_image
+
+    @located_image.setter
+    def located_image(self, image):
+        self._located_image = image
+
+
+class EarlyExit:
+    """
+    Early termination policy of the tile search: a match is confident enough to stop matching
+    the remaining tiles when it has at least min_matches matches, at least min_inlier_ratio of
+    them are RANSAC inliers of the homography and the center of the query image falls inside the tile.
+    """
+    def __init__(self, min_matches=100, min_inlier_ratio=0.5, require_valid_center=True):
+        self.min_matches = min_matches
+        self.min_inlier_ratio = min_inlier_ratio
+        self.require_valid_center = require_valid_center
+
+    def is_confident(self, num_matches, inlier_ratio, center):
+        if num_matches < self.min_matches or inlier_ratio < self.min_inlier_ratio:
+            return False
+        if self.require_valid_center:
+            return center is not None and 0 <= center[0] < 1 and 0 <= center[1] < 1
+        return True
+
+
+def match_image(): 
+    """
+    Wrapper function for matching two images, provides an interface to superglue model.
+    Builds a one-shot session; use a Localizer directly to keep the model loaded between calls.
+    """
+    return Localizer(trace=True).match_image()
@@ -0,0 +1,128 @@
+"""Sequential tracking: the position of the previous drone images predicts where to search for the next one"""
+import math
+
+import numpy as np
+
+from spatial_index import METERS_PER_DEGREE
+
+############################################################################################################
+# Constant velocity Kalman filter over the calculated positions of consecutive drone images, in meters
+# (east, north) around the first position of the track, one time step per drone image. Before every drone
+# image the filter predicts its position and uncertainty, and only the map tiles reaching into the gating
+# ellipse of the prediction are matched. After max_misses drone images in a row without a fix inside the
+# ellipse the track is dropped, and the next drone image is searched in the whole map again.
+############################################################################################################
+
+
+def _min_mahalanobis(inverse, x_range, y_range):
+    """
+    Smallest squared Mahalanobis distance (with the inverse covariance) from the origin to the
+    rectangle x_range x y_range. The quadratic form is convex, so if the origin is outside the
+    rectangle the minimum is on one of its edges, where it is a 1D quadratic.
+    """
+    (a, b), (_, c) = inverse
+    (x0, x1), (y0, y1) = x_range, y_range
+    if x0 <= 0 <= x1 and y0 <= 0 <= y1:
+        return 0.0
+    distances = []
+    for x in (x0, x1):
+        y = min(max(-b * x / c, y0), y1)
+        distances.append(a * x * x + 2 * b * x * y + c * y * y)
+    for y in (y0, y1):
+        x = min(max(-b * y / a, x0), x1)
+        distances.append(a * x * x + 2 * b * x * y + c * y * y)
+    return min(distances)
+
+
+class Tracker:
+    """
+    Constant velocity Kalman filter over the drone positions.
+    measurement_noise: standard deviation of the calculated positions (meters)
+    process_noise: standard deviation of the acceleration between drone images (meters / image^2)
+    initial_speed: standard deviation of the speed when a track starts (meters / image)
+    gate: size of the gating ellipse in standard deviations
+    max_misses: drone images in a row without a fix before the track is dropped
+    """
+    def __init__(self, max_misses=3, measurement_noise=20.0, process_noise=10.0, initial_speed=50.0, gate=3.0):
+        self.max_misses = max_misses
+        self.measurement_noise = measurement_noise
+        self.process_noise = process_noise
+        self.initial_speed = initial_speed
+        self.gate = gate
+        self.reset()
+
+    def reset(self):
+        self.origin = None # (latitude, longitude) of the local east / north frame
+        self.state = None # east, north, east speed, north speed
+        self.covariance = None
+        self.misses = 0
+
+    @property
+    def active(self):
+        return self.state is not None
+
+    def _to_local(self, latitude, longitude):
+        return np.array([(longitude - self.origin[1]) * METERS_PER_DEGREE * math.cos(math.radians(self.origin[0])),
+                         (latitude - self.origin[0]) * METERS_PER_DEGREE])
+
+    def _to_geo(self, east, north):
+        return (self.origin[0] + north / METERS_PER_DEGREE,
+                self.origin[1] + east / (METERS_PER_DEGREE * math.cos(math.radians(self.origin[0]))))
+
+    def position(self):
+        """Current (latitude, longitude) estimate of the track"""
+        return self._to_geo(*self.state[:2])
+
+    def predict(self):
+        """Moves the track to the next drone image, returns the predicted (latitude, longitude) or None without track"""
+        if not self.active:
+            return None
+        F = np.array([[1, 0, 1, 0], [0, 1, 0, 1], [0, 0, 1, 0], [0, 0, 0, 1]], float)
+        # white noise acceleration over one time step
+        Q = self.process_noise ** 2 * np.array([[1/4, 0, 1/2, 0], [0, 1/4, 0, 1/2], [1/2, 0, 1, 0], [0, 1/2, 0, 1]])
+        self.state = F @ self.state
+        self.covariance = F @ self.covariance @ F.T + Q
+        return self.position()
+
+    def innovation_covariance(self):
+        """Covariance (east, north) of the next calculated position around the prediction"""
+        return self.covariance[:2, :2] + self.measurement_noise ** 2 * np.eye(2)
+
+    def update(self, latitude, longitude):
+        """Corrects the track with a calculated position, or starts a new track"""
+        self.misses = 0
+        if not self.active:
+            self.origin = (latitude, longitude)
+            self.state = np.zeros(4)
+            self.covariance = np.diag([self.measurement_noise ** 2] * 2 + [self.initial_speed ** 2] * 2)
+            return
+        H = np.eye(2, 4)
+        S = self.innovation_covariance()
+        K = self.covariance @ H.T @ np.linalg.inv(S)
+        self.state = self.state + K @ (self._to_local(latitude, longitude) - self.state[:2])
+        self.covariance = (np.eye(4) - K @ H) @ self.covariance
+
+    def miss(self):
+        """No fix for the current drone image, drops the track after max_misses in a row"""
+        if not self.active:
+            return
+        self.misses += 1
+        if self.misses > self.max_misses:
+            print("Track lost after %d drone images without a fix" % self.misses)
+            self.reset()
+
+    def candidates(self, tile_grid):
+        """Indices of the map tiles reaching into the gating ellipse of the prediction, most likely first"""
+        S = self.innovation_covariance()
+        inverse = np.linalg.inv(S)
+        latitude, longitude = self.position()
+        radius = self.gate * math.sqrt(max(np.linalg.eigvalsh(S))) # circle around the ellipse
+        distances = {}
+        for index in tile_grid.query(latitude, longitude, radius):
+            min_lat, min_lon, max_lat, max_lon = tile_grid.bounds[index]
+            west, south = self._to_local(min_lat, min_lon) - self.state[:2]
+            east, north = self._to_local(max_lat, max_lon) - self.state[:2]
+            distance = _min_mahalanobis(inverse, (west, east), (south, north))
+            if distance <= self.gate ** 2:
+                distances[index] = distance
+        return sorted(distances, key=lambda index: (distances[index], index))
@@ -1,20 +1,76 @@
 """Core module. Contains the main functions for the project."""
 import csv
+import math
+import os
 import cv2
-import haversine as hs
-from haversine import Unit
 import superglue_utils
+import feature_cache
+from spatial_index import TileGrid
+import retrieval
+import rotation
+import map_pyramid
+import orthomosaic
+import tracking
+import parallel
+import instrumentation
+import results_store
+import latency_budget
 
 ############################################################################################################
 # Important variables
 ############################################################################################################
 
-map_path = "../assets/map/"
 map_filename = "../assets/map/map.csv" #  csv file with the sattelite geo tagged images
+orthomosaic_filename = None # single large georeferenced raster used as map instead of map_filename (see orthomosaic.py)
+orthomosaic_window_size = 1000 # size in pixels of the square orthomosaic windows matched like map tiles
+orthomosaic_window_overlap = 0.25 # overlap between neighbouring orthomosaic windows, as a fraction of their size
 drone_photos_filename = "../assets/query/photo_metadata.csv" # csv file with the geo tagged drone images;
                                                              # the geo coordinates are only used to compare
                                                              # the calculated coordinates with the real ones
                                                              # after the feature matching
+gnss_prior_radius = None # uncertainty of the drone GNSS coordinates in meters, e.g. 250: only the map tiles within this
+                         # distance are matched (the radius grows if none are found); None searches the whole map.
+                         # Opt-in: the GNSS coordinates of the sample drone images are also the ground truth the
+                         # results are evaluated against, so using them as a prior makes the accuracy optimistic
+superglue_batch_size = 8 # number of map tiles matched in one superglue forward pass; checked against superglue on single
+                         # pairs when the model is loaded, the tiles are matched one by one if the matches differ
+workers = 1 # number of worker processes localizing drone images in parallel, each one loads the model and the map
+threads_per_worker = None # torch threads of every worker process, None splits the CPU cores evenly between workers
+retrieval_top_k = None # when there is no GNSS prior, only the k map tiles with the most similar global descriptor
+                       # are matched, e.g. 5 (see retrieval.py to pick k for your map, a k that is too small loses
+                       # drone images); None matches every tile
+early_exit_min_matches = None # e.g. 100: the candidate tiles are matched most likely first (nearest to the GNSS prior
+                              # or most similar) and the search stops at the first tile with at least this many matches,
+                              # a center inside the tile and early_exit_min_inlier_ratio homography inliers; None matches
+                              # every candidate tile and keeps the one with the most matches
+early_exit_min_inlier_ratio = 0.5 # fraction of the matches that must be RANSAC inliers of the homography to stop early
+map_pyramid_levels = 0 # number of coarse levels of the map pyramid (see map_pyramid.py): the drone images are located
+                       # in merged, downsampled super-tiles first and only the map tiles inside the one they were
+                       # found in are matched; 0 matches the map tiles directly
+tracking_mode = False # the drone images come from a continuous flight, in order: the position of the previous ones
+                      # predicts where the next one is and only the map tiles around it are matched
+tracking_max_misses = 3 # drone images in a row without a fix before tracking falls back to the whole map search
+use_heading = False # de-rotate the drone images to north-up with the gimbal yaw from their metadata
+fallback_rotations = rotation.FALLBACK_ROTATIONS # rotations (degrees clockwise, relative to north-up with use_heading)
+                                                 # the first one is tried alone, the others in one pass if it gives no
+                                                 # confident match
+save_located_images = True # draw the best match of every located drone image and write it to ../results
+trace_matches = False # debug output: draw every drone image / map tile pair, show it in a window and write it to
+                      # ../results; without it no GUI is needed and nothing is drawn during the search
+inference_precision = 'fp32' # 'fp32', or int8 models on the CPU (see quantization.py): 'dynamic' quantizes SuperGlue,
+                             # 'static' SuperPoint too; compare them on your data with python3 quantization.py
+inference_backend = 'eager' # 'eager', or 'torchscript' to run compiled graphs of the models (see backends.py), faster
+                            # on the CPU; compiled once and cached in compiled_model_dir
+compiled_model_dir = "../assets/compiled/" # cache of the compiled models
+latency_target = None # seconds: deadline mode, the image size, keypoints and Sinkhorn iterations of every drone image are
+                      # lowered as needed to keep the latency_percentile of the latency under it (see latency_budget.py);
+                      # None always uses the settings above
+latency_percentile = 99 # percentile of the drone image latency kept under latency_target
+instrumentation_filename = None # file for the stage durations and per drone image / map tile metrics, None disables them
+instrumentation_format = 'jsonl' # 'jsonl' (one record per span / metric) or 'prometheus' (text file with the totals)
+results_filename = "../results/calculated_coordinates.csv" # calculated coordinates of the drone images, .csv, .npz
+                                                           # or .parquet (see results_store.py)
+results_buffer_size = 100 # results written to the results file at once
 
 ############################################################################################################
 # Class definitios
@@ -40,18 +96,40 @@ class GeoPhotoDrone:
         self.flight_pitch = flight_pitch
         self.corrected = False
         self.matched = False
+        self.tiles_evaluated = 0
+        self.num_matches = -1 # number of matches with the map tile the drone image was located in
+        self.inlier_ratio = 0.0 # fraction of those matches that are inliers of the homography
+        self.quality_level = 0 # level of the latency budget quality ladder the drone image was localized at
 
     def __str__(self):
         return "%s; \nlatitude: %f \nlongitude: %f \naltitude: %f \ngimball_roll: %f \ngimball_yaw: %f \ngimball_pitch: %f \nflight_roll: %f \nflight_yaw: %f \nflight_pitch: %f" % (self.filename, self.latitude, self.longitude, self.altitude, self.gimball_roll, self.gimball_yaw, self.gimball_pitch, self.flight_roll, self.flight_yaw, self.flight_pitch )
         
+
+# GeoPhotoDrone attributes set by localize_drone_image(), copied back from parallel worker processes
+RESULT_FIELDS = ['matched', 'latitude_calculated', 'longitude_calculated', 'tiles_evaluated', 'num_matches',
+                 'inlier_ratio', 'quality_level']
+
+
 class GeoPhoto:
     """Stores a satellite photo together with (latitude, longitude) for top_left and bottom_right_corner
+    The photo is only read (grayscale) when it is used, from its file or from the orthomosaic window it comes from.
+    Orthomosaic windows also have the affine geotransform of their pixels.
     """
-    def __init__(self, filename, photo, geo_top_left, geo_bottom_right):
+    def __init__(self, filename, photo, geo_top_left, geo_bottom_right, window=None):
         self.filename = filename
-        self.photo = photo
+        self._photo = photo
         self.top_left_coord = geo_top_left
         self.bottom_right_coord = geo_bottom_right
+        self.window = window
+        self.geotransform = window.geotransform if window is not None else None
+
+    @property
+    def photo(self):
+        if self._photo is not None:
+            return self._photo
+        if self.window is not None:
+            return self.window.read()
+        return cv2.imread(self.filename, 0)
 
     def __lt__(self, other):
          return self.filename < other.filename
@@ -86,13 +164,13 @@ def csv_read_drone_images(filename):
         print(f'Processed {line_count} lines.')
         return geo_list_drone
 
-def csv_read_sat_map(filename):
+def csv_read_sat_map(filename, photo_path = "../assets/map/"):
     """Builds a list with satellite geo tagged photos by reading a csv file with this format:
     Filename, Top_left_lat,Top_left_lon,Bottom_right_lat,Bottom_right_long
     "photo_name.png",60.506787,22.311631,60.501037,22.324467
+    The photo filenames are relative to photo_path.
     """
     geo_list = []
-    photo_path = "../assets/map/"
     print("opening: ",filename)
     with open(filename) as csv_file:
         csv_reader = csv.reader(csv_file, delimiter=',')
@@ -102,27 +180,36 @@ def csv_read_sat_map(filename):
                 print(f'Column names are {", ".join(row)}')
                 line_count += 1
             else:            
-                img = cv2.imread(photo_path + row[0],0)
-                geo_photo = GeoPhoto(photo_path + row[0],img,(float(row[1]),float(row[2])), (float(row[3]), float(row[4])))
-                geo_list.append(geo_photo)
                 line_count += 1
+                if not cv2.haveImageReader(photo_path + row[0]):
+                    print("Could not read map image, skipping: " + photo_path + row[0])
+                    continue
+                # the image is only read when it is used
+                geo_photo = GeoPhoto(photo_path + row[0],None,(float(row[1]),float(row[2])), (float(row[3]), float(row[4])))
+                geo_list.append(geo_photo)
 
         print(f'Processed {line_count} lines.')
         geo_list.sort() # sort alphabetically by filename to ensure that the feature matcher return the right index of the matched sat image
         return geo_list
     
-def csv_write_image_location(photo):
-    header = ['Filename', 'Latitude', 'Longitude', 'Calculated_Latitude', 'Calculated_Longitude', 'Latitude_Error', 'Longitude_Error', 'Meters_Error', 'Corrected', 'Matched']
-    with open('../results/calculated_coordinates.csv', 'a', encoding='UTF8') as f:
-        writer = csv.writer(f)        
-        photo_name = photo.filename.split("/")[-1]
-        loc1 = ( photo.latitude, photo.longitude)
-        loc2 = ( photo.latitude_calculated, photo.longitude_calculated)
-        dist_error =  hs.haversine(loc1,loc2,unit=Unit.METERS)
-        lat_error = photo.latitude - photo.latitude_calculated
-        lon_error = photo.longitude - photo.longitude_calculated
-        line = [photo_name, str(photo.latitude), str(photo.longitude), str(photo.latitude_calculated), str(photo.longitude_calculated), str(lat_error), str(lon_error), str(dist_error), str(drone_image.corrected), str(drone_image.matched), str(drone_image.gimball_yaw + drone_image.flight_yaw - 15)]
-        writer.writerow(line)
+def run_metadata():
+    """Config of the run and version of the map, stored in the header of the results file"""
+    if orthomosaic_filename is not None:
+        stat = os.stat(orthomosaic_filename)
+        map_version = "%d:%d" % (stat.st_size, stat.st_mtime_ns)
+    else:
+        map_version = feature_cache.file_hash(map_filename)
+    names = ['map_filename', 'orthomosaic_filename', 'orthomosaic_window_size', 'orthomosaic_window_overlap',
+             'drone_photos_filename', 'gnss_prior_radius', 'superglue_batch_size', 'workers', 'retrieval_top_k',
+             'early_exit_min_matches', 'early_exit_min_inlier_ratio', 'map_pyramid_levels', 'tracking_mode',
+             'tracking_max_misses', 'use_heading', 'fallback_rotations', 'inference_precision', 'inference_backend',
+             'latency_target', 'latency_percentile', 'instrumentation_filename', 'instrumentation_format']
+    return {'config': {name: globals()[name] for name in names}, 'map_version': map_version}
+
+
+def open_results():
+    """Results writer for the calculated coordinates of the drone images, close it (or use it in a with block) at the end"""
+    return results_store.ResultsWriter(results_filename, run_metadata(), results_buffer_size)
 
 
 def calculate_geo_pose(geo_photo, center, features_mean,  shape):
@@ -131,7 +218,12 @@ def calculate_geo_pose(geo_photo, center, features_mean,  shape):
     Input: satellite geotagged image, relative pixel center of the drone image, 
     (center with x = 0.5 and y = 0.5 means the located features are in the middle of the sat image)
     pixel coordinatess (horizontal and vertical) of where the features are localted in the sat image, shape of the sat image
+    Orthomosaic windows use their geotransform, so rotated or sheared rasters are handled too.
     """
+    if geo_photo.geotransform is not None:
+        window = geo_photo.window
+        return orthomosaic.apply_geotransform(geo_photo.geotransform, center[0] * window.width, center[1] * window.height)
+
     #use ratio here instead of pixels because image is reshaped in superglue    
     latitude = geo_photo.top_left_coord[0] + abs( center[1])  * ( geo_photo.bottom_right_coord[0] - geo_photo.top_left_coord[0])
     longitude = geo_photo.top_left_coord[1] + abs(center[0])  * ( geo_photo.bottom_right_coord[1] - geo_photo.top_left_coord[1])
@@ -140,85 +232,272 @@ def calculate_geo_pose(geo_photo, center, features_mean,  shape):
 
 
 
-#######################################
-# MAIN
-#######################################
+############################################################################################################
+# Localization of the drone images in the satellite map
+############################################################################################################
+class SatelliteMap:
+    """Satellite map loaded for localization: the geo tagged tiles, their superpoint features
+    and the indices used to select the candidate tiles of a drone image
+    """
+    def __init__(self, geo_images_list, tile_features, tile_grid, global_index, coarse_levels=None):
+        self.geo_images_list = geo_images_list
+        self.tile_features = tile_features
+        self.tile_grid = tile_grid
+        self.global_index = global_index
+        self.coarse_levels = coarse_levels or [] # SatelliteMap of every coarse level of the map pyramid, finest first
 
-#Read all the geo tagged images that make up the sattelite map used for reference
-geo_images_list = csv_read_sat_map(map_filename)
 
-#Read all the geo tagged drone that will located in the map
-drone_images_list = csv_read_drone_images(drone_photos_filename)
+def setup_instrumentation(worker=False):
+    """Enables the instrumentation if instrumentation_filename is set; worker processes write to their own file"""
+    if instrumentation_filename is None:
+        return
+    filename = instrumentation_filename
+    if worker:
+        root, extension = os.path.splitext(filename)
+        filename = "%s.%d%s" % (root, os.getpid(), extension)
+    instrumentation.configure(filename, instrumentation_format)
 
-latitude_truth = []
-longitude_truth = []
-latitude_calculated = []
-longitude_calculated = []
 
-print(str(len(drone_images_list)) + " drone photos were loaded.")
+def create_localizer(**kwargs):
+    """Creates the feature matching session used to localize the drone images"""
+    early_exit = None
+    if early_exit_min_matches is not None:
+        early_exit = superglue_utils.EarlyExit(early_exit_min_matches, early_exit_min_inlier_ratio)
+    return superglue_utils.Localizer(batch_size=superglue_batch_size, early_exit=early_exit, trace=trace_matches,
+                                     precision=inference_precision, backend=inference_backend,
+                                     compiled_dir=compiled_model_dir, **kwargs)
 
 
-# Iterate through all the drone images
-for drone_image in drone_images_list:
-    latitude_truth.append(drone_image.latitude) # ground truth from drone image metadata for later comparison
-    longitude_truth.append(drone_image.longitude) # ground truth for later comparison
-    photo =  cv2.imread(drone_image.filename) # read the drone image
-    
+def read_orthomosaic_map(filename):
+    """Builds a list with the overlapping windows of a georeferenced orthomosaic, as satellite geo tagged photos"""
+    mosaic = orthomosaic.Orthomosaic(filename)
+    print("Orthomosaic %s: %dx%d pixels" % (filename, mosaic.width, mosaic.height))
+    windows = mosaic.windows(orthomosaic_window_size, orthomosaic_window_overlap)
+    return [GeoPhoto(window.filename, None, window.top_left_coord, window.bottom_right_coord, window) for window in windows]
+
+
+def load_satellite_map(localizer):
+    """Loads the satellite map and everything derived from it that is reused for every drone image"""
+    if orthomosaic_filename is not None:
+        # Windows of the orthomosaic, read on demand from the memory mapped raster
+        geo_images_list = read_orthomosaic_map(orthomosaic_filename)
+        tile_features = orthomosaic.load_window_features(localizer, [geo_image.window for geo_image in geo_images_list])
+    else:
+        #Read all the geo tagged images that make up the sattelite map used for reference
+        geo_images_list = csv_read_sat_map(map_filename, os.path.join(os.path.dirname(map_filename), ""))
+
+        # Load the superpoint features of the map tiles from the map feature cache, extracting them if missing or stale
+        tile_features, loaded = feature_cache.load_map_features(localizer, [geo_image.filename for geo_image in geo_images_list])
+        geo_images_list = [geo_images_list[index] for index in loaded]
+
+    # Spatial index over the map tiles, used to select the tiles close to the GNSS prior of each drone image
+    tile_grid = TileGrid(geo_images_list)
+
+    # Global descriptors of the map tiles, used to shortlist tiles for drone images without GNSS prior
+    global_index = retrieval.load_global_index(tile_features) if retrieval_top_k is not None else None
+
+    # Coarse levels of the map pyramid, each one with its own cached features
+    coarse_levels = []
+    if map_pyramid_levels:
+        map_dir = os.path.dirname(orthomosaic_filename or map_filename)
+        for level_filename in map_pyramid.build_pyramid(geo_images_list, map_dir, map_pyramid_levels):
+            level_images_list = csv_read_sat_map(level_filename, os.path.join(map_dir, ""))
+            level_features, loaded = feature_cache.load_map_features(localizer, [geo_image.filename for geo_image in level_images_list])
+            level_images_list = [level_images_list[index] for index in loaded]
+            coarse_levels.append(SatelliteMap(level_images_list, level_features, TileGrid(level_images_list), None))
+
+    return SatelliteMap(geo_images_list, tile_features, tile_grid, global_index, coarse_levels)
+
+
+def select_candidates(drone_image, satellite_map, query_data):
+    """
+    Selects the map tiles worth matching for a drone image: the tiles close to its (noisy) GNSS position,
+    or the most similar ones according to their global descriptor if there is no GNSS prior.
+    Returns their indices, most likely first.
+    """
+    candidates = list(range(len(satellite_map.tile_features)))
+    if gnss_prior_radius is not None and not math.isnan(drone_image.latitude) and not math.isnan(drone_image.longitude):
+        candidates, search_radius = satellite_map.tile_grid.search(drone_image.latitude, drone_image.longitude, gnss_prior_radius)
+        instrumentation.value('candidates', len(candidates), source='gnss_prior', radius_m=search_radius)
+    elif satellite_map.global_index is not None:
+        candidates = list(satellite_map.global_index.rank(query_data[1]['descriptors0'][0].cpu().numpy(), retrieval_top_k))
+        instrumentation.value('candidates', len(candidates), source='retrieval')
+    return candidates
+
+
+def create_latency_controller(localizer):
+    """Latency budget controller of the localizer if latency_target is set, None otherwise"""
+    if latency_target is None:
+        return None
+    return latency_budget.LatencyController(localizer, latency_target, latency_percentile)
+
+
+def quality_summary(drone_image):
+    """Quality level of a drone image for its result line, only with a latency target"""
+    return ", quality level %d" % drone_image.quality_level if latency_target is not None else ""
+
+
+def localize_drone_image(drone_image, localizer, satellite_map, tracker=None, controller=None):
+    """
+    Localizes one drone image in the satellite map, sets its calculated coordinates if it was matched.
+    With a tracker (tracking.Tracker) the drone images must come in flight order: while the track is alive
+    only the map tiles around the position predicted from the previous drone images are matched.
+    With a controller (latency_budget.LatencyController) the matching settings are chosen to fit the latency target.
+    """
+    with instrumentation.span('query', query=drone_image.filename.split("/")[-1]):
+        if controller is not None:
+            controller.begin_frame(drone_image)
+        try:
+            return _localize_drone_image(drone_image, localizer, satellite_map, tracker)
+        finally:
+            if controller is not None:
+                controller.end_frame()
+
+
+def _localize_drone_image(drone_image, localizer, satellite_map, tracker):
+    # Position of the drone image predicted by the track of the previous ones, if any
+    prediction = tracker.predict() if tracker is not None else None
+
+    # read the drone image, unless it is already in memory (frames of a video stream)
+    with instrumentation.span('decode'):
+        photo = drone_image.photo if hasattr(drone_image.photo, 'shape') else cv2.imread(drone_image.filename)
+    photo_name = drone_image.filename.split("/")[-1]
+    if photo is None:
+        print("Could not read drone image: " + drone_image.filename)
+        if tracker is not None:
+            tracker.miss()
+        return drone_image
 
-    max_features = 0 # keep track of the best match, more features = better match
     located = False # flag to indicate if the drone image was located in the map
     center = None # center of the drone image in the map
 
+    # Rotations to try: north-up from the heading in the metadata first, then the fallback rotations if that fails
+    # (keep in mind GNSS metadata could have wrong rotation angle)
+    stages = rotation.rotation_stages(drone_image, fallback_rotations, use_heading)
 
-    rotations = [20] # list of rotations to try
-                     # keep in mind GNSS metadata could have wrong rotation angle
-                     # so we try to match the image with different (manually established) rotations
+    # Run superpoint on the (first rotation of the) drone image once, its features are used for retrieval and matching
+    query_data = localizer.extract_query(rotation.rotate_image(photo, stages[0][0]))
 
-    # Iterate through all the rotations, in this case only one rotation
-    for rot in rotations:
-        
-        # Write the query photo to the map folder
-        cv2.imwrite(map_path + "1_query_image.png", photo)
+    # Coarse-to-fine search in the map pyramid: locate the drone image in the coarsest level, then only
+    # match the super-tiles of the next finer level overlapping the one it was found in, down to the map tiles
+    region = None # bounds of the super-tile where the drone image was found, and position estimate in it
+    all_stages, first_query_data = stages, query_data
+    for level in (reversed(satellite_map.coarse_levels) if prediction is None else []):
+        if region is None:
+            candidates = select_candidates(drone_image, level, query_data)
+        else:
+            candidates = level.tile_grid.overlapping(*region)
+        result = rotation.match_rotated(localizer, photo, [level.tile_features[i] for i in candidates], stages, query_data)
+        drone_image.tiles_evaluated += result.tiles_evaluated
+        if not rotation.is_located(result):
+            instrumentation.count('pyramid_misses')
+            region = None
+            break
+        super_tile = level.geo_images_list[candidates[result.tile_index]]
+        region = (map_pyramid.tile_bounds(super_tile), *calculate_geo_pose(super_tile, result.center, result.features_mean, result.query_image.shape))
+        # the finer levels only need the rotation the drone image was found with
+        stages, query_data = [[result.rotation]], result.query_data
 
-        #Call superglue wrapper function to match the query image to the map
-        satellite_map_index_new, center_new, located_image_new, features_mean_new, query_image_new, feature_number = superglue_utils.match_image()
-        
-        # If the drone image was located in the map and the number of features is greater than the previous best match, then update the best match
-        # Sometimes the pixel center returned by the perspective transform exceeds 1, discard the resuls in that case
-        if (feature_number > max_features and center_new[0] < 1 and center_new[1] < 1):
-            satellite_map_index = satellite_map_index_new
-            center = center_new
-            located_image = located_image_new
-            features_mean = features_mean_new
-            query_image = query_image_new
-            max_features = feature_number
-            located = True
-    photo_name = drone_image.filename.split("/")[-1]
+    tile_features = satellite_map.tile_features
+    if prediction is not None:
+        candidates = tracker.candidates(satellite_map.tile_grid)
+        instrumentation.value('candidates', len(candidates), source='tracking')
+    elif region is not None:
+        candidates = satellite_map.tile_grid.overlapping(*region)
+        instrumentation.value('candidates', len(candidates), source='pyramid')
+    else:
+        with instrumentation.span('candidates'):
+            candidates = select_candidates(drone_image, satellite_map, query_data)
+    candidate_tiles = [tile_features[i] for i in candidates]
+
+    #Match the rotated query images to the candidate map tiles, in memory
+    result = rotation.match_rotated(localizer, photo, candidate_tiles, stages, query_data)
+    drone_image.tiles_evaluated += result.tiles_evaluated
+
+    # The super-tile match may have been wrong, search the rest of the map in that case
+    if region is not None and not rotation.is_located(result):
+        instrumentation.count('pyramid_fallbacks')
+        tried = set(candidates)
+        candidates = [i for i in select_candidates(drone_image, satellite_map, first_query_data) if i not in tried]
+        result = rotation.match_rotated(localizer, photo, [tile_features[i] for i in candidates], all_stages, first_query_data)
+        drone_image.tiles_evaluated += result.tiles_evaluated
+
+    # If the drone image was located in the map, keep the best match
+    # Sometimes the pixel center returned by the perspective transform exceeds 1, discard the resuls in that case
+    if (result.num_matches > 0 and result.center[0] < 1 and result.center[1] < 1):
+        satellite_map_index = candidates[result.tile_index]
+        center = result.center
+        best_result = result # its located image is only drawn if it is saved
+        features_mean = result.features_mean
+        query_image = result.query_image
+        drone_image.num_matches = result.num_matches
+        drone_image.inlier_ratio = result.inlier_ratio
+        located = True
 
     # If the drone image was located in the map, calculate the geographical location of the drone image
     if center != None and located:        
-        current_location = calculate_geo_pose(geo_images_list[satellite_map_index], center, features_mean, query_image.shape )
+        current_location = calculate_geo_pose(satellite_map.geo_images_list[satellite_map_index], center, features_mean, query_image.shape )
         
         # Write the results to the image result file with the best match
-        cv2.putText(located_image, "Calculated: " + str(current_location), org = (10,625),fontFace =  cv2.FONT_HERSHEY_DUPLEX, fontScale = 0.8,  color = (0, 0, 0))
-        cv2.putText(located_image, "Ground truth: " + str(drone_image.latitude) + ", " + str(drone_image.longitude), org = (10,655),fontFace =  cv2.FONT_HERSHEY_DUPLEX, fontScale = 0.8,  color = (0, 0, 0))
-        cv2.imwrite("../results/" + photo_name + "_located.png", located_image)
+        if save_located_images:
+            with instrumentation.span('visualization'):
+                located_image = best_result.located_image
+                cv2.putText(located_image, "Calculated: " + str(current_location), org = (10,625),fontFace =  cv2.FONT_HERSHEY_DUPLEX, fontScale = 0.8,  color = (0, 0, 0))
+                cv2.putText(located_image, "Ground truth: " + str(drone_image.latitude) + ", " + str(drone_image.longitude), org = (10,655),fontFace =  cv2.FONT_HERSHEY_DUPLEX, fontScale = 0.8,  color = (0, 0, 0))
+                cv2.imwrite("../results/" + photo_name + "_located.png", located_image)
         
-        print("Image " + str(photo_name) + " was successfully located in the map")
-        print("Calculated location: ", str(current_location[0:2]))
-        print("Ground Truth: ", drone_image.latitude, drone_image.longitude)   
+        print("Image %s located at %s (ground truth %s, %s), rotated by %.1f degrees, %d matches, %d tiles evaluated%s" % (
+            photo_name, str(current_location[0:2]), drone_image.latitude, drone_image.longitude, best_result.rotation,
+            drone_image.num_matches, drone_image.tiles_evaluated, quality_summary(drone_image)))
         
         # Save the calculated location for later comparison with the ground truth
         drone_image.matched = True
         drone_image.latitude_calculated = current_location[0]
         drone_image.longitude_calculated = current_location[1]
-        
-        latitude_calculated.append(drone_image.latitude_calculated)
-        longitude_calculated.append(drone_image.longitude_calculated)
+        if tracker is not None:
+            tracker.update(*current_location[0:2])
 
     else:
-        print("NOT MATCHED:", photo_name)
+        print("NOT MATCHED: %s, %d tiles evaluated%s" % (photo_name, drone_image.tiles_evaluated, quality_summary(drone_image)))
+        if tracker is not None:
+            tracker.miss()
+
+    instrumentation.value('tiles_evaluated', drone_image.tiles_evaluated)
+    instrumentation.count('located' if drone_image.matched else 'not_located')
+    return drone_image
+
+
+#######################################
+# MAIN
+#######################################
+
+if __name__ == "__main__":
+    #Read all the geo tagged drone that will located in the map
+    drone_images_list = csv_read_drone_images(drone_photos_filename)
+
+    print(str(len(drone_images_list)) + " drone photos were loaded.")
+    setup_instrumentation()
+
+    if workers > 1 and tracking_mode:
+        print("Tracking needs the drone images in flight order, localizing them in a single process")
+
+    with open_results() as results:
+        if workers > 1 and not tracking_mode:
+            # Split the drone images across worker processes, the results come back in input order
+            for drone_image in parallel.localize_parallel(drone_images_list, workers, threads_per_worker):
+                # Write the results to the results file
+                results.write(drone_image)
+        else:
+            # Load the feature matching model and the map once, they are reused for every drone image
+            localizer = create_localizer()
+            satellite_map = load_satellite_map(localizer)
+            tracker = tracking.Tracker(tracking_max_misses) if tracking_mode else None
+            controller = create_latency_controller(localizer)
+
+            # Iterate through all the drone images
+            for drone_image in drone_images_list:
+                localize_drone_image(drone_image, localizer, satellite_map, tracker, controller)
 
-    # Write the results to the csv file    
-    csv_write_image_location(drone_image)
+                # Write the results to the results file
+                results.write(drone_image)
 